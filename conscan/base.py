@@ -34,9 +34,11 @@
 
 from molmod import PairSearchIntra, Rotation
 
-from interface import ProgressMessage
+from interface import Geometry, QualityEvaluator, ConnectionPreview, \
+    ProgressMessage, decompose_transformations
+from cache import environment_cache
 
-import math, numpy, copy
+import math, numpy, copy, multiprocessing, heapq
 
 
 __all__ = ["Scanner"]
@@ -49,6 +51,31 @@ class Environment(object):
         deltas = []
         distances = []
 
+    def set_fingerprint(self, hit_tolerance):
+        # The distances are binned with a bin width equal to hit_tolerance.
+        # Three bitsets (Python integers) are stored: the populated bins,
+        # the bins with at least two distances and the populated bins
+        # together with their neighbors. Two matching distances always end
+        # up in the same or in neighboring bins.
+        counts = numpy.bincount((self.distances/hit_tolerance).astype(int))
+        self.fingerprint_bits = 0
+        self.fingerprint_doubles = 0
+        for index in counts.nonzero()[0]:
+            self.fingerprint_bits |= 1 << int(index)
+            if counts[index] > 1:
+                self.fingerprint_doubles |= 1 << int(index)
+        self.fingerprint_dilated = self.fingerprint_bits | (self.fingerprint_bits << 1) | (self.fingerprint_bits >> 1)
+
+    def count_matchable(self, other, limit):
+        """An upper bound for the number of distances that match with other
+
+        The result is truncated at limit.
+        """
+        if self.fingerprint_doubles & other.fingerprint_dilated:
+            return limit
+        shared = self.fingerprint_bits & other.fingerprint_dilated
+        return min(limit, bin(shared).count("1"))
+
 
 
 
@@ -56,13 +83,74 @@ class EmptyGeometry(Exception):
     pass
 
 
+def rotations_to_quaternions(rotations):
+    """Convert an array of proper rotation matrices into quaternions
+
+    For each matrix, the largest quaternion component is computed from the
+    diagonal and the others from the off-diagonal elements (Shepperd's
+    method), which is robust for all rotation angles. The sign of each
+    quaternion is chosen such that the first component is not negative.
+    """
+    r = rotations
+    size = len(r)
+    trace = r[:, 0, 0] + r[:, 1, 1] + r[:, 2, 2]
+    squares = numpy.array([
+        1 + trace,
+        1 + 2*r[:, 0, 0] - trace,
+        1 + 2*r[:, 1, 1] - trace,
+        1 + 2*r[:, 2, 2] - trace,
+    ]).transpose()
+    largest = squares.argmax(axis=1)
+    factors = 2*numpy.sqrt(squares[numpy.arange(size), largest])
+    # each row contains 4*q0*q, 4*q1*q, 4*q2*q and 4*q3*q, the relevant one is
+    # divided by 4*q_largest.
+    products = numpy.array([
+        [squares[:, 0], r[:, 2, 1] - r[:, 1, 2], r[:, 0, 2] - r[:, 2, 0], r[:, 1, 0] - r[:, 0, 1]],
+        [r[:, 2, 1] - r[:, 1, 2], squares[:, 1], r[:, 0, 1] + r[:, 1, 0], r[:, 0, 2] + r[:, 2, 0]],
+        [r[:, 0, 2] - r[:, 2, 0], r[:, 0, 1] + r[:, 1, 0], squares[:, 2], r[:, 1, 2] + r[:, 2, 1]],
+        [r[:, 1, 0] - r[:, 0, 1], r[:, 0, 2] + r[:, 2, 0], r[:, 1, 2] + r[:, 2, 1], squares[:, 3]],
+    ]).transpose(2, 0, 1)
+    quaternions = products[numpy.arange(size), largest]/factors.reshape((-1, 1))
+    quaternions[quaternions[:, 0] < 0] *= -1
+    return quaternions
+
+
+# The scanner that is being run in a process pool. It is set before the pool
+# is created, such that the forked workers inherit it without pickling.
+_pool_scanner = None
+
+
+def _compare_shard(ids1):
+    scanner = _pool_scanner
+    scanner.connections = []
+    environments2 = scanner.geometry2.environments
+    for id1 in ids1:
+        environment1 = scanner.geometry1.environments[id1]
+        for environment2 in environments2.itervalues():
+            if scanner.may_match(environment1, environment2):
+                scanner.compare_environments(environment1, environment2)
+    return len(ids1), scanner.connections
+
+
 class Scanner(object):
-    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance):
+    # The minimum number of matching distances in a pair of environments that
+    # is needed to generate a connection.
+    min_matches = 1
+
+    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, num_processes=1, prune_size=0, rotation_tolerance=None, translation_tolerance=None, top_k=None, cache_dir=None):
         self.send = send
         self.geometry1 = geometry1
         self.geometry2 = geometry2
         self.action_radius = action_radius
         self.hit_tolerance = hit_tolerance
+        if num_processes is None:
+            num_processes = multiprocessing.cpu_count()
+        self.num_processes = num_processes
+        self.prune_size = prune_size
+        self.rotation_tolerance = rotation_tolerance
+        self.translation_tolerance = translation_tolerance
+        self.top_k = top_k
+        self.cache_dir = cache_dir
 
         self.egoscan = (geometry2 is None)
         if self.egoscan:
@@ -75,7 +163,12 @@ class Scanner(object):
         # find the connections
         self.generate_connections()
         self.compute_transformations()
-        self.evaluate_connections()
+        if self.prune_size > 0:
+            self.prune_connections()
+        if self.top_k is None:
+            self.evaluate_connections()
+        else:
+            self.evaluate_connections_streaming()
         self.eliminate_duplicate_connections()
         # send them to the parent process
         self.connections.sort(key=(lambda c: -c.quality))
@@ -131,7 +224,13 @@ class Scanner(object):
             return environments
 
         def assign_env(geometry, number):
-            environments = setup_env(geometry, self.action_radius)
+            # The environments only depend on the coordinates, the connect
+            # masks and the action radius, hence they can be reused when only
+            # other parameters are changed.
+            environments = environment_cache.load(geometry, self.action_radius, self.cache_dir)
+            if environments is None:
+                environments = setup_env(geometry, self.action_radius)
+                environment_cache.dump(geometry, self.action_radius, environments, self.cache_dir)
 
             def overlap(environment):
                 for distance in environment.distances:
@@ -148,6 +247,9 @@ class Scanner(object):
             if len(geometry.environments) == 0:
                 raise EmptyGeometry("No usable points were found in geometry %i" % number)
 
+            for environment in geometry.environments.itervalues():
+                environment.set_fingerprint(self.hit_tolerance)
+
             #self.output("     '" + geometry.root.name + "' has " + str(len(geometry.environments) + len(dupes)) + " - " + str(len(dupes)) + " = " + str(len(geometry.environments)) + " environments to be checked for connection.\n")
             #for environment in geometry.environments:
             #    self.output("          identifier %s\tneighbors %s\n" % (environment.id, environment.neighbors))
@@ -172,15 +274,56 @@ class Scanner(object):
         environments1 = self.geometry1.environments
         environments2 = self.geometry2.environments
         maximum = len(environments1)
-        for progress, environment1 in enumerate(environments1.itervalues()):
-            self.send(ProgressMessage("comp_env", progress, maximum))
-            for environment2 in environments2.itervalues():
-                self.compare_environments(environment1, environment2)
+        if self.num_processes > 1 and maximum > 1:
+            self.compare_environments_parallel()
+        else:
+            for progress, environment1 in enumerate(environments1.itervalues()):
+                self.send(ProgressMessage("comp_env", progress, maximum))
+                for environment2 in environments2.itervalues():
+                    if self.may_match(environment1, environment2):
+                        self.compare_environments(environment1, environment2)
         self.send(ProgressMessage("comp_env", maximum, maximum))
 
         #self.output("     Number of accepted triangles: %i\n" % len(self.connections))
         #self.output("     Average of accepted triangles per environment-pair: %.2f\n" % (len(self.connections) / (len(self.geometrys[0].environment) * len(self.geometrys[1].environment))))
 
+    def compare_environments_parallel(self):
+        # The environments of geometry1 are divided in shards that are
+        # compared in a pool of worker processes. There are a few shards per
+        # process to balance the load and to keep the progress bar moving.
+        # The results are collected in order, such that the list of
+        # connections is the same as in the serial case.
+        global _pool_scanner
+        ids1 = self.geometry1.environments.keys()
+        maximum = len(ids1)
+        shard_size = max(1, maximum/(4*self.num_processes))
+        shards = [ids1[index:index+shard_size] for index in xrange(0, maximum, shard_size)]
+        self.send(ProgressMessage("comp_env", 0, maximum))
+        _pool_scanner = self
+        pool = multiprocessing.Pool(self.num_processes)
+        try:
+            progress = 0
+            for count, connections in pool.imap(_compare_shard, shards):
+                self.connections.extend(connections)
+                progress += count
+                self.send(ProgressMessage("comp_env", progress, maximum))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _pool_scanner = None
+
+    def may_match(self, environment1, environment2):
+        # A cheap test based on the fingerprints of the environments. It
+        # returns False only when the environments certainly do not have
+        # min_matches matching distances.
+        return (
+            environment1.count_matchable(environment2, self.min_matches) >= self.min_matches and
+            environment2.count_matchable(environment1, self.min_matches) >= self.min_matches
+        )
+
     def compare_environments(self, environment1, environment2):
         raise NotImplementedError
 
@@ -198,6 +341,76 @@ class Scanner(object):
     def compute_transformation(self, connection):
         raise NotImplementedError
 
+    #
+    # prune_connections
+    #
+
+    def prune_connections(self):
+        # A sample of at most prune_size repulsive points in geometry2 is
+        # checked for overlap with geometry1. The penalty of this sample is
+        # an upper bound for the unfavorable part of the quality and
+        # get_quality_bound gives an upper bound for the favorable part.
+        # Connections for which the sum of both is negative certainly have a
+        # negative quality and are removed. Note that this is not lossless:
+        # without pruning, such clashing connections are evaluated and
+        # reported like all others. The sample is drawn with a fixed seed,
+        # such that a scan always gives the same results.
+        maximum = len(self.connections)
+        repulsive = (~self.geometry2.connect_masks).nonzero()[0]
+        if maximum == 0 or len(repulsive) == 0:
+            self.send(ProgressMessage("pruned", 0, maximum))
+            return
+        sample = numpy.random.RandomState(0).permutation(repulsive)[:self.prune_size]
+        sample.sort()
+        geometry2 = Geometry(
+            self.geometry2.coordinates[sample],
+            self.geometry2.connect_masks[sample],
+            self.geometry2.radii[sample],
+        )
+        cutoff = max(self.geometry1.radii.max(), self.geometry2.radii.max())
+        evaluator = QualityEvaluator(self.geometry1, geometry2, cutoff)
+        limit = -self.get_quality_bound(cutoff)
+        step = evaluator.get_batch_size()
+        survivors = []
+        for start in xrange(0, maximum, step):
+            self.send(ProgressMessage("pruned", start - len(survivors), maximum))
+            batch = self.connections[start:start+step]
+            qualities = evaluator.compute(batch)[0]
+            survivors.extend(
+                connection for connection, quality
+                in zip(batch, qualities) if quality >= limit
+            )
+        self.send(ProgressMessage("pruned", maximum - len(survivors), maximum))
+        self.connections = survivors
+
+    def get_quality_bound(self, cutoff):
+        # Returns an upper bound for the favorable part of the quality of any
+        # connection. Each overlapping pair of connecting points contributes
+        # at most one. A connecting point of geometry2 with radius r overlaps
+        # with connecting points of geometry1 that are closer than
+        # distance = min(cutoff, r + largest radius of geometry1). All of
+        # these are closer than 2*distance to each other, hence their number
+        # is at most the largest number of connecting points of geometry1
+        # within 2*distance of one of them.
+        coordinates1 = self.geometry1.coordinates[self.geometry1.connect_masks]
+        if len(coordinates1) == 0:
+            return 0
+        radii1 = self.geometry1.radii[self.geometry1.connect_masks]
+        radii2 = self.geometry2.radii[self.geometry2.connect_masks]
+        distances = numpy.minimum(cutoff, radii2 + radii1.max())
+        geometry1 = Geometry(
+            coordinates1,
+            numpy.ones(len(coordinates1), bool),
+            radii1,
+        )
+        result = 0
+        for distance in numpy.unique(distances):
+            evaluator = QualityEvaluator(geometry1, geometry1, 2*distance)
+            indices1, indices2, pair_distances = evaluator.find_pairs(coordinates1)
+            count = numpy.bincount(indices2).max()
+            result += count*(distances == distance).sum()
+        return result
+
     #
     # evaluate_connections
     #
@@ -205,15 +418,61 @@ class Scanner(object):
     def evaluate_connections(self):
         maximum = len(self.connections)
         if maximum > 0:
-            for progress, connection in enumerate(self.connections):
+            evaluator = QualityEvaluator(self.geometry1, self.geometry2)
+            step = evaluator.get_batch_size()
+            for progress in xrange(0, maximum, step):
                 self.send(ProgressMessage("eval_con", progress, maximum))
-                connection.compute_quality(self.geometry1, self.geometry2)
+                evaluator.evaluate(self.connections[progress:progress+step])
         self.send(ProgressMessage("eval_con", maximum, maximum))
 
+    def evaluate_connections_streaming(self):
+        # Only the best top_k connections are retained during the evaluation.
+        # Each time a connection enters this selection, a preview is sent to
+        # the parent process, such that the best results can be shown before
+        # the scan is finished. Connections that are not selected are released
+        # immediately. Duplicates (according to stage 1 of
+        # eliminate_duplicate_connections) are already merged here, otherwise
+        # they could crowd out other connections. All previews of duplicates
+        # get the same key, such that a better duplicate replaces the preview
+        # of the one it supersedes.
+        candidates = self.connections
+        maximum = len(candidates)
+        best = {}
+        preview_keys = {}
+        if maximum > 0:
+            evaluator = QualityEvaluator(self.geometry1, self.geometry2)
+            step = evaluator.get_batch_size()
+            for progress in xrange(0, maximum, step):
+                self.send(ProgressMessage("eval_con", progress, maximum))
+                batch = candidates[progress:progress+step]
+                candidates[progress:progress+step] = [None]*len(batch)
+                evaluator.evaluate(batch)
+                previous = set(id(connection) for connection in best.itervalues())
+                for connection in batch:
+                    key = self.get_duplicate_key(connection)
+                    existing = best.get(key)
+                    if existing is None or existing.quality < connection.quality:
+                        best[key] = connection
+                best = dict(heapq.nlargest(
+                    self.top_k, best.iteritems(), key=(lambda item: item[1].quality)
+                ))
+                for key, connection in best.iteritems():
+                    if id(connection) not in previous:
+                        preview_key = preview_keys.setdefault(key, len(preview_keys))
+                        self.send(ConnectionPreview(connection.quality, len(connection.pairs), preview_key))
+        self.send(ProgressMessage("eval_con", maximum, maximum))
+        self.connections = best.values()
+
     #
     # eliminate_duplicate_connections
     #
 
+    def get_duplicate_key(self, connection):
+        if isinstance(connection.transformation, Rotation):
+            return (connection.pairs, numpy.linalg.det(connection.transformation.r) > 0)
+        else:
+            return connection.pairs
+
     def eliminate_duplicate_connections(self):
         # Stage 1 searches for duplicates that arise because certain pairs of
         # matching triangles simply lead to the same relative orientation. Two
@@ -226,10 +485,7 @@ class Scanner(object):
         maximum = len(self.connections)
         for connection in self.connections:
             self.send(ProgressMessage("elim_dup", progress, maximum))
-            if isinstance(connection.transformation, Rotation):
-                key = (connection.pairs, numpy.linalg.det(connection.transformation.r) > 0)
-            else:
-                key = connection.pairs
+            key = self.get_duplicate_key(connection)
             existing = stage1.get(key)
             if existing is None:
                 progress += 1
@@ -269,4 +525,60 @@ class Scanner(object):
 
         self.connections = stage2.values()
 
+        if self.rotation_tolerance is not None and self.translation_tolerance is not None:
+            # Stage 3 merges connections with nearly the same transformation.
+            self.cluster_connections()
+
+    def cluster_connections(self):
+        # Each transformation is represented by a point in seven dimensions:
+        # the quaternion of the (proper part of the) rotation and the
+        # translation vector. Two transformations are duplicates when all
+        # quaternion components differ less than rotation_tolerance and all
+        # translation components less than translation_tolerance. The points
+        # are hashed in a grid with cells that are twice as large as the
+        # tolerances, such that a duplicate is always found in one of the 2**7
+        # cells nearest to a point. The connections are processed by
+        # decreasing quality, hence the best connection of a cluster is kept.
+        maximum = len(self.connections)
+        if maximum == 0:
+            return
+        self.connections.sort(key=(lambda c: -c.quality))
+        rotations, translations = decompose_transformations(self.connections)
+        determinants = numpy.array([numpy.linalg.det(r) for r in rotations])
+        quaternions = rotations_to_quaternions(rotations*determinants.reshape((-1, 1, 1)))
+        tolerances = numpy.array([self.rotation_tolerance]*4 + [self.translation_tolerance]*3)
+        points = numpy.concatenate([quaternions, translations], axis=1)/tolerances
+
+        corners = numpy.array([
+            [(index >> bit) & 1 for bit in xrange(7)] for index in xrange(2**7)
+        ])
+        grid = {}
+        survivors = []
+        for progress, (connection, point, determinant) in enumerate(zip(self.connections, points, determinants)):
+            self.send(ProgressMessage("elim_dup", progress, maximum))
+            proper = determinant > 0
+            # q and -q are the same rotation.
+            if abs(point[0]) < 1:
+                alternatives = [point, numpy.concatenate([-point[:4], point[4:]])]
+            else:
+                alternatives = [point]
+            duplicate = False
+            for alternative in alternatives:
+                cell = numpy.floor(alternative/2).astype(int)
+                directions = 2*(alternative - 2*cell >= 1) - 1
+                for corner in corners:
+                    key = (proper,) + tuple(cell + corner*directions)
+                    for other in grid.get(key, ()):
+                        if abs(other - alternative).max() < 1:
+                            duplicate = True
+                            break
+                    if duplicate: break
+                if duplicate: break
+            if not duplicate:
+                key = (proper,) + tuple(numpy.floor(point/2).astype(int))
+                grid.setdefault(key, []).append(point)
+                survivors.append(connection)
+        self.send(ProgressMessage("elim_dup", maximum, maximum))
+        self.connections = survivors
+
 
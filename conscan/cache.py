@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import cPickle, os, hashlib
+
+
+__all__ = ["EnvironmentCache", "environment_cache"]
+
+
+class EnvironmentCache(object):
+    """Keeps the environmental descriptions of recently scanned geometries
+
+    The key of an entry is a hash of the coordinates, the connect masks and
+    the action radius, the only parameters that affect the environments.
+    The most recent entries are kept in memory. When a directory is given,
+    the entries are also stored on disk, where the most recently used
+    disk_size files are kept. The modification time of a file is updated
+    each time it is read, such that the directory behaves like the LRU list
+    in memory.
+    """
+    def __init__(self, size=8, disk_size=64):
+        self.size = size
+        self.disk_size = disk_size
+        self.keys = []
+        self.values = {}
+
+    def get_key(self, geometry, action_radius):
+        h = hashlib.sha1()
+        h.update(geometry.coordinates.astype(float).tostring())
+        h.update(geometry.connect_masks.astype(bool).tostring())
+        h.update(repr(float(action_radius)))
+        return h.hexdigest()
+
+    def get_filename(self, directory, key):
+        return os.path.join(directory, "%s.environments" % key)
+
+    def remember(self, key, environments):
+        if key in self.values:
+            self.keys.remove(key)
+        self.keys.append(key)
+        self.values[key] = environments
+        while len(self.keys) > self.size:
+            del self.values[self.keys.pop(0)]
+
+    def load(self, geometry, action_radius, directory=None):
+        """Returns the cached environments or None"""
+        key = self.get_key(geometry, action_radius)
+        environments = self.values.get(key)
+        if environments is None and directory is not None:
+            filename = self.get_filename(directory, key)
+            if os.path.isfile(filename):
+                try:
+                    f = file(filename, "rb")
+                    try:
+                        environments = cPickle.load(f)
+                    finally:
+                        f.close()
+                    os.utime(filename, None)
+                except Exception:
+                    # a damaged file is just a cache miss
+                    environments = None
+        if environments is not None:
+            self.remember(key, environments)
+        return environments
+
+    def dump(self, geometry, action_radius, environments, directory=None):
+        key = self.get_key(geometry, action_radius)
+        self.remember(key, environments)
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # write to a temporary file first, such that concurrent scans
+            # never read an incomplete file.
+            filename = self.get_filename(directory, key)
+            tmp_filename = "%s.%i" % (filename, os.getpid())
+            f = file(tmp_filename, "wb")
+            try:
+                cPickle.dump(environments, f, -1)
+            finally:
+                f.close()
+            os.rename(tmp_filename, filename)
+            self.evict(directory)
+
+    def evict(self, directory):
+        """Removes the least recently used files beyond disk_size"""
+        entries = []
+        for name in os.listdir(directory):
+            if not name.endswith(".environments"):
+                continue
+            filename = os.path.join(directory, name)
+            try:
+                entries.append((os.path.getmtime(filename), filename))
+            except OSError:
+                # removed by a concurrent scan
+                continue
+        entries.sort()
+        for mtime, filename in entries[:max(0, len(entries) - self.disk_size)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+environment_cache = EnvironmentCache()
@@ -37,7 +37,10 @@ from molmod import PairSearchInter
 import numpy, sys, copy
 
 
-__all__  = ["Geometry", "Connection", "ProgressMessage"]
+__all__  = [
+    "Geometry", "Connection", "QualityEvaluator", "ConnectionPreview",
+    "ProgressMessage"
+]
 
 
 class Geometry(object):
@@ -89,6 +92,145 @@ class Connection(object):
         self.pairs = frozenset(pairs)
 
 
+def decompose_transformations(connections):
+    """Stacked rotation matrices and translation vectors of the connections
+
+    They are extracted by applying each transformation to the origin and the
+    unit vectors, which works for all types of transformations.
+    """
+    basis = numpy.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]], float)
+    rotations = numpy.zeros((len(connections), 3, 3), float)
+    translations = numpy.zeros((len(connections), 3), float)
+    for index, connection in enumerate(connections):
+        points = connection.transformation*basis
+        translations[index] = points[0]
+        rotations[index] = (points[1:] - points[0]).transpose()
+    return rotations, translations
+
+
+class QualityEvaluator(object):
+    """Computes the quality of many connections at once
+
+    The points of geometry1 are sorted in a cell list that is reused for all
+    connections. The coordinates of geometry2 are transformed for a batch of
+    connections at once and all overlapping pairs in the batch are found and
+    evaluated with array operations. The results are identical to those of
+    Connection.compute_quality, up to round-off in the quality.
+    """
+
+    # number of transformed points of geometry2 that are processed at once
+    batch_points = 50000
+
+    def __init__(self, geometry1, geometry2, cutoff=None):
+        self.geometry1 = geometry1
+        self.geometry2 = geometry2
+        if cutoff is None:
+            cutoff = max(geometry1.radii.max(), geometry2.radii.max())
+        self.cutoff = cutoff
+
+        # the cell list of geometry1
+        keys = self.get_keys(self.get_cells(geometry1.coordinates))
+        self.order = keys.argsort()
+        self.cell_keys = keys[self.order]
+
+        # all relative cells that may contain neighbors
+        offsets = numpy.array([
+            (x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)
+        ], int)
+        self.key_offsets = self.get_keys(offsets) - self.get_keys(numpy.zeros((1, 3), int))
+
+    def get_cells(self, coordinates):
+        return numpy.floor(coordinates/self.cutoff).astype(int)
+
+    def get_keys(self, cells):
+        # a unique integer for each cell, assuming that the cell indexes are
+        # within the range [-2**20, 2**20[.
+        cells = cells.astype(numpy.int64) + 2**20
+        return (cells[..., 0]*2**21 + cells[..., 1])*2**21 + cells[..., 2]
+
+    def find_pairs(self, coordinates2):
+        # returns the indexes of the pairs within the cutoff distance and their
+        # distances. coordinates2 is a flat list of transformed points.
+        keys = (
+            self.get_keys(self.get_cells(coordinates2)).reshape((-1, 1)) +
+            self.key_offsets
+        ).ravel()
+        lows = self.cell_keys.searchsorted(keys, "left")
+        highs = self.cell_keys.searchsorted(keys, "right")
+        counts = highs - lows
+        total = counts.sum()
+        indices2 = numpy.repeat(numpy.arange(len(keys))//len(self.key_offsets), counts)
+        offsets = numpy.repeat(counts.cumsum() - counts, counts)
+        indices1 = self.order[numpy.repeat(lows, counts) + numpy.arange(total) - offsets]
+        deltas = coordinates2[indices2] - self.geometry1.coordinates[indices1]
+        distances = numpy.sqrt((deltas**2).sum(axis=1))
+        mask = distances < self.cutoff
+        return indices1[mask], indices2[mask], distances[mask]
+
+    def compute(self, connections):
+        """Compute the qualities and the connecting pairs of the connections
+
+        Returns the array with qualities and three arrays describing the
+        connecting pairs: the index of the connection and the indexes of the
+        points in geometry1 and geometry2.
+        """
+        geometry1 = self.geometry1
+        geometry2 = self.geometry2
+        size2 = len(geometry2.coordinates)
+
+        rotations, translations = decompose_transformations(connections)
+        coordinates2 = (
+            numpy.dot(rotations, geometry2.coordinates.transpose()).transpose(0, 2, 1) +
+            translations.reshape((-1, 1, 3))
+        ).reshape((-1, 3))
+
+        indices1, indices2, distances = self.find_pairs(coordinates2)
+        candidates = indices2//size2
+        indices2 = indices2 % size2
+
+        radii = geometry1.radii[indices1] + geometry2.radii[indices2]
+        overlap = distances < radii
+        indices1 = indices1[overlap]
+        indices2 = indices2[overlap]
+        candidates = candidates[overlap]
+        penalties = 1 - (distances[overlap]/radii[overlap])**2
+        connecting = geometry1.connect_masks[indices1] & geometry2.connect_masks[indices2]
+        penalties[~connecting] *= -2
+        qualities = numpy.bincount(candidates, penalties, len(connections))
+
+        return qualities, candidates[connecting], indices1[connecting], indices2[connecting]
+
+    def evaluate(self, connections):
+        """Assign a quality and the overlapping pairs to all connections"""
+        if len(connections) == 0:
+            return
+        qualities, candidates, indices1, indices2 = self.compute(connections)
+
+        # the connecting pairs are grouped per candidate
+        order = candidates.argsort(kind="mergesort")
+        bounds = candidates[order].searchsorted(numpy.arange(len(connections) + 1))
+        pairs = zip(indices1[order].tolist(), indices2[order].tolist())
+        for index, connection in enumerate(connections):
+            connection.quality = qualities[index]
+            connection.pairs = frozenset(pairs[bounds[index]:bounds[index+1]])
+
+    def get_batch_size(self):
+        """The number of connections that is evaluated in one call"""
+        return max(1, self.batch_points//len(self.geometry2.coordinates))
+
+
+class ConnectionPreview(object):
+    """A light-weight summary of a good connection found during the scan
+
+    Duplicate connections (stage 1 of eliminate_duplicate_connections) share
+    the same key. A preview replaces any earlier preview with the same key.
+    """
+    def __init__(self, quality, size, key):
+        self.quality = quality
+        self.size = size
+        self.key = key
+
+
 class ProgressMessage(object):
     def __init__(self, label, progress, maximum):
         self.label = label
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Compact encodings of the messages sent by the conscan helper
+
+The codecs are registered with zeobuilder.wire.register_codecs in the helper
+and in the process that reads its output. Arrays are stored as raw
+little-endian float64 or int32 buffers. Transformations are sent as a type
+code and a 4x4 float64 matrix, such that they are decoded as an instance of
+the same class.
+"""
+
+
+from conscan.interface import Connection, ConnectionPreview, ProgressMessage
+
+from molmod import Translation, Rotation, Complete
+
+import struct, numpy
+
+
+__all__ = ["message_codecs"]
+
+
+PROGRESS = 1
+PREVIEW = 2
+CONNECTION = 3
+
+
+# the most specific class first
+transformation_types = [
+    (Complete, lambda matrix: Complete(matrix[:3, :3].copy(), matrix[:3, 3].copy())),
+    (Rotation, lambda matrix: Rotation(matrix[:3, :3].copy())),
+    (Translation, lambda matrix: Translation(matrix[:3, 3].copy())),
+]
+
+
+def get_transformation_index(transformation):
+    # the exact type first, then the first base class
+    for index, (cls, construct) in enumerate(transformation_types):
+        if type(transformation) is cls:
+            return index
+    for index, (cls, construct) in enumerate(transformation_types):
+        if isinstance(transformation, cls):
+            return index
+    raise TypeError("Can not encode a transformation of type %s." % type(transformation))
+
+
+def encode_transformation(transformation):
+    index = get_transformation_index(transformation)
+    basis = numpy.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]], float)
+    points = transformation*basis
+    matrix = numpy.identity(4, float)
+    matrix[:3, :3] = (points[1:] - points[0]).transpose()
+    matrix[:3, 3] = points[0]
+    return index, matrix
+
+
+progress_struct = struct.Struct("<ii")
+
+def encode_progress(message):
+    return progress_struct.pack(message.progress, message.maximum) + message.label
+
+def decode_progress(payload):
+    progress, maximum = progress_struct.unpack_from(payload)
+    return ProgressMessage(payload[progress_struct.size:], progress, maximum)
+
+
+preview_struct = struct.Struct("<dii")
+
+def encode_preview(preview):
+    return preview_struct.pack(preview.quality, preview.size, preview.key)
+
+def decode_preview(payload):
+    return ConnectionPreview(*preview_struct.unpack(payload))
+
+
+connection_struct = struct.Struct("<dBB")
+
+def encode_connection(connection):
+    index, matrix = encode_transformation(connection.transformation)
+    pairs = numpy.array(list(connection.pairs), numpy.int32).reshape((-1, 2))
+    return "".join([
+        connection_struct.pack(connection.quality, connection.invertible, index),
+        matrix.astype("<f8").tostring(),
+        pairs.astype("<i4").tostring(),
+    ])
+
+def decode_connection(payload):
+    quality, invertible, index = connection_struct.unpack_from(payload)
+    offset = connection_struct.size
+    matrix = numpy.frombuffer(payload, "<f8", 16, offset).reshape((4, 4))
+    offset += 16*8
+    pairs = numpy.frombuffer(payload, "<i4", -1, offset).reshape((-1, 2))
+    connection = Connection(frozenset(zip(pairs[:, 0].tolist(), pairs[:, 1].tolist())))
+    connection.transformation = transformation_types[index][1](matrix)
+    connection.quality = quality
+    connection.invertible = bool(invertible)
+    return connection
+
+
+message_codecs = [
+    (ProgressMessage, PROGRESS, encode_progress, decode_progress),
+    (ConnectionPreview, PREVIEW, encode_preview, decode_preview),
+    (Connection, CONNECTION, encode_connection, decode_connection),
+]
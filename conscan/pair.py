@@ -44,8 +44,8 @@ __all__ = ["PairScanner"]
 
 
 class PairScanner(Scanner):
-    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, rotation2):
-        Scanner.__init__(self, send, geometry1, geometry2, action_radius, hit_tolerance)
+    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, rotation2, **kwargs):
+        Scanner.__init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, **kwargs)
         if rotation2 is None:
             self.rotation2 = Rotation.identity()
         else:
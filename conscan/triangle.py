@@ -80,16 +80,127 @@ class Triangle(object):
 
 
 class TriangleScanner(Scanner):
-    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, allow_inversions, minimum_trianlge_area):
-        Scanner.__init__(self, send, geometry1, geometry2, action_radius, hit_tolerance)
+    # two sides of a triangle must match
+    min_matches = 2
+
+    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, allow_inversions, minimum_trianlge_area, vectorized=True, **kwargs):
+        Scanner.__init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, **kwargs)
         self.allow_inversions = allow_inversions
         self.minimum_trianlge_area = minimum_trianlge_area
+        self.vectorized = vectorized
 
     #
     # generate_connections
     #
 
+    def compute_environmental_descriptions(self):
+        Scanner.compute_environmental_descriptions(self)
+        if self.vectorized:
+            self.compute_distance_tables(self.geometry1)
+            if not self.egoscan:
+                self.compute_distance_tables(self.geometry2)
+
+    def compute_distance_tables(self, geometry):
+        # The vectorized comparison needs the neighbor distances of each
+        # environment in sorted order and a global table to look up the
+        # distance between two (usable) points without dictionaries. The
+        # latter is a sorted array of keys id1*size + id2.
+        size = len(geometry.coordinates)
+        keys = []
+        distances = []
+        for environment in geometry.environments.itervalues():
+            usable = numpy.array([
+                neighbor in geometry.environments
+                for neighbor in environment.neighbors
+            ], bool)
+            # avoiding duplicates part 1
+            mask = usable & (environment.id < environment.neighbors)
+            environment.sorted_indices = environment.distances.argsort()
+            environment.sorted_distances = environment.distances[environment.sorted_indices]
+            environment.sorted_mask = mask[environment.sorted_indices]
+            keys.append(environment.id*size + environment.neighbors[usable])
+            distances.append(environment.distances[usable])
+        keys = numpy.concatenate(keys).astype(numpy.int64)
+        order = keys.argsort()
+        geometry.distance_keys = keys[order]
+        geometry.distance_values = numpy.concatenate(distances)[order]
+
+    def lookup_distances(self, geometry, ids1, ids2):
+        # returns the distances between the points ids1 and ids2 and a mask
+        # that is False for pairs that are not within the action radius.
+        if len(geometry.distance_keys) == 0:
+            return numpy.zeros(len(ids1), float), numpy.zeros(len(ids1), bool)
+        keys = ids1.astype(numpy.int64)*len(geometry.coordinates) + ids2
+        indices = geometry.distance_keys.searchsorted(keys)
+        indices[indices == len(geometry.distance_keys)] = 0
+        found = (geometry.distance_keys[indices] == keys)
+        return geometry.distance_values[indices], found
+
     def compare_environments(self, environment1, environment2):
+        if self.vectorized:
+            self.compare_environments_vectorized(environment1, environment2)
+        else:
+            self.compare_environments_python(environment1, environment2)
+
+    def compare_environments_vectorized(self, environment1, environment2):
+        # first do a distance compare test on the sorted distances. For each
+        # distance in environment1, a window of candidates in environment2 is
+        # located with searchsorted. The window is slightly too wide to be
+        # safe against round-off, the hit criterion is applied afterwards.
+        distances1 = environment1.sorted_distances[environment1.sorted_mask]
+        indices1 = environment1.sorted_indices[environment1.sorted_mask]
+        distances2 = environment2.sorted_distances
+        margin = 2*self.hit_tolerance
+        lows = distances2.searchsorted(distances1 - margin)
+        highs = distances2.searchsorted(distances1 + margin)
+        counts = highs - lows
+        total = counts.sum()
+        if total < 2:
+            return
+        first = numpy.repeat(numpy.arange(len(distances1)), counts)
+        offsets = numpy.repeat(counts.cumsum() - counts, counts)
+        second = numpy.repeat(lows, counts) + numpy.arange(total) - offsets
+        hits = abs(distances1[first] - distances2[second]) < self.hit_tolerance
+        if hits.sum() < 2:
+            return
+        # translate back to the original neighbor indices and restore the
+        # order of the reference implementation.
+        indices1 = indices1[first[hits]]
+        indices2 = environment2.sorted_indices[second[hits]]
+        order = numpy.lexsort((indices2, indices1))
+        ids1 = environment1.neighbors[indices1[order]]
+        ids2 = environment2.neighbors[indices2[order]]
+
+        # the pairs of matching distances can be further examined for the
+        # third side of the triangle, all combinations at once.
+        n = len(ids1)
+        mask = (
+            # if two sides of one of the triangles coincide, skip this combination
+            (ids1.reshape((n, 1)) != ids1) &
+            # avoiding duplicates part 2
+            (ids2.reshape((n, 1)) < ids2)
+        )
+        rows, cols = mask.nonzero()
+        if len(rows) == 0:
+            return
+        third1, found1 = self.lookup_distances(self.geometry1, ids1[rows], ids1[cols])
+        third2, found2 = self.lookup_distances(self.geometry2, ids2[rows], ids2[cols])
+        accept = found1 & found2 & (abs(third1 - third2) < self.hit_tolerance)
+
+        environments1 = self.geometry1.environments
+        environments2 = self.geometry2.environments
+        for row, col in zip(rows[accept], cols[accept]):
+            new_connection = TriangleConnection(
+                [
+                    (environments1[ids1[row]], environments2[ids2[row]]),
+                    (environments1[ids1[col]], environments2[ids2[col]]),
+                    (environment1, environment2)
+                ], self.minimum_trianlge_area
+            )
+            if new_connection.valid:
+                self.connections.append(new_connection)
+
+    def compare_environments_python(self, environment1, environment2):
         #print "*** COMPARING: %3i with %3i" % (environment1.id, environment2.id)
         # first do a distance compare test
         matching_pairs = []
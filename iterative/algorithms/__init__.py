@@ -34,6 +34,7 @@
 
 from base import *
 from minimize import *
+from multistart import *
 
 
 
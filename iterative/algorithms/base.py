@@ -32,6 +32,9 @@
 #--
 
 
+import time
+
+
 __all__ = ["Status", "Algorithm"]
 
 
@@ -43,6 +46,18 @@ class Algorithm(object):
     def __init__(self, root_expression, stop_criterion):
         self.root_expression = root_expression
         self.stop_criterion = stop_criterion
+        self.report_interval = None
+        self.report_steps = None
+
+    def set_report_policy(self, interval=None, steps=None):
+        """Limit the number of intermediate reports
+
+        An intermediate status is only reported when at least interval
+        seconds and at least steps iterations passed since the previous
+        report. None means no limit. The final status is always reported.
+        """
+        self.report_interval = interval
+        self.report_steps = steps
 
     def run(self, report):
         self.status = Status()
@@ -50,8 +65,18 @@ class Algorithm(object):
         self.status.state = self.root_expression.state
 
         self.initialize()
+        last_time = time.time()
+        last_step = 0
         while not self.iterate():
             self.status.step += 1
+            if self.report_steps is not None and self.status.step - last_step < self.report_steps:
+                continue
+            if self.report_interval is not None:
+                current_time = time.time()
+                if current_time - last_time < self.report_interval:
+                    continue
+                last_time = current_time
+            last_step = self.status.step
             report(self.status)
         self.status.step += 1
         report(self.status)
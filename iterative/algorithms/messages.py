@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Compact encoding of the Status objects sent by the iterative helper
+
+The codec is registered with zeobuilder.wire.register_codecs in the helper
+and in the process that reads its output. The attributes that are sent with
+every report have a fixed place in the payload and the state vector is sent
+as a raw little-endian float64 buffer. All other attributes, and those with
+an unexpected type (e.g. a value that is still None), are pickled at the end
+of the payload, such that every attribute of the status is restored.
+"""
+
+
+from iterative.algorithms.base import Status
+
+import struct, cPickle, numpy
+
+
+__all__ = ["message_codecs"]
+
+
+STATUS = 4
+
+
+# flags, step, progress, value, num_shakes, size of the state vector
+status_struct = struct.Struct("<Bqddqq")
+
+status_fields = [
+    # (flag, attribute name, type)
+    (1, "step", int),
+    (2, "progress", float),
+    (4, "value", float),
+    (8, "num_shakes", int),
+]
+state_flag = 16
+
+
+def encode_status(status):
+    others = status.__dict__.copy()
+    flags = 0
+    values = []
+    for flag, name, kind in status_fields:
+        value = others.get(name)
+        if isinstance(value, kind) and not isinstance(value, bool):
+            flags |= flag
+            values.append(others.pop(name))
+        else:
+            values.append(0)
+    state = others.get("state")
+    if isinstance(state, numpy.ndarray) and state.ndim == 1 and state.dtype == float:
+        flags |= state_flag
+        del others["state"]
+        state = state.astype("<f8").tostring()
+    else:
+        state = ""
+    if len(others) > 0:
+        others = cPickle.dumps(others, -1)
+    else:
+        others = ""
+    return status_struct.pack(flags, *(values + [len(state)//8])) + state + others
+
+def decode_status(payload):
+    status = Status()
+    values = status_struct.unpack_from(payload)
+    flags = values[0]
+    for (flag, name, kind), value in zip(status_fields, values[1:]):
+        if flags & flag:
+            setattr(status, name, kind(value))
+    offset = status_struct.size
+    if flags & state_flag:
+        size = values[-1]
+        status.state = numpy.frombuffer(payload, "<f8", size, offset).copy()
+        offset += 8*size
+    if offset < len(payload):
+        status.__dict__.update(cPickle.loads(payload[offset:]))
+    return status
+
+
+message_codecs = [
+    (Status, STATUS, encode_status, decode_status),
+]
@@ -34,12 +34,14 @@
 
 from base import Algorithm
 from iterative.stop_criteria import SmallStep
+from iterative.expressions.base import ShakeError
 
 import math, numpy, sys
 
 
 __all__ = [
-    "Minimize", "SteepestDescent", "ConjugateGradient", "DefaultMinimize"
+    "Minimize", "SteepestDescent", "ConjugateGradient", "LBFGS",
+    "TruncatedNewton", "DefaultMinimize"
 ]
 
 
@@ -72,7 +74,7 @@ class Minimize(Algorithm):
         self.status.num_shakes = 0
 
         self.root_expression.clear_outputs()
-        self.root_expression.add_outputs()
+        self.root_expression.add_outputs_incremental()
         self.original_state = self.root_expression.state.copy()
         self.original_value = self.root_expression.outputs[0]
 
@@ -81,7 +83,7 @@ class Minimize(Algorithm):
             self.root_expression.state[:] = self.original_state + step
             self.status.num_shakes += self.root_expression.shake()
             self.root_expression.clear_outputs()
-            self.root_expression.add_outputs()
+            self.root_expression.add_outputs_incremental()
             if self.original_value > self.root_expression.outputs[0]:
                 stop = False
                 break
@@ -117,18 +119,23 @@ class ConjugateGradient(Minimize):
 
         self.delta_gradient = numpy.zeros(self.gradient.shape, float)
         self.backup = numpy.zeros(self.root_expression.state.shape, float)
+        self.analytic_curvature = self.root_expression.supports_hessian_vector()
 
     def iterate(self):
-        # obtain the 'second order derivative in the search direction' numerically,
-        # ~= numpy.dot(direction, numpy.dot(hessian, direction))
-        epsilon = 1e-12
-        self.backup[:] = self.root_expression.state
-        self.root_expression.state[:] += self.direction/numpy.linalg.norm(self.direction)*epsilon
-        self.root_expression.clear_derivatives()
-        self.root_expression.add_derivatives()
-        self.delta_gradient[:] = self.root_expression.derivatives
-        curvature = numpy.dot(self.direction, (self.delta_gradient-self.gradient))/epsilon
-        self.root_expression.state[:] = self.backup
+        # obtain the 'second order derivative in the search direction',
+        # ~= numpy.dot(direction, numpy.dot(hessian, direction))/norm(direction)
+        if self.analytic_curvature:
+            curvature = numpy.dot(self.direction, self.root_expression.compute_hessian_vector(self.direction))/numpy.linalg.norm(self.direction)
+        else:
+            # numerically
+            epsilon = 1e-12
+            self.backup[:] = self.root_expression.state
+            self.root_expression.state[:] += self.direction/numpy.linalg.norm(self.direction)*epsilon
+            self.root_expression.clear_derivatives()
+            self.root_expression.add_derivatives()
+            self.delta_gradient[:] = self.root_expression.derivatives
+            curvature = numpy.dot(self.direction, (self.delta_gradient-self.gradient))/epsilon
+            self.root_expression.state[:] = self.backup
 
         if curvature <= 0:
             step = -self.gradient/numpy.linalg.norm(self.gradient)
@@ -163,6 +170,272 @@ class ConjugateGradient(Minimize):
         return False
 
 
+class LBFGS(Minimize):
+    """Limited memory BFGS with a line search for the strong Wolfe conditions
+
+    The last memory pairs of steps and gradient differences are used to
+    construct the search direction. Each trial point in the line search
+    computes the energy and the gradient together, and the gradient of the
+    accepted point is reused in the next iteration.
+    """
+
+    def __init__(self, root_expression, max_step, step_threshold, memory=10, c1=1e-4, c2=0.9, max_evaluations=20):
+        Minimize.__init__(self, root_expression, max_step, step_threshold)
+        self.memory = memory
+        self.c1 = c1
+        self.c2 = c2
+        self.max_evaluations = max_evaluations
+
+    def initialize(self):
+        Minimize.initialize(self)
+        self.status.num_shakes = 0
+        self.value = self.evaluate()
+        self.gradient = self.root_expression.derivatives.copy()
+        self.steps = []
+        self.delta_gradients = []
+        self.status.value = self.value
+        self.status.progress = 0.0
+
+    def evaluate(self):
+        root_expression = self.root_expression
+        root_expression.clear()
+        root_expression.add_outputs()
+        root_expression.add_derivatives()
+        return root_expression.outputs[0]
+
+    def get_direction(self):
+        # the two-loop recursion
+        direction = -self.gradient
+        alphas = []
+        for step, delta_gradient in reversed(zip(self.steps, self.delta_gradients)):
+            alpha = numpy.dot(step, direction)/numpy.dot(delta_gradient, step)
+            direction = direction - alpha*delta_gradient
+            alphas.append(alpha)
+        if len(self.steps) > 0:
+            step, delta_gradient = self.steps[-1], self.delta_gradients[-1]
+            direction *= numpy.dot(step, delta_gradient)/numpy.dot(delta_gradient, delta_gradient)
+        for (step, delta_gradient), alpha in zip(zip(self.steps, self.delta_gradients), reversed(alphas)):
+            beta = numpy.dot(delta_gradient, direction)/numpy.dot(delta_gradient, step)
+            direction = direction + (alpha - beta)*step
+        return direction
+
+    def trial(self, alpha, direction):
+        # returns the energy and the directional derivative at the trial point
+        # or None when the constraints can not be satisfied.
+        root_expression = self.root_expression
+        root_expression.state[:] = self.original_state + alpha*direction
+        try:
+            self.status.num_shakes += root_expression.shake()
+        except ShakeError:
+            return None
+        value = self.evaluate()
+        return value, numpy.dot(root_expression.derivatives, direction)
+
+    def interpolate(self, alpha_lo, value_lo, slope_lo, alpha_hi, value_hi, slope_hi):
+        # minimizer of the cubic interpolant, safeguarded by bisection
+        d1 = slope_lo + slope_hi - 3*(value_lo - value_hi)/(alpha_lo - alpha_hi)
+        discriminant = d1*d1 - slope_lo*slope_hi
+        if discriminant >= 0:
+            d2 = math.sqrt(discriminant)
+            if alpha_hi < alpha_lo:
+                d2 = -d2
+            denominator = slope_hi - slope_lo + 2*d2
+            if denominator != 0:
+                alpha = alpha_hi - (alpha_hi - alpha_lo)*(slope_hi + d2 - d1)/denominator
+                low, high = min(alpha_lo, alpha_hi), max(alpha_lo, alpha_hi)
+                margin = 0.1*(high - low)
+                if low + margin <= alpha <= high - margin:
+                    return alpha
+        return 0.5*(alpha_lo + alpha_hi)
+
+    def wolfe_line_search(self, direction, slope0):
+        """Search a step length along direction that obeys the strong Wolfe conditions
+
+        Returns the accepted step length or None. The state, outputs and
+        derivatives of the root expression are those of the accepted point.
+        """
+        value0 = self.value
+        # the initial step obeys the max_step limits
+        alpha_max = 1.0/numpy.linalg.norm(direction/self.max_step)
+        alpha = min(1.0, alpha_max)
+        alpha_prev, value_prev, slope_prev = 0.0, value0, slope0
+        best = None
+        evaluations = 0
+        zoom = None
+        while evaluations < self.max_evaluations:
+            result = self.trial(alpha, direction)
+            evaluations += 1
+            if result is None:
+                # the step was too large for the constraints
+                alpha = 0.5*(alpha_prev + alpha)
+                continue
+            value, slope = result
+            if value < value0 and (best is None or value < best[1]):
+                best = (alpha, value)
+            if value > value0 + self.c1*alpha*slope0 or (alpha_prev > 0 and value >= value_prev):
+                zoom = (alpha_prev, value_prev, slope_prev, alpha, value, slope)
+                break
+            if abs(slope) <= -self.c2*slope0:
+                return alpha
+            if slope >= 0:
+                zoom = (alpha, value, slope, alpha_prev, value_prev, slope_prev)
+                break
+            if alpha >= alpha_max:
+                # do not go beyond the max_step limits
+                return alpha
+            alpha_prev, value_prev, slope_prev = alpha, value, slope
+            alpha = min(2*alpha, alpha_max)
+
+        if zoom is not None:
+            alpha_lo, value_lo, slope_lo, alpha_hi, value_hi, slope_hi = zoom
+            while evaluations < self.max_evaluations:
+                # give up when the bracket is below the step threshold
+                if self.stop_criterion.threshold > abs(alpha_hi - alpha_lo)*numpy.linalg.norm(direction):
+                    break
+                alpha = self.interpolate(alpha_lo, value_lo, slope_lo, alpha_hi, value_hi, slope_hi)
+                result = self.trial(alpha, direction)
+                evaluations += 1
+                if result is None:
+                    alpha_hi, value_hi, slope_hi = alpha, numpy.inf, 0.0
+                    continue
+                value, slope = result
+                if value < value0 and (best is None or value < best[1]):
+                    best = (alpha, value)
+                if value > value0 + self.c1*alpha*slope0 or value >= value_lo:
+                    alpha_hi, value_hi, slope_hi = alpha, value, slope
+                else:
+                    if abs(slope) <= -self.c2*slope0:
+                        return alpha
+                    if slope*(alpha_hi - alpha_lo) >= 0:
+                        alpha_hi, value_hi, slope_hi = alpha_lo, value_lo, slope_lo
+                    alpha_lo, value_lo, slope_lo = alpha, value, slope
+
+        # no point obeys the Wolfe conditions, fall back to the lowest energy
+        if best is not None:
+            self.trial(best[0], direction)
+            return best[0]
+        return None
+
+    def iterate(self):
+        root_expression = self.root_expression
+        self.status.num_shakes = 0
+        direction = self.get_direction()
+        slope0 = numpy.dot(self.gradient, direction)
+        if slope0 >= 0:
+            # not a descent direction, start over with steepest descent
+            self.steps = []
+            self.delta_gradients = []
+            direction = -self.gradient
+            slope0 = numpy.dot(self.gradient, direction)
+            if slope0 == 0:
+                return True
+
+        self.original_state = root_expression.state.copy()
+        alpha = self.wolfe_line_search(direction, slope0)
+        if alpha is None:
+            root_expression.state[:] = self.original_state
+            self.value = self.evaluate()
+            self.status.value = self.value
+            if len(self.steps) == 0:
+                return True
+            # retry with steepest descent in the next iteration
+            self.steps = []
+            self.delta_gradients = []
+            return False
+
+        step = root_expression.state - self.original_state
+        new_gradient = root_expression.derivatives.copy()
+        delta_gradient = new_gradient - self.gradient
+        # skip updates that would spoil the positive definiteness
+        if numpy.dot(step, delta_gradient) > 1e-10*numpy.linalg.norm(step)*numpy.linalg.norm(delta_gradient):
+            self.steps.append(step)
+            self.delta_gradients.append(delta_gradient)
+            if len(self.steps) > self.memory:
+                del self.steps[0]
+                del self.delta_gradients[0]
+        self.gradient = new_gradient
+        self.value = root_expression.outputs[0]
+
+        stop = self.stop_criterion(step)
+        self.status.progress = self.stop_criterion.get_fraction()
+        self.status.value = self.value
+        return stop
+
+
+class TruncatedNewton(Minimize):
+    """Newton steps, computed approximately with the conjugate gradient method
+
+    The Newton equations are solved with inner conjugate gradient iterations
+    that only need products of the Hessian with vectors. The inner loop is
+    stopped early when the residual is small compared to the gradient, or
+    when a direction with negative curvature is found. The products are
+    analytic when all termini and constraints support them, and otherwise
+    they are computed with finite differences of the derivatives.
+    """
+
+    def __init__(self, root_expression, max_step, step_threshold, max_inner=50):
+        Minimize.__init__(self, root_expression, max_step, step_threshold)
+        self.max_inner = max_inner
+
+    def initialize(self):
+        Minimize.initialize(self)
+        self.analytic_hessian = self.root_expression.supports_hessian_vector()
+        self.update_gradient()
+
+    def update_gradient(self):
+        self.root_expression.clear_derivatives()
+        self.root_expression.add_derivatives()
+        self.gradient = self.root_expression.derivatives.copy()
+
+    def hessian_vector(self, vector):
+        if self.analytic_hessian:
+            return self.root_expression.compute_hessian_vector(vector)
+        norm = numpy.linalg.norm(vector)
+        epsilon = 1e-7/norm
+        backup = self.root_expression.state.copy()
+        self.root_expression.state[:] += epsilon*vector
+        self.root_expression.clear_derivatives()
+        self.root_expression.add_derivatives()
+        result = (self.root_expression.derivatives - self.gradient)/epsilon
+        self.root_expression.state[:] = backup
+        return result
+
+    def solve_newton(self):
+        # conjugate gradient iterations for hessian*step = -gradient
+        gradient_norm = numpy.linalg.norm(self.gradient)
+        tolerance = min(0.5, numpy.sqrt(gradient_norm))*gradient_norm
+        step = numpy.zeros(self.gradient.shape, float)
+        residual = -self.gradient
+        direction = residual.copy()
+        rr = numpy.dot(residual, residual)
+        for iteration in xrange(self.max_inner):
+            product = self.hessian_vector(direction)
+            curvature = numpy.dot(direction, product)
+            if curvature <= 0:
+                if iteration == 0:
+                    return -self.gradient
+                break
+            alpha = rr/curvature
+            step += alpha*direction
+            residual -= alpha*product
+            rr_new = numpy.dot(residual, residual)
+            if numpy.sqrt(rr_new) < tolerance:
+                break
+            direction *= rr_new/rr
+            direction += residual
+            rr = rr_new
+        return step
+
+    def iterate(self):
+        step = self.solve_newton()
+        if numpy.dot(step, self.gradient) >= 0:
+            step = -self.gradient
+        stop = self.line_search(step)
+        if stop: return True
+        self.update_gradient()
+        return False
+
+
 DefaultMinimize = ConjugateGradient
 
 
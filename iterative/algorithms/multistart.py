@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from base import Algorithm, Status
+
+import numpy, cPickle, multiprocessing
+
+
+__all__ = ["MultiStart", "random_quaternion", "perturb_variable"]
+
+
+def random_quaternion():
+    # a random unit quaternion with a positive real part, it corresponds to a
+    # uniformly distributed random rotation
+    quaternion = numpy.random.normal(0, 1, 4)
+    quaternion /= numpy.linalg.norm(quaternion)
+    if quaternion[0] < 0:
+        quaternion *= -1
+    return quaternion
+
+
+def perturb_variable(variable, translation_scale):
+    """Randomly rotate and translate a rigid body variable before parse_input
+
+    Variables without a free rotation are only translated.
+    """
+    # imported here to avoid a circular import
+    from iterative.variables.rigid_body import Frame, ExponentialFrame
+    if isinstance(variable, Frame):
+        a, b, c, d = random_quaternion()
+        rotation_matrix = numpy.array([
+            [a*a + b*b - c*c - d*d, 2*(b*c - a*d), 2*(b*d + a*c)],
+            [2*(b*c + a*d), a*a - b*b + c*c - d*d, 2*(c*d - a*b)],
+            [2*(b*d - a*c), 2*(c*d + a*b), a*a - b*b - c*c + d*d],
+        ], float)
+        variable.rotation_matrix = numpy.dot(rotation_matrix, variable.rotation_matrix)
+    elif isinstance(variable, ExponentialFrame):
+        # the rotation vector is perturbed, not the reference matrix, so that
+        # the states of all starts have the same meaning.
+        quaternion = random_quaternion()
+        norm = numpy.linalg.norm(quaternion[1:])
+        if norm > 0:
+            variable.rotation_vector = quaternion[1:]/norm*2*numpy.arccos(min(quaternion[0], 1.0))
+    variable.translation_vector = variable.translation_vector + numpy.random.normal(0, translation_scale, 3)
+
+
+def _run_start(args):
+    # runs one start in a worker process and returns the final value and the
+    # states of the variables in the order in which they were registered.
+    template, seed, translation_scale = args
+    algorithm = cPickle.loads(template)
+    root_expression = algorithm.root_expression
+    if seed is not None:
+        numpy.random.seed(seed)
+        for variable in root_expression.state_variables:
+            perturb_variable(variable, translation_scale)
+    root_expression.parse_input()
+    algorithm.run(lambda status: None)
+    root_expression.clear_outputs()
+    root_expression.add_outputs()
+    return root_expression.outputs[0], [variable.state.copy() for variable in root_expression.state_variables]
+
+
+class MultiStart(Algorithm):
+    """Run an algorithm from several perturbed initial states in parallel
+
+    The first start is the unperturbed initial state. All other starts get
+    random rotations and random translations of the rigid bodies. The
+    reported state is the best state found so far, and the status is
+    reported each time a start finishes.
+
+    The algorithm must be given before parse_input is called on its root
+    expression. The root expression of a MultiStart instance is parsed
+    as usual, and only serves as a reference for the layout of the state.
+    """
+
+    def __init__(self, algorithm, num_starts, translation_scale, num_processes=None):
+        Algorithm.__init__(self, algorithm.root_expression, None)
+        self.template = cPickle.dumps(algorithm, -1)
+        self.num_starts = num_starts
+        self.translation_scale = translation_scale
+        self.num_processes = num_processes
+
+    def run(self, report):
+        self.status = Status()
+        self.status.step = 0
+        self.status.state = self.root_expression.state
+        self.status.progress = 0.0
+        self.status.value = None
+        self.status.num_shakes = 0
+
+        seeds = [None] + list(numpy.random.randint(0, 2**30, self.num_starts - 1))
+        jobs = [(self.template, seed, self.translation_scale) for seed in seeds]
+        pool = multiprocessing.Pool(self.num_processes)
+        try:
+            for value, states in pool.imap_unordered(_run_start, jobs):
+                self.status.step += 1
+                self.status.progress = float(self.status.step)/self.num_starts
+                if self.status.value is None or value < self.status.value:
+                    self.status.value = value
+                    for variable, state in zip(self.root_expression.state_variables, states):
+                        variable.state[:] = state
+                report(self.status)
+        finally:
+            pool.terminate()
+            pool.join()
@@ -41,7 +41,8 @@ import copy
 
 __all__ = [
     "Base", "RootMixin", "SanityError", "TerminusMixin", "CircularDependence",
-    "ShakeError", "Root", "Helper", "Terminus", "Constraint",
+    "ShakeError", "Root", "Helper", "Terminus", "Constraint", "ConstraintBatch",
+    "SparseJacobian",
 ]
 
 
@@ -127,7 +128,7 @@ class TerminusMixin(object):
 
 
 class Root(Base, RootMixin):
-    def __init__(self, output_dimension, max_num_shakes=5, constrain_derivatives=True):
+    def __init__(self, output_dimension, max_num_shakes=5, constrain_derivatives=True, sparse_threshold=200):
         # set the output_dimension
         self.output_dimension = output_dimension
         # call the ancestors
@@ -136,6 +137,11 @@ class Root(Base, RootMixin):
         # set the parameters
         self.max_num_shakes = max_num_shakes
         self.constrain_derivatives = constrain_derivatives
+        # clusters with at least this number of constraint outputs use a
+        # SparseJacobian instead of a dense matrix.
+        self.sparse_threshold = sparse_threshold
+        # the state at the last call to add_outputs_incremental
+        self.cached_state = None
         # lists that will contain the dependent sub expressions
         self.sub_expressions = []
         self.helpers = []
@@ -247,6 +253,31 @@ class Root(Base, RootMixin):
             cluster.inputs = self.state[cluster.state_index: cluster.state_index + cluster.input_dimension]
             cluster.state_derivatives = self.derivatives[cluster.state_index: cluster.state_index + cluster.input_dimension]
             cluster.outputs = numpy.zeros(cluster.output_dimension, float)
+            # the Lagrange multipliers of the last projection of the derivatives
+            cluster.multipliers = numpy.zeros(cluster.output_dimension, float)
+            if cluster.output_dimension >= self.sparse_threshold:
+                blocks = []
+                output_index = 0
+                for constraint in cluster.rules:
+                    for variable in constraint.input_variables:
+                        blocks.append((
+                            output_index, variable.state_index - cluster.state_index,
+                            constraint.output_dimension, variable.dimension
+                        ))
+                    output_index += constraint.output_dimension
+                cluster.jacobian = SparseJacobian(cluster.output_dimension, cluster.input_dimension, blocks)
+                cluster.constraint_derivatives = None
+                block_iter = iter(cluster.jacobian.blocks)
+                output_index = 0
+                for constraint in cluster.rules:
+                    constraint.sanity_check()
+                    constraint.connect_outputs(output_index, cluster.outputs)
+                    constraint.connect_derivatives([
+                        block_iter.next() for variable in constraint.input_variables
+                    ])
+                    output_index += constraint.output_dimension
+                continue
+            cluster.jacobian = None
             cluster.constraint_derivatives = numpy.zeros((cluster.output_dimension, cluster.input_dimension), float)
             output_index = 0
             for constraint in cluster.rules:
@@ -264,6 +295,24 @@ class Root(Base, RootMixin):
             variable.state_index = state_index
             state_index += variable.dimension
 
+        # clusters with a single constraint on a single variable are handled
+        # in batches when the constraint supports it.
+        batches = {}
+        self.unbatched_clusters = []
+        for cluster in self.constraint_clusters:
+            if len(cluster.rules) == 1 and len(cluster.items) == 1 and cluster.rules[0].batched:
+                constraint = cluster.rules[0]
+                batch = batches.get(constraint.__class__)
+                if batch is None:
+                    batch = ConstraintBatch(constraint.__class__)
+                    batches[constraint.__class__] = batch
+                batch.add_constraint(constraint)
+            else:
+                self.unbatched_clusters.append(cluster)
+        self.constraint_batches = batches.values()
+        for batch in self.constraint_batches:
+            batch.connect(self.state, self.derivatives)
+
         for variable in self.state_variables:
             variable.connect(self.state, self.derivatives, self.mass)
 
@@ -285,28 +334,110 @@ class Root(Base, RootMixin):
         for terminus in self.termini:
             terminus.add_outputs()
 
+    def supports_hessian_vector(self):
+        if self.output_dimension != 1 or len(self.helpers) > 0:
+            return False
+        if self.constrain_derivatives:
+            for constraint in self.constraints:
+                if not constraint.supports_hessian_vector():
+                    return False
+        for terminus in self.termini:
+            if not terminus.supports_hessian_vector():
+                return False
+        return True
+
+    def compute_hessian_vector(self, vector):
+        """Return the product of the Hessian of the output with vector
+
+        When the derivatives are constrained, the Hessian of the Lagrangian
+        is projected on the tangent space of the constraints, P*(H - L)*P,
+        where L is the sum of the Hessians of the constraint functions,
+        weighted with the Lagrange multipliers of the last call to
+        add_derivatives. Check first with supports_hessian_vector if all
+        termini and constraints implement this product.
+        """
+        constrained = self.constrain_derivatives and len(self.constraint_clusters) > 0
+        if constrained:
+            vector = vector.copy()
+            self.project_constraints(vector)
+        result = numpy.zeros(self.state_dimension, float)
+        for terminus in self.termini:
+            terminus.add_hessian_vector(vector, result)
+        if constrained:
+            for batch in self.constraint_batches:
+                batch.add_hessian_vector(-batch.multipliers, vector, result)
+            for cluster in self.unbatched_clusters:
+                output_index = 0
+                for constraint in cluster.rules:
+                    constraint.add_hessian_vector(
+                        -cluster.multipliers[output_index: output_index + constraint.output_dimension],
+                        vector, result
+                    )
+                    output_index += constraint.output_dimension
+            self.project_constraints(result)
+        return result
+
+    def add_outputs_incremental(self):
+        """Add the outputs, reusing the contributions of unchanged termini
+
+        Only the termini that depend on state elements that changed since the
+        previous call are recomputed. Expressions with helpers are always
+        recomputed completely.
+        """
+        if len(self.helpers) > 0:
+            self.add_outputs()
+            return
+        if self.cached_state is None:
+            changed_state = None
+        else:
+            changed_state = self.state != self.cached_state
+        for terminus in self.termini:
+            terminus.add_outputs_incremental(changed_state)
+        self.cached_state = self.state.copy()
+
     def add_derivatives(self):
         for terminus in self.termini:
             terminus.add_derivatives()
         for helper in self.helpers[::-1]:
             helper.transform_derivatives()
         if self.constrain_derivatives:
-            for cluster in self.constraint_clusters:
-                for constraint in cluster.rules:
-                    constraint.clear()
-                    constraint.add_derivatives()
-                # project the derivative vector on the space spanned by the
-                # tangents (derivatives) of the constraint functions.
-                ortho_move = numpy.dot(cluster.constraint_derivatives, numpy.transpose(cluster.constraint_derivatives))
-                x,resids,rank,s = numpy.linalg.lstsq(cluster.constraint_derivatives.transpose(), cluster.state_derivatives)
-                cluster.state_derivatives[:] -= numpy.dot(cluster.constraint_derivatives.transpose(), x)
+            for batch in self.constraint_batches:
+                batch.multipliers = batch.project(self.derivatives)
+            for cluster in self.unbatched_clusters:
+                cluster.multipliers = self.project_cluster(cluster, self.derivatives)
+
+    def project_constraints(self, vector):
+        # remove the components along the tangents of the constraint
+        # functions from vector, in place.
+        for batch in self.constraint_batches:
+            batch.project(vector)
+        for cluster in self.unbatched_clusters:
+            self.project_cluster(cluster, vector)
+
+    def project_cluster(self, cluster, vector):
+        # project the part of vector that belongs to the cluster on the space
+        # orthogonal to the tangents (derivatives) of the constraint
+        # functions. The coefficients of the removed tangents are returned.
+        for constraint in cluster.rules:
+            constraint.clear()
+            constraint.add_derivatives()
+        part = vector[cluster.state_index: cluster.state_index + cluster.input_dimension]
+        if cluster.jacobian is not None:
+            x = cluster.jacobian.solve_normal(cluster.jacobian.dot(part))
+            part -= cluster.jacobian.dot_transpose(x)
+            return x
+        x,resids,rank,s = numpy.linalg.lstsq(cluster.constraint_derivatives.transpose(), part)
+        part -= numpy.dot(cluster.constraint_derivatives.transpose(), x)
+        return x
 
     def shake(self):
         # returns the mean number of shakes per constraint cluster
         if len(self.constraint_clusters) == 0: return 0
         total_num_shakes = 0
+        for batch in self.constraint_batches:
+            total_num_shakes += batch.shake(self.max_num_shakes)
         # nr stands for newton-raphson
-        for cluster in self.constraint_clusters:
+        for cluster in self.unbatched_clusters:
             num_shakes = 0
             while True:
                 converged = True
@@ -318,9 +449,13 @@ class Root(Base, RootMixin):
                 for constraint in cluster.rules:
                     constraint.add_derivatives()
 
-                ortho_move = numpy.dot(cluster.constraint_derivatives, numpy.transpose(cluster.constraint_derivatives))
-                delta_mu = -numpy.linalg.solve(ortho_move, cluster.outputs)
-                cluster.inputs += numpy.dot(numpy.transpose(cluster.constraint_derivatives), delta_mu)
+                if cluster.jacobian is not None:
+                    delta_mu = -cluster.jacobian.solve_normal(cluster.outputs)
+                    cluster.inputs += cluster.jacobian.dot_transpose(delta_mu)
+                else:
+                    ortho_move = numpy.dot(cluster.constraint_derivatives, numpy.transpose(cluster.constraint_derivatives))
+                    delta_mu = -numpy.linalg.solve(ortho_move, cluster.outputs)
+                    cluster.inputs += numpy.dot(numpy.transpose(cluster.constraint_derivatives), delta_mu)
                 num_shakes += 1
                 if num_shakes > self.max_num_shakes:
                     raise ShakeError("The number of NR corrections exceeded the given limit (%i). This probably means that the step size is too large." % (self.max_num_shakes))
@@ -328,6 +463,136 @@ class Root(Base, RootMixin):
         return total_num_shakes
 
 
+class ConstraintBatch(object):
+    """A set of constraints of the same type, each on its own variable
+
+    The constraint class must have a compute_batch method that returns the
+    outputs and the derivatives of all constraints at once. The projection
+    of the derivatives and the SHAKE iterations are then carried out for all
+    constraints together. Products with the Hessians of the constraints
+    require a compute_hessian_vector_batch method.
+    """
+
+    def __init__(self, constraint_class):
+        self.constraint_class = constraint_class
+        self.constraints = []
+
+    def add_constraint(self, constraint):
+        self.constraints.append(constraint)
+
+    def connect(self, state, derivatives):
+        self.state = state
+        self.derivatives = derivatives
+        self.state_indices = numpy.array([
+            constraint.input_variables[0].state_index + numpy.arange(constraint.input_variables[0].dimension)
+            for constraint in self.constraints
+        ], int)
+        self.convergence_thresholds2 = numpy.array([
+            constraint.convergence_threshold2 for constraint in self.constraints
+        ], float)
+        # the Lagrange multipliers of the last projection of the derivatives
+        self.multipliers = numpy.zeros((len(self.constraints), self.constraint_class.output_dimension), float)
+
+    def project(self, vector):
+        # remove the components along the tangents of the constraint
+        # functions from vector, in place. The coefficients of the removed
+        # tangents are returned.
+        outputs, constraint_derivatives = self.constraint_class.compute_batch(self.state[self.state_indices])
+        ortho_move = numpy.einsum("nij,nkj->nik", constraint_derivatives, constraint_derivatives)
+        x = numpy.linalg.solve(ortho_move, numpy.einsum("nij,nj->ni", constraint_derivatives, vector[self.state_indices])[:,:,numpy.newaxis])
+        vector[self.state_indices] -= numpy.einsum("nij,ni->nj", constraint_derivatives, x[:,:,0])
+        return x[:,:,0]
+
+    def add_hessian_vector(self, weights, vector, result):
+        # add the products of the Hessians of the constraint functions,
+        # weighted with the rows of weights, with vector to result
+        result[self.state_indices] += self.constraint_class.compute_hessian_vector_batch(weights, vector[self.state_indices])
+
+    def shake(self, max_num_shakes):
+        # returns the total number of shakes, just like Root.shake
+        total_num_shakes = 0
+        active = numpy.arange(len(self.constraints))
+        num_shakes = 0
+        while True:
+            state_indices = self.state_indices[active]
+            outputs, constraint_derivatives = self.constraint_class.compute_batch(self.state[state_indices])
+            converged = (outputs*outputs).mean(axis=1) < self.convergence_thresholds2[active]
+            active = active[~converged]
+            if len(active) == 0: break
+            total_num_shakes += len(active)
+            state_indices = state_indices[~converged]
+            outputs = outputs[~converged]
+            constraint_derivatives = constraint_derivatives[~converged]
+            ortho_move = numpy.einsum("nij,nkj->nik", constraint_derivatives, constraint_derivatives)
+            delta_mu = -numpy.linalg.solve(ortho_move, outputs[:,:,numpy.newaxis])
+            self.state[state_indices] += numpy.einsum("nij,ni->nj", constraint_derivatives, delta_mu[:,:,0])
+            num_shakes += 1
+            if num_shakes > max_num_shakes:
+                raise ShakeError("The number of NR corrections exceeded the given limit (%i). This probably means that the step size is too large." % (max_num_shakes))
+        return total_num_shakes
+
+
+class SparseJacobian(object):
+    """The derivatives of a large constraint cluster, stored block by block
+
+    Each block contains the derivatives of one constraint towards one of its
+    variables. The blocks are dense views on one array with all the nonzero
+    elements, so constraints can fill them in just like the slices of a
+    dense matrix. Systems with the matrix J J^T are solved with the
+    conjugate gradient method instead of a dense factorization.
+    """
+
+    def __init__(self, output_dimension, input_dimension, blocks):
+        # blocks is a list of (output_index, input_index, num_rows, num_cols)
+        self.output_dimension = output_dimension
+        self.input_dimension = input_dimension
+        size = sum(num_rows*num_cols for output_index, input_index, num_rows, num_cols in blocks)
+        self.values = numpy.zeros(size, float)
+        self.rows = numpy.zeros(size, int)
+        self.cols = numpy.zeros(size, int)
+        self.blocks = []
+        offset = 0
+        for output_index, input_index, num_rows, num_cols in blocks:
+            end = offset + num_rows*num_cols
+            self.blocks.append(self.values[offset:end].reshape((num_rows, num_cols)))
+            self.rows[offset:end] = numpy.repeat(numpy.arange(output_index, output_index + num_rows), num_cols)
+            self.cols[offset:end] = numpy.tile(numpy.arange(input_index, input_index + num_cols), num_rows)
+            offset = end
+
+    def dot(self, vector):
+        return numpy.bincount(self.rows, self.values*vector[self.cols], self.output_dimension)
+
+    def dot_transpose(self, vector):
+        return numpy.bincount(self.cols, self.values*vector[self.rows], self.input_dimension)
+
+    def solve_normal(self, rhs, relative_tolerance=1e-14):
+        """Solve J J^T x = rhs with the preconditioned conjugate gradient method"""
+        diagonal = numpy.bincount(self.rows, self.values**2, self.output_dimension)
+        diagonal[diagonal == 0] = 1
+        x = numpy.zeros(self.output_dimension, float)
+        residual = rhs.copy()
+        threshold = relative_tolerance*numpy.dot(rhs, rhs)
+        z = residual/diagonal
+        direction = z.copy()
+        rz = numpy.dot(residual, z)
+        for iteration in xrange(2*self.output_dimension):
+            if numpy.dot(residual, residual) <= threshold:
+                break
+            product = self.dot(self.dot_transpose(direction))
+            curvature = numpy.dot(direction, product)
+            if curvature <= 0:
+                break
+            alpha = rz/curvature
+            x += alpha*direction
+            residual -= alpha*product
+            z = residual/diagonal
+            rz_new = numpy.dot(residual, z)
+            direction *= rz_new/rz
+            direction += z
+            rz = rz_new
+        return x
+
+
 class Helper(RootMixin, TerminusMixin):
     def __init__(self):
         RootMixin.__init__(self)
@@ -357,12 +622,44 @@ class Terminus(Base, TerminusMixin):
     def __init__(self):
         Base.__init__(self)
         TerminusMixin.__init__(self)
+        self.cached_outputs = None
 
     def connect_outputs(self, outputs):
         self.outputs = outputs
 
+    def supports_hessian_vector(self):
+        return False
+
+    def add_hessian_vector(self, vector, result):
+        """Add the product of the Hessian of the outputs with vector to result
+
+        Both arrays have the size of the state of the root expression.
+        """
+        raise NotImplementedError
+
+    def depends_on(self, changed_state):
+        for variable in self.input_variables:
+            if changed_state[variable.state_index: variable.state_index + variable.dimension].any():
+                return True
+        return False
+
+    def add_outputs_incremental(self, changed_state):
+        # changed_state is a boolean array with the changed elements of the
+        # state, or None when everything must be recomputed.
+        if changed_state is None or self.cached_outputs is None or self.depends_on(changed_state):
+            outputs = self.outputs
+            self.outputs = numpy.zeros(self.output_dimension, float)
+            self.add_outputs()
+            self.cached_outputs = self.outputs
+            self.outputs = outputs
+        self.outputs += self.cached_outputs
+
 
 class Constraint(Base, TerminusMixin):
+    # When batched is True, the class must implement compute_batch, see
+    # ConstraintBatch.
+    batched = False
+
     def __init__(self, convergence_threshold):
         Base.__init__(self)
         TerminusMixin.__init__(self)
@@ -382,6 +679,17 @@ class Constraint(Base, TerminusMixin):
     def converged(self):
         return (numpy.dot(self.outputs, self.outputs) / self.output_dimension) < self.convergence_threshold2
 
+    def supports_hessian_vector(self):
+        return False
+
+    def add_hessian_vector(self, weights, vector, result):
+        """Add the product of the weighted sum of the Hessians of the outputs with vector to result
+
+        The weights have one element per output. Both vector and result
+        have the size of the state of the root expression.
+        """
+        raise NotImplementedError
+
 
 
 
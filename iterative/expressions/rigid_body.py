@@ -33,12 +33,13 @@
 
 
 from base import Terminus, Constraint, Helper
-from iterative.variables.rigid_body import Frame, Translation
+from iterative.variables.rigid_body import Frame, ExponentialFrame, Translation, \
+    rotation_vectors_to_matrices
 
 import numpy
 
 
-__all__ = ["Orthonormality", "NoFrame", "Spring"]
+__all__ = ["Orthonormality", "NoFrame", "Spring", "SpringSet"]
 
 
 class Error(Exception):
@@ -47,6 +48,9 @@ class Error(Exception):
 
 class Orthonormality(Constraint):
     output_dimension = 6
+    batched = True
+    # the pairs of columns of the rotation matrix that belong to each output
+    column_pairs = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
 
     def register_input_variable(self, variable):
         assert isinstance(variable, Frame), "An orthonormality constraint only supports a Frame variable."
@@ -56,36 +60,63 @@ class Orthonormality(Constraint):
         assert len(self.input_variables) == 1, "An orthonormality expression only supports one variable."
         Constraint.sanity_check(self)
 
+    @classmethod
+    def compute_batch(cls, frame_states):
+        """Compute the outputs and derivatives for a set of frames
+
+        The argument has shape (n, 12), with the states of n frames. The
+        outputs have shape (n, 6) and the derivatives have shape (n, 6, 12).
+        Both follow from the columns of the rotation matrices: the outputs
+        are elements of R^T R - 1.
+        """
+        size = len(frame_states)
+        rotation_matrices = frame_states[:,:9].reshape((size, 3, 3))
+        products = numpy.einsum("nij,nik->njk", rotation_matrices, rotation_matrices)
+        outputs = numpy.zeros((size, 6), float)
+        derivatives = numpy.zeros((size, 6, 12), float)
+        rotation_derivatives = derivatives[:,:,:9].reshape((size, 6, 3, 3))
+        for counter, (a, b) in enumerate(cls.column_pairs):
+            outputs[:,counter] = products[:,a,b] - (a == b)
+            rotation_derivatives[:,counter,:,a] += rotation_matrices[:,:,b]
+            rotation_derivatives[:,counter,:,b] += rotation_matrices[:,:,a]
+        derivatives[:,:,:9] = rotation_derivatives.reshape((size, 6, 9))
+        return outputs, derivatives
+
+    @classmethod
+    def compute_hessian_vector_batch(cls, weights, frame_vectors):
+        """Compute the products of the weighted Hessians with a set of vectors
+
+        The weights have shape (n, 6) and the vectors have shape (n, 12),
+        one row for each frame. The outputs are quadratic in the state, so
+        the Hessians are constant. The product with the weighted sum of the
+        Hessians is V*W, where V contains the rotation part of a vector as a
+        3x3 matrix and W is the symmetric matrix with the weights of the
+        column pairs, doubled on the diagonal.
+        """
+        size = len(frame_vectors)
+        weight_matrices = numpy.zeros((size, 3, 3), float)
+        for counter, (a, b) in enumerate(cls.column_pairs):
+            weight_matrices[:,a,b] += weights[:,counter]
+            weight_matrices[:,b,a] += weights[:,counter]
+        result = numpy.zeros((size, 12), float)
+        result[:,:9] = numpy.einsum("nij,njk->nik", frame_vectors[:,:9].reshape((size, 3, 3)), weight_matrices).reshape((size, 9))
+        return result
+
     def add_outputs(self):
-        rotation_matrix = self.input_variables[0].rotation_matrix
-        counter = 0
-        for a in range(3):
-            self.outputs[counter] += numpy.dot(rotation_matrix[:,a], rotation_matrix[:,a]) - 1
-            counter += 1
-            for b in range(a+1,3):
-                self.outputs[counter] += numpy.dot(rotation_matrix[:,a], rotation_matrix[:,b])
-                counter += 1
+        outputs, derivatives = self.compute_batch(self.input_variables[0].state[numpy.newaxis])
+        self.outputs += outputs[0]
 
     def add_derivatives(self):
-        rotation_matrix = self.input_variables[0].rotation_matrix
-        derivatives_row_iter = iter(self.derivatives[0])
-        for a in range(3):
-            for b in range(a,3):
-                current_derivatives_row = derivatives_row_iter.next()
-                value_counter = 0
-                for alpha in range(3):
-                    for beta in range(3):
-                        # here comes the calculation of the derivatives matrix elements:
-                        if a==b:
-                            if b==beta:
-                                current_derivatives_row[value_counter] += 2 * rotation_matrix[alpha, beta]
-                        else:
-                            if a==beta:
-                                current_derivatives_row[value_counter] += rotation_matrix[alpha, b]
-                            elif b==beta:
-                                current_derivatives_row[value_counter] += rotation_matrix[alpha, a]
-                        # that were the elements
-                        value_counter += 1
+        outputs, derivatives = self.compute_batch(self.input_variables[0].state[numpy.newaxis])
+        self.derivatives[0] += derivatives[0]
+
+    def supports_hessian_vector(self):
+        return True
+
+    def add_hessian_vector(self, weights, vector, result):
+        variable = self.input_variables[0]
+        part = slice(variable.state_index, variable.state_index + variable.dimension)
+        result[part] += self.compute_hessian_vector_batch(weights[numpy.newaxis], vector[part][numpy.newaxis])[0]
 
 
 class NoFrame(object):
@@ -105,8 +136,8 @@ class Spring(Terminus):
         self.rest_length = rest_length
 
     def register_input_variable(self, variable, coordinate):
-        if not (isinstance(variable, Frame) or isinstance(variable, Translation) or isinstance(variable, NoFrame)):
-            raise Error("Expression requires iterative.var.Frame or iterative.var.Translation as variable")
+        if not (isinstance(variable, Frame) or isinstance(variable, ExponentialFrame) or isinstance(variable, Translation) or isinstance(variable, NoFrame)):
+            raise Error("Expression requires iterative.var.Frame, iterative.var.ExponentialFrame or iterative.var.Translation as variable")
         self.coordinates.append(coordinate)
         self.frames.append(variable)
         if not isinstance(variable, NoFrame):
@@ -150,6 +181,9 @@ class Spring(Terminus):
                     for alpha in range(3):
                         fa.derivatives[current_index:current_index+3] += alpha_column[alpha] * ca
                         current_index += 3
+                elif isinstance(fa, ExponentialFrame):
+                    fa.derivatives[0:3] += numpy.dot(alpha_column, fa.get_vector_derivatives(ca))
+                    current_index += 3
                 fa.derivatives[current_index:current_index+3] += alpha_column
 
         frame1, frame2 = self.frames
@@ -157,8 +191,274 @@ class Spring(Terminus):
         helper(frame1, frame2, coordinate1, coordinate2)
         helper(frame2, frame1, coordinate2, coordinate1)
 
+    def supports_hessian_vector(self):
+        return True
 
+    def add_hessian_vector(self, vector, result):
+        def change(frame, coordinate):
+            # the change of the transformed coordinate along vector
+            if isinstance(frame, NoFrame):
+                return numpy.zeros(3, float)
+            part = vector[frame.state_index: frame.state_index + frame.dimension]
+            if isinstance(frame, Frame):
+                return numpy.dot(part[:9].reshape((3,3)), coordinate) + part[9:]
+            elif isinstance(frame, ExponentialFrame):
+                return numpy.dot(frame.get_vector_derivatives(coordinate), part[:3]) + part[3:]
+            else:
+                return part
 
+        def scatter(frame, coordinate, gradient, first_gradient):
+            # first_gradient is the derivative of the energy towards the
+            # transformed coordinate, needed for the curvature of the
+            # exponential map.
+            if isinstance(frame, NoFrame):
+                return
+            part = result[frame.state_index: frame.state_index + frame.dimension]
+            if isinstance(frame, Frame):
+                part[:9] += numpy.outer(gradient, coordinate).ravel()
+                part[9:] += gradient
+            elif isinstance(frame, ExponentialFrame):
+                second_derivatives = frame.get_vector_second_derivatives(coordinate)
+                part[:3] += numpy.dot(gradient, frame.get_vector_derivatives(coordinate))
+                part[:3] += numpy.dot(numpy.dot(second_derivatives, first_gradient), vector[frame.state_index: frame.state_index + 3])
+                part[3:] += gradient
+            else:
+                part += gradient
 
+        frame1, frame2 = self.frames
+        coordinate1, coordinate2 = self.coordinates
+        delta = frame1.apply_vector(coordinate1) - frame2.apply_vector(coordinate2)
+        delta_change = change(frame1, coordinate1) - change(frame2, coordinate2)
+        norm = numpy.linalg.norm(delta)
+        if norm > 0:
+            ratio = self.rest_length/norm
+            unit = delta/norm
+            gradient = 2*(1 - ratio)*delta_change + 2*ratio*numpy.dot(unit, delta_change)*unit
+            first_gradient = 2*(1 - ratio)*delta
+        else:
+            gradient = 2*delta_change
+            first_gradient = 2*delta
+        scatter(frame1, coordinate1, gradient, first_gradient)
+        scatter(frame2, coordinate2, -gradient, -first_gradient)
+
+
+class SpringSet(Terminus):
+    """A collection of springs that is evaluated with array operations
+
+    The energy is the same as the sum of the energies of the corresponding
+    Spring terms, but all springs are processed at once. All frames must
+    be state variables of the same root expression.
+    """
+    output_dimension = 1
 
+    def __init__(self):
+        Terminus.__init__(self)
+        self.springs = []
 
+    def add_spring(self, variable1, coordinate1, variable2, coordinate2, rest_length=0.0):
+        if rest_length < 0.0:
+            raise Error("The rest length of a spring must be zero or positive.")
+        for variable, coordinate in (variable1, coordinate1), (variable2, coordinate2):
+            if not (isinstance(variable, Frame) or isinstance(variable, ExponentialFrame) or isinstance(variable, Translation) or isinstance(variable, NoFrame)):
+                raise Error("Expression requires iterative.var.Frame, iterative.var.ExponentialFrame or iterative.var.Translation as variable")
+            if not isinstance(variable, NoFrame):
+                variable.add_mass(coordinate)
+                if variable not in self.input_variables:
+                    Terminus.register_input_variable(self, variable)
+        self.springs.append((variable1, numpy.array(coordinate1, float), variable2, numpy.array(coordinate2, float), rest_length))
+
+    def sanity_check(self):
+        if len(self.springs) == 0:
+            raise Error("A SpringSet needs at least one spring.")
+        if len(self.parent_expressions) != 1:
+            raise Error("All variables of a SpringSet must belong to the same expression.")
+        Terminus.sanity_check(self)
+
+    def connect_outputs(self, outputs):
+        Terminus.connect_outputs(self, outputs)
+        # The state indices are known at this point. The springs are
+        # translated into index arrays. The first half of the end points are
+        # the first ends of the springs, the second half are the other ends.
+        parent_expression = iter(self.parent_expressions).next()
+        self.state = parent_expression.state
+        self.state_derivatives = parent_expression.derivatives
+        num_springs = len(self.springs)
+        self.rest_lengths = numpy.array([spring[4] for spring in self.springs], float)
+        self.constants = numpy.zeros((2*num_springs, 3), float)
+        rotation_ends = []
+        rotation_indices = []
+        rotation_coordinates = []
+        exponential_ends = []
+        exponential_indices = []
+        exponential_coordinates = []
+        # the exponential map is computed once for each frame
+        exponential_rows = []
+        exponential_frames = {}
+        translation_ends = []
+        translation_indices = []
+        ends = [spring[0:2] for spring in self.springs] + [spring[2:4] for spring in self.springs]
+        for end, (variable, coordinate) in enumerate(ends):
+            if isinstance(variable, Frame):
+                rotation_ends.append(end)
+                rotation_indices.append(variable.state_index + numpy.arange(9))
+                rotation_coordinates.append(coordinate)
+                translation_ends.append(end)
+                translation_indices.append(variable.state_index + 9 + numpy.arange(3))
+            elif isinstance(variable, ExponentialFrame):
+                exponential_ends.append(end)
+                exponential_indices.append(variable.state_index + numpy.arange(3))
+                exponential_rows.append(exponential_frames.setdefault(variable, len(exponential_frames)))
+                exponential_coordinates.append(numpy.dot(variable.reference_matrix, coordinate))
+                translation_ends.append(end)
+                translation_indices.append(variable.state_index + 3 + numpy.arange(3))
+            elif isinstance(variable, Translation):
+                self.constants[end] = numpy.dot(variable.rotation_matrix, coordinate)
+                translation_ends.append(end)
+                translation_indices.append(variable.state_index + numpy.arange(3))
+            else:
+                self.constants[end] = coordinate
+        self.rotation_ends = numpy.array(rotation_ends, int)
+        self.rotation_indices = numpy.array(rotation_indices, int).reshape((-1, 3, 3))
+        self.rotation_coordinates = numpy.array(rotation_coordinates, float).reshape((-1, 3))
+        self.exponential_ends = numpy.array(exponential_ends, int)
+        self.exponential_indices = numpy.array(exponential_indices, int).reshape((-1, 3))
+        self.exponential_coordinates = numpy.array(exponential_coordinates, float).reshape((-1, 3))
+        self.exponential_rows = numpy.array(exponential_rows, int)
+        self.exponential_frame_indices = numpy.zeros((len(exponential_frames), 3), int)
+        for variable, row in exponential_frames.iteritems():
+            self.exponential_frame_indices[row] = variable.state_index + numpy.arange(3)
+        self.translation_ends = numpy.array(translation_ends, int)
+        self.translation_indices = numpy.array(translation_indices, int).reshape((-1, 3))
+
+    def compute_deltas(self, derivatives=False, springs=None):
+        # When derivatives is True, also the derivatives of the end points
+        # of exponential frames towards their rotation vectors are returned.
+        # When springs is given, an array with spring indices, only the deltas
+        # of these springs are computed.
+        num_springs = len(self.springs)
+        if springs is None:
+            def select(ends):
+                return slice(None)
+        else:
+            active_ends = numpy.zeros(2*num_springs, bool)
+            active_ends[springs] = True
+            active_ends[springs + num_springs] = True
+            def select(ends):
+                return active_ends[ends]
+        positions = self.constants.copy()
+        exponential_derivatives = None
+        if len(self.rotation_ends) > 0:
+            selection = select(self.rotation_ends)
+            rotation_matrices = self.state[self.rotation_indices[selection]]
+            positions[self.rotation_ends[selection]] += (rotation_matrices*self.rotation_coordinates[selection,numpy.newaxis,:]).sum(axis=2)
+        if len(self.exponential_ends) > 0:
+            selection = select(self.exponential_ends)
+            rotation_vectors = self.state[self.exponential_frame_indices]
+            rows = self.exponential_rows[selection]
+            coordinates = self.exponential_coordinates[selection]
+            if derivatives:
+                rotation_matrices, matrix_derivatives = rotation_vectors_to_matrices(rotation_vectors, True)
+                exponential_derivatives = (matrix_derivatives[rows]*coordinates[:,numpy.newaxis,numpy.newaxis,:]).sum(axis=3)
+            else:
+                rotation_matrices = rotation_vectors_to_matrices(rotation_vectors)
+            positions[self.exponential_ends[selection]] += (rotation_matrices[rows]*coordinates[:,numpy.newaxis,:]).sum(axis=2)
+        if len(self.translation_ends) > 0:
+            selection = select(self.translation_ends)
+            positions[self.translation_ends[selection]] += self.state[self.translation_indices[selection]]
+        if springs is None:
+            deltas = positions[:num_springs] - positions[num_springs:]
+        else:
+            deltas = positions[springs] - positions[springs + num_springs]
+        norms = numpy.sqrt((deltas*deltas).sum(axis=1))
+        if derivatives:
+            return deltas, norms, exponential_derivatives
+        return deltas, norms
+
+    def add_outputs(self):
+        deltas, norms = self.compute_deltas()
+        self.outputs[0] += ((norms - self.rest_lengths)**2).sum()
+
+    def add_outputs_incremental(self, changed_state):
+        # the energies of the individual springs are cached
+        if changed_state is None or self.cached_outputs is None:
+            deltas, norms = self.compute_deltas()
+            self.cached_outputs = (norms - self.rest_lengths)**2
+        else:
+            num_springs = len(self.springs)
+            changed_ends = numpy.zeros(2*num_springs, bool)
+            if len(self.rotation_ends) > 0:
+                changed_ends[self.rotation_ends] |= changed_state[self.rotation_indices].reshape((-1, 9)).any(axis=1)
+            if len(self.exponential_ends) > 0:
+                changed_ends[self.exponential_ends] |= changed_state[self.exponential_indices].any(axis=1)
+            if len(self.translation_ends) > 0:
+                changed_ends[self.translation_ends] |= changed_state[self.translation_indices].any(axis=1)
+            springs = (changed_ends[:num_springs] | changed_ends[num_springs:]).nonzero()[0]
+            if len(springs) == num_springs:
+                deltas, norms = self.compute_deltas()
+                self.cached_outputs = (norms - self.rest_lengths)**2
+            elif len(springs) > 0:
+                deltas, norms = self.compute_deltas(springs=springs)
+                self.cached_outputs[springs] = (norms - self.rest_lengths[springs])**2
+        self.outputs[0] += self.cached_outputs.sum()
+
+    def add_derivatives(self):
+        deltas, norms, exponential_derivatives = self.compute_deltas(True)
+        # where the norm is zero, the delta vector is zero too
+        factors = 2*(norms - self.rest_lengths)/(norms + (norms == 0))
+        factors[norms == 0] = 2
+        gradients = deltas*factors[:,numpy.newaxis]
+        self.scatter(gradients, self.state_derivatives, exponential_derivatives)
+
+    def scatter(self, gradients, result, exponential_derivatives=None):
+        # add the derivatives towards the state, given the derivatives
+        # towards the delta vectors of the springs, to result
+        gradients = numpy.concatenate([gradients, -gradients])
+        size = len(result)
+        if len(self.rotation_ends) > 0:
+            rotation_gradients = gradients[self.rotation_ends,:,numpy.newaxis]*self.rotation_coordinates[:,numpy.newaxis,:]
+            result += numpy.bincount(self.rotation_indices.ravel(), rotation_gradients.ravel(), size)
+        if len(self.exponential_ends) > 0:
+            exponential_gradients = (gradients[self.exponential_ends,numpy.newaxis,:]*exponential_derivatives).sum(axis=2)
+            result += numpy.bincount(self.exponential_indices.ravel(), exponential_gradients.ravel(), size)
+        if len(self.translation_ends) > 0:
+            result += numpy.bincount(self.translation_indices.ravel(), gradients[self.translation_ends].ravel(), size)
+
+    def supports_hessian_vector(self):
+        return True
+
+    def add_hessian_vector(self, vector, result):
+        deltas, norms, exponential_derivatives = self.compute_deltas(True)
+        # the changes of the delta vectors along vector
+        num_springs = len(self.springs)
+        changes = numpy.zeros((2*num_springs, 3), float)
+        if len(self.rotation_ends) > 0:
+            changes[self.rotation_ends] += (vector[self.rotation_indices]*self.rotation_coordinates[:,numpy.newaxis,:]).sum(axis=2)
+        if len(self.exponential_ends) > 0:
+            changes[self.exponential_ends] += numpy.einsum("mik,mi->mk", exponential_derivatives, vector[self.exponential_indices])
+        if len(self.translation_ends) > 0:
+            changes[self.translation_ends] += vector[self.translation_indices]
+        delta_changes = changes[:num_springs] - changes[num_springs:]
+        # the Hessian of (|delta| - rest_length)**2 towards delta is
+        # 2*(1 - ratio)*I + 2*ratio*u*u^T, with ratio = rest_length/|delta|
+        # and u the unit vector along delta.
+        zero = norms == 0
+        ratios = self.rest_lengths/(norms + zero)
+        ratios[zero] = 0
+        units = deltas/(norms + zero)[:,numpy.newaxis]
+        projections = (units*delta_changes).sum(axis=1)
+        gradients = (
+            2*(1 - ratios)[:,numpy.newaxis]*delta_changes +
+            2*(ratios*projections)[:,numpy.newaxis]*units
+        )
+        self.scatter(gradients, result, exponential_derivatives)
+        if len(self.exponential_ends) > 0:
+            # the end points of exponential frames depend nonlinearly on the
+            # rotation vectors, which adds the second derivatives of the end
+            # points, weighted with the derivatives of the energy.
+            first_gradients = 2*(1 - ratios)[:,numpy.newaxis]*deltas
+            first_gradients = numpy.concatenate([first_gradients, -first_gradients])[self.exponential_ends]
+            rotation_vectors = self.state[self.exponential_frame_indices]
+            matrix_second_derivatives = rotation_vectors_to_matrices(rotation_vectors, second_derivatives=True)[2]
+            second_derivatives = (matrix_second_derivatives[self.exponential_rows]*self.exponential_coordinates[:,numpy.newaxis,numpy.newaxis,numpy.newaxis,:]).sum(axis=4)
+            curvatures = numpy.einsum("mijk,mk,mj->mi", second_derivatives, first_gradients, vector[self.exponential_indices])
+            result += numpy.bincount(self.exponential_indices.ravel(), curvatures.ravel(), len(result))
@@ -37,7 +37,9 @@ from base import Variable, Helper, SanityError
 import numpy
 
 
-__all__ = ["Frame", "Translation"]
+__all__ = [
+    "Frame", "ExponentialFrame", "Translation", "rotation_vectors_to_matrices",
+]
 
 
 class Frame(Variable):
@@ -79,6 +81,158 @@ class Frame(Variable):
         return numpy.dot(self.rotation_matrix, vector) + self.translation_vector
 
 
+def rotation_vectors_to_matrices(rotation_vectors, derivatives=False, second_derivatives=False):
+    """Convert rotation vectors into rotation matrices (exponential map)
+
+    The argument has shape (n, 3). The result has shape (n, 3, 3). When
+    derivatives is True, also the derivatives of the rotation matrices
+    towards the components of the rotation vectors are returned, with shape
+    (n, 3, 3, 3) and the derivative index in the second position. When
+    second_derivatives is True, the second derivatives follow as a third
+    result, with shape (n, 3, 3, 3, 3) and the derivative indices in the
+    second and third position.
+
+    The Rodrigues formula, R = 1 + A*K + B*K^2, is used. K is the cross
+    product matrix of the rotation vector. Taylor series replace the
+    coefficients at small angles.
+    """
+    size = len(rotation_vectors)
+    angles2 = (rotation_vectors*rotation_vectors).sum(axis=1)
+    angles = numpy.sqrt(angles2)
+    small = angles < 1e-2
+    safe_angles = angles + small
+    sines = numpy.sin(safe_angles)
+    cosines = numpy.cos(safe_angles)
+    a = numpy.where(small, 1 - angles2/6 + angles2**2/120, sines/safe_angles)
+    b = numpy.where(small, 0.5 - angles2/24 + angles2**2/720, (1 - cosines)/safe_angles**2)
+
+    cross = numpy.zeros((size, 3, 3), float)
+    cross[:,0,1] = -rotation_vectors[:,2]
+    cross[:,0,2] = rotation_vectors[:,1]
+    cross[:,1,0] = rotation_vectors[:,2]
+    cross[:,1,2] = -rotation_vectors[:,0]
+    cross[:,2,0] = -rotation_vectors[:,1]
+    cross[:,2,1] = rotation_vectors[:,0]
+    cross2 = numpy.einsum("nij,njk->nik", cross, cross)
+    matrices = numpy.identity(3) + a[:,None,None]*cross + b[:,None,None]*cross2
+    if not (derivatives or second_derivatives):
+        return matrices
+
+    # the derivatives of a and b, divided by the rotation vector component
+    c = numpy.where(small, -1.0/3 + angles2/30, (safe_angles*cosines - sines)/safe_angles**3)
+    d = numpy.where(small, -1.0/12 + angles2/180, (safe_angles*sines - 2*(1 - cosines))/safe_angles**4)
+    unit_cross = numpy.zeros((3, 3, 3), float)
+    unit_cross[0,1,2] = -1
+    unit_cross[0,2,1] = 1
+    unit_cross[1,0,2] = 1
+    unit_cross[1,2,0] = -1
+    unit_cross[2,0,1] = -1
+    unit_cross[2,1,0] = 1
+    # the derivatives of K^2
+    cross_products = (
+        numpy.einsum("ijk,nkl->nijl", unit_cross, cross) +
+        numpy.einsum("njk,ikl->nijl", cross, unit_cross)
+    )
+    matrix_derivatives = (
+        a[:,None,None,None]*unit_cross +
+        b[:,None,None,None]*cross_products +
+        rotation_vectors[:,:,None,None]*(
+            c[:,None,None,None]*cross[:,None] +
+            d[:,None,None,None]*cross2[:,None]
+        )
+    )
+    if not second_derivatives:
+        return matrices, matrix_derivatives
+
+    # the derivatives of c and d, divided by the rotation vector component
+    e = numpy.where(small, 1.0/15 - angles2/210, (3*sines - 3*safe_angles*cosines - safe_angles**2*sines)/safe_angles**5)
+    f = numpy.where(small, 1.0/90 - angles2/1680, (safe_angles**2*cosines - 5*safe_angles*sines + 8*(1 - cosines))/safe_angles**6)
+    unit_products = numpy.einsum("ijk,lkm->iljm", unit_cross, unit_cross)
+    mixed = c[:,None,None,None]*unit_cross + d[:,None,None,None]*cross_products
+    matrix_second_derivatives = (
+        rotation_vectors[:,None,:,None,None]*mixed[:,:,None] +
+        rotation_vectors[:,:,None,None,None]*mixed[:,None,:] +
+        b[:,None,None,None,None]*(unit_products + unit_products.transpose(1, 0, 2, 3)) +
+        numpy.identity(3)[:,:,None,None]*(
+            c[:,None,None]*cross + d[:,None,None]*cross2
+        )[:,None,None] +
+        (rotation_vectors[:,:,None]*rotation_vectors[:,None,:])[:,:,:,None,None]*(
+            e[:,None,None]*cross + f[:,None,None]*cross2
+        )[:,None,None]
+    )
+    return matrices, matrix_derivatives, matrix_second_derivatives
+
+
+class ExponentialFrame(Variable):
+    """A rigid body frame with a rotation vector instead of a rotation matrix
+
+    The state consists of a rotation vector and a translation vector. The
+    rotation is the exponential map of the rotation vector, applied after
+    the reference rotation matrix. It needs no orthonormality constraint.
+    """
+    dimension = 6
+
+    def __init__(self, rotation_matrix, translation_vector):
+        Variable.__init__(self)
+        self.reference_matrix = numpy.array(rotation_matrix, float)
+        self.rotation_vector = numpy.zeros(3, float)
+        self.translation_vector = translation_vector
+        self.inertia_tensor = numpy.zeros((3,3), float)
+        self.inertia_mass = numpy.zeros(3, float)
+
+    def add_mass(self, coordinate):
+        self.inertia_tensor += numpy.dot(coordinate, coordinate) - numpy.outer(coordinate, coordinate)
+        self.inertia_mass += 1
+
+    def sanity_check(self):
+        Variable.sanity_check(self)
+        if self.reference_matrix.shape != (3,3):
+            raise SanityError("The rotation_matrix must be a 3x3 matrix. The given array hase shape %s." % self.reference_matrix.shape)
+        if self.translation_vector.shape != (3,):
+            raise SanityError("The translation_vector must be a vector of length 3. The given array has  shape=%s." % self.translation_vector.shape)
+
+    def connect(self, state, derivatives, mass):
+        Variable.connect(self, state, derivatives, mass)
+        self.state[0: 3] = self.rotation_vector
+        self.rotation_vector = self.state[0: 3]
+        self.state[3: 6] = self.translation_vector
+        self.translation_vector = self.state[3: 6]
+        self.mass[0: 3] = self.inertia_tensor.diagonal()
+        self.mass[3: 6] = self.inertia_mass
+        self.inertia_mass = self.mass[3: 6]
+
+    def get_rotation_matrix(self, rotation_vector=None):
+        if rotation_vector is None:
+            rotation_vector = self.rotation_vector
+        return numpy.dot(rotation_vectors_to_matrices(rotation_vector[numpy.newaxis])[0], self.reference_matrix)
+
+    rotation_matrix = property(get_rotation_matrix)
+
+    def get_vector_derivatives(self, vector):
+        """The derivatives of the transformed vector towards the rotation vector
+
+        Column i contains the derivative towards component i.
+        """
+        matrix_derivatives = rotation_vectors_to_matrices(self.rotation_vector[numpy.newaxis], True)[1][0]
+        return numpy.dot(matrix_derivatives, numpy.dot(self.reference_matrix, vector)).transpose()
+
+    def get_vector_second_derivatives(self, vector):
+        """The second derivatives of the transformed vector towards the rotation vector
+
+        The result has shape (3, 3, 3). The first two indices are the
+        components of the rotation vector, the last index is the component
+        of the transformed vector.
+        """
+        matrix_second_derivatives = rotation_vectors_to_matrices(self.rotation_vector[numpy.newaxis], second_derivatives=True)[2][0]
+        return numpy.dot(matrix_second_derivatives, numpy.dot(self.reference_matrix, vector))
+
+    def extract_state(self, state_index, state):
+        return self.get_rotation_matrix(state[state_index: state_index+3]), state[state_index+3: state_index+6]
+
+    def apply_vector(self, vector):
+        return numpy.dot(self.rotation_matrix, vector) + self.translation_vector
+
+
 class Translation(Variable):
     dimension = 3
 
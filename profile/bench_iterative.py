@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Benchmarks for the minimizers in the iterative package
+
+Reproducible spring networks between rigid bodies are generated. The rigid
+bodies are randomly displaced from a configuration in which all springs
+have their rest length. Each minimizer is run on each network. For every
+run, one JSON object is written per line with the number of energy and
+gradient evaluations, the number of analytic Hessian-vector products, the
+number of SHAKE iterations and the wall time.
+
+Run 'python bench_iterative.py --help' for the options.
+"""
+
+
+import iterative
+
+import numpy, time, json, optparse, sys
+
+
+sizes = [
+    # (number of frames, number of springs)
+    (2, 10),
+    (5, 50),
+    (20, 200),
+    (50, 1000),
+    (200, 4000),
+    (500, 10000),
+]
+
+
+algorithms = {
+    "sd": iterative.alg.SteepestDescent,
+    "cg": iterative.alg.ConjugateGradient,
+    "lbfgs": iterative.alg.LBFGS,
+    "tn": iterative.alg.TruncatedNewton,
+}
+
+
+parametrizations = ["matrix", "vector"]
+
+
+class TooManySteps(Exception):
+    pass
+
+
+def random_rotation_matrix():
+    rotation_matrix = numpy.linalg.qr(numpy.random.normal(0, 1, (3, 3)))[0]
+    if numpy.linalg.det(rotation_matrix) < 0:
+        rotation_matrix *= -1
+    return rotation_matrix
+
+
+def build_network(num_frames, num_springs, parametrization, displacement, seed):
+    """Return a spring network and the max_step array for the minimizers"""
+    numpy.random.seed(seed)
+    root_expression = iterative.expr.Root(1, 10, True)
+    # the configuration in which all springs are at rest
+    size = 3*num_frames**(1.0/3)
+    centers = numpy.random.uniform(0, size, (num_frames, 3))
+    rotations = [random_rotation_matrix() for index in xrange(num_frames)]
+    frames = []
+    max_step = []
+    for center, rotation in zip(centers, rotations):
+        # the displaced initial state
+        rotation_vector = numpy.random.normal(0, displacement, 3)
+        rotation_matrix = numpy.dot(iterative.var.rotation_vectors_to_matrices(rotation_vector[numpy.newaxis])[0], rotation)
+        translation_vector = center + numpy.random.normal(0, displacement, 3)
+        if parametrization == "matrix":
+            frame = iterative.var.Frame(rotation_matrix, translation_vector)
+            root_expression.register_state_variable(frame)
+            constraint = iterative.expr.Orthonormality(1e-10)
+            constraint.register_input_variable(frame)
+            max_step.extend([0.1]*9 + [1.0]*3)
+        else:
+            frame = iterative.var.ExponentialFrame(rotation_matrix, translation_vector)
+            root_expression.register_state_variable(frame)
+            max_step.extend([0.1]*3 + [1.0]*3)
+        frames.append(frame)
+
+    spring_set = iterative.expr.SpringSet()
+    for counter in xrange(num_springs):
+        index1 = numpy.random.randint(num_frames)
+        index2 = (index1 + numpy.random.randint(1, num_frames)) % num_frames
+        coordinate1 = numpy.random.normal(0, 1, 3)
+        coordinate2 = numpy.random.normal(0, 1, 3)
+        rest_length = numpy.linalg.norm(
+            numpy.dot(rotations[index1], coordinate1) + centers[index1] -
+            numpy.dot(rotations[index2], coordinate2) - centers[index2]
+        )
+        spring_set.add_spring(frames[index1], coordinate1, frames[index2], coordinate2, rest_length)
+
+    root_expression.parse_input()
+    return root_expression, numpy.array(max_step, float)
+
+
+def count_calls(root_expression, counts):
+    # replace the methods of the root expression by counting wrappers
+    def wrap(name, key):
+        method = getattr(root_expression, name)
+        def wrapper():
+            counts[key] += 1
+            return method()
+        setattr(root_expression, name, wrapper)
+    wrap("add_outputs", "energy_evaluations")
+    wrap("add_outputs_incremental", "energy_evaluations")
+    wrap("add_derivatives", "gradient_evaluations")
+
+    compute_hessian_vector = root_expression.compute_hessian_vector
+    def hessian_vector_wrapper(vector):
+        counts["hessian_vector_products"] += 1
+        return compute_hessian_vector(vector)
+    root_expression.compute_hessian_vector = hessian_vector_wrapper
+
+    shake = root_expression.shake
+    def shake_wrapper():
+        num_shakes = shake()
+        counts["shake_iterations"] += num_shakes
+        return num_shakes
+    root_expression.shake = shake_wrapper
+
+
+def run_benchmark(algorithm_name, parametrization, num_frames, num_springs, displacement, seed, max_steps):
+    root_expression, max_step = build_network(num_frames, num_springs, parametrization, displacement, seed)
+    counts = {
+        "energy_evaluations": 0,
+        "gradient_evaluations": 0,
+        "hessian_vector_products": 0,
+        "shake_iterations": 0,
+    }
+    count_calls(root_expression, counts)
+    minimize = algorithms[algorithm_name](root_expression, max_step, max_step*1e-8)
+
+    def report(status):
+        if status.step >= max_steps:
+            raise TooManySteps
+
+    start = time.time()
+    try:
+        minimize.run(report)
+        converged = True
+    except TooManySteps:
+        converged = False
+    wall_time = time.time() - start
+
+    root_expression.clear_outputs()
+    root_expression.add_outputs()
+    result = {
+        "algorithm": algorithm_name,
+        "parametrization": parametrization,
+        "num_frames": num_frames,
+        "num_springs": num_springs,
+        "displacement": displacement,
+        "seed": seed,
+        "steps": minimize.status.step,
+        "converged": converged,
+        "final_energy": float(root_expression.outputs[0]),
+        "wall_time": wall_time,
+    }
+    result.update(counts)
+    # the final energy evaluation above is not part of the run
+    result["energy_evaluations"] -= 1
+    return result
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        "-a", "--algorithms", default=",".join(sorted(algorithms)),
+        help="Comma separated list of minimizers [default: %default]",
+    )
+    parser.add_option(
+        "-p", "--parametrizations", default=",".join(parametrizations),
+        help="Comma separated list of rotation parametrizations [default: %default]",
+    )
+    parser.add_option(
+        "-n", "--max-springs", type="int", default=1000,
+        help="Only run networks with at most this number of springs [default: %default]",
+    )
+    parser.add_option(
+        "-s", "--seeds", type="int", default=1,
+        help="Number of random networks of each size [default: %default]",
+    )
+    parser.add_option(
+        "-d", "--displacement", type="float", default=0.3,
+        help="Standard deviation of the initial displacements [default: %default]",
+    )
+    parser.add_option(
+        "-m", "--max-steps", type="int", default=5000,
+        help="Give up after this number of iterations [default: %default]",
+    )
+    parser.add_option(
+        "-o", "--output", default=None,
+        help="Write the results to this file instead of the standard output",
+    )
+    options, args = parser.parse_args()
+
+    if options.output is None:
+        f = sys.stdout
+    else:
+        f = file(options.output, "w")
+    for num_frames, num_springs in sizes:
+        if num_springs > options.max_springs:
+            continue
+        for seed in xrange(options.seeds):
+            for parametrization in options.parametrizations.split(","):
+                for algorithm_name in options.algorithms.split(","):
+                    result = run_benchmark(
+                        algorithm_name, parametrization, num_frames,
+                        num_springs, options.displacement, seed,
+                        options.max_steps,
+                    )
+                    print >> f, json.dumps(result, sort_keys=True)
+                    f.flush()
+    if f is not sys.stdout:
+        f.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -37,7 +37,8 @@ from zeobuilder.actions.composed import Immediate
 from zeobuilder.actions.collections.menu import MenuInfo, MenuInfoBase
 from zeobuilder.nodes.parent_mixin import ContainerMixin
 from zeobuilder.gui.fields_dialogs import FieldsDialogSimple
-from zeobuilder.zml import dump_to_file, load_from_string, load_from_file
+from zeobuilder.nodes.model_object import copy_model_objects
+from zeobuilder.zml import dump_to_file, load_from_string
 import zeobuilder.actions.primitive as primitive
 import zeobuilder.authors as authors
 
@@ -151,17 +152,33 @@ def delete(nodes):
             primitive.Delete(dupe)
 
 
+# The copies of the nodes that are on the clipboard, as long as this
+# application owns it. Pasting them does not need the ZML text.
+clipboard_nodes = None
+
+
 def copy_to_clipboard(nodes):
-    serialized = StringIO.StringIO()
-    if dump_to_file(serialized, nodes) > 0:
+    global clipboard_nodes
+    copies = copy_model_objects(nodes)
+    if len(copies) > 0:
+        serialized = []
+
         def get_func(clipboard, selection_data, info, user_data):
-            selection_data.set("ZML", 8, serialized.getvalue())
+            # the ZML text is only made when it is requested
+            if len(serialized) == 0:
+                f = StringIO.StringIO()
+                dump_to_file(f, copies)
+                serialized.append(f.getvalue())
+            selection_data.set("ZML", 8, serialized[0])
 
         def clear_func(clipboard, user_data):
-            serialized.close()
+            global clipboard_nodes
+            if clipboard_nodes is copies:
+                clipboard_nodes = None
 
         clipboard = gtk.clipboard_get()
         clipboard.set_with_data([("ZML", 0, 0)], get_func, clear_func)
+        clipboard_nodes = copies
 
 
 class Cut(Immediate):
@@ -230,6 +247,11 @@ class Paste(Immediate):
     def do(self):
         parent = context.application.cache.node
 
+        if clipboard_nodes is not None:
+            nodes = copy_model_objects(clipboard_nodes)
+            primitive.AddMany([node for node in nodes if parent.check_add(node.__class__)], parent)
+            return
+
         def load_func(clipboard, selection_data, user_data):
             string_representation = selection_data.data
             if string_representation is None:
@@ -282,10 +304,7 @@ class Duplicate(Immediate):
         parent = cache.parent
         highest_index = cache.highest_index
 
-        serialized = StringIO.StringIO()
-        dump_to_file(serialized, originals)
-        serialized.seek(0)
-        duplicates = load_from_file(serialized)
+        duplicates = copy_model_objects(originals)
 
         for duplicate in duplicates:
             highest_index += 1
@@ -38,7 +38,7 @@ from zeobuilder.actions.composed import ImmediateWithMemory, Immediate, \
 from zeobuilder.actions.collections.menu import MenuInfo
 from zeobuilder.nodes.meta import Property
 from zeobuilder.nodes.elementary import GLContainerBase, GLReferentBase
-from zeobuilder.nodes.model_object import ModelObjectInfo
+from zeobuilder.nodes.model_object import ModelObjectInfo, copy_model_objects
 from zeobuilder.nodes.parent_mixin import ReferentMixin
 from zeobuilder.nodes.glmixin import GLTransformationMixin
 from zeobuilder.nodes.helpers import FrameAxes
@@ -46,7 +46,6 @@ from zeobuilder.nodes.reference import SpatialReference
 from zeobuilder.nodes.vector import Vector
 from zeobuilder.undefined import Undefined
 from zeobuilder.gui.fields_dialogs import FieldsDialogSimple, DialogFieldInfo
-from zeobuilder.zml import dump_to_file, load_from_file
 import zeobuilder.actions.primitive as primitive
 import zeobuilder.gui.fields as fields
 import zeobuilder.authors as authors
@@ -55,8 +54,6 @@ from molmod import Translation, UnitCell, angstrom
 
 import numpy, gtk
 
-import StringIO
-
 
 default_unit_cell = UnitCell(numpy.identity(3, float)*10*angstrom, numpy.zeros(3, bool))
 
@@ -637,7 +634,7 @@ class SuperCell(ImmediateWithMemory):
 
         repetitions = numpy.array(repetitions, int)
 
-        # serialize the positioned children
+        # the positioned children
         universe = context.application.model.universe
 
         positioned = [
@@ -648,9 +645,6 @@ class SuperCell(ImmediateWithMemory):
         ]
         if len(positioned) == 0: return
 
-        serialized = StringIO.StringIO()
-        dump_to_file(serialized, positioned)
-
         # create the replica's
 
         # replicate the positioned objects
@@ -658,18 +652,13 @@ class SuperCell(ImmediateWithMemory):
         for cell_index in iter_all_positions(repetitions):
             cell_index = numpy.array(cell_index)
             cell_hash = tuple(cell_index)
-            serialized.seek(0)
-            nodes = load_from_file(serialized)
+            nodes = copy_model_objects(positioned)
             new_children[cell_hash] = nodes
             for node in nodes:
                 t = node.transformation.t + numpy.dot(universe.cell.matrix, cell_index)
                 new_transformation = node.transformation.copy_with(t=t)
                 node.set_transformation(new_transformation)
 
-        # forget about serialized stuff
-        serialized.close()
-        del serialized
-
         new_connectors = []
         # replicate the objects that connect these positioned objects
         for cell_index in iter_all_positions(repetitions):
@@ -34,7 +34,8 @@
 
 from zeobuilder import context
 from zeobuilder.filters import LoadFilter, DumpFilter, FilterError
-from zeobuilder.zml import load_from_file, dump_to_file
+from zeobuilder.zml import load_from_file, dump_to_file, \
+    load_from_binary_file, dump_to_binary_file
 from zeobuilder.plugins import PluginNotFoundError
 import zeobuilder.authors as authors
 
@@ -45,9 +46,14 @@ class LoadZML(LoadFilter):
     def __init__(self):
         LoadFilter.__init__(self, "Zeobuilder Markup Language (*.zml)")
 
+    def load(self, f):
+        # the children of frames are loaded when they are used, e.g. when a
+        # frame is expanded in the tree view.
+        return load_from_file(f, lazy=True)
+
     def __call__(self, f):
         try:
-            root = load_from_file(f)
+            root = self.load(f)
             return root[0], root[1]
         except PluginNotFoundError, e:
             raise FilterError("The file contains a node Class (%s) for which no appropriate plugin can be found." % e.name)
@@ -61,9 +67,12 @@ class DumpZML(DumpFilter):
     def __init__(self):
         DumpFilter.__init__(self, "Zeobuilder Markup Language (*.zml)")
 
+    def dump(self, f, root):
+        dump_to_file(f, root)
+
     def __call__(self, f, universe, folder, nodes=None):
         if nodes is None:
-            dump_to_file(f, [universe, folder])
+            self.dump(f, [universe, folder])
         else:
             Universe = context.application.plugins.get_node(name="Universe")
             new_universe = Universe()
@@ -71,15 +80,37 @@ class DumpZML(DumpFilter):
             Folder = context.application.plugins.get_node("Folder")
             new_folder = Folder(name="Root folder")
             new_folder.children = [node for node in nodes if node.is_indirect_child_of(folder)]
-            dump_to_file(f, [new_universe, new_folder])
+            self.dump(f, [new_universe, new_folder])
+
+
+class LoadZMLB(LoadZML):
+    authors = [authors.toon_verstraelen]
+
+    def __init__(self):
+        LoadFilter.__init__(self, "Binary Zeobuilder Markup Language (*.zmlb)")
+
+    def load(self, f):
+        return load_from_binary_file(f)
+
+
+class DumpZMLB(DumpZML):
+    authors = [authors.toon_verstraelen]
+
+    def __init__(self):
+        DumpFilter.__init__(self, "Binary Zeobuilder Markup Language (*.zmlb)")
+
+    def dump(self, f, root):
+        dump_to_binary_file(f, root)
 
 
 load_filters = {
     "zml": LoadZML(),
+    "zmlb": LoadZMLB(),
 }
 
 dump_filters = {
     "zml": DumpZML(),
+    "zmlb": DumpZMLB(),
 }
 
 
@@ -47,15 +47,20 @@ from zeobuilder.gui.fields_dialogs import FieldsDialogSimple
 from zeobuilder.gui.glade_wrapper import GladeWrapper
 from zeobuilder.undefined import Undefined
 from zeobuilder.child_process import ChildProcessDialog
+from zeobuilder.wire import register_codecs
 import zeobuilder.actions.primitive as primitive
 import zeobuilder.gui.fields as fields
 import zeobuilder.authors as authors
 
-from conscan import Geometry, ProgressMessage, Connection
+from conscan import Geometry, ProgressMessage, Connection, ConnectionPreview
+from conscan.messages import message_codecs
 
 from molmod import Rotation, Translation, angstrom
 
-import gtk, numpy, weakref
+import gtk, numpy, weakref, os
+
+
+register_codecs(message_codecs)
 
 
 class ConscanResults(ReferentBase):
@@ -131,8 +136,11 @@ class ConscanResultsWindow(GladeWrapper):
             "cb_inverse",
         ])
         self.window.hide()
+        self.title = self.window.get_title()
 
-        self.list_store = gtk.ListStore(float, int, str, object)
+        # The last column contains the key of a preview and -1 for the
+        # final results.
+        self.list_store = gtk.ListStore(float, int, str, object, int)
 
         column = gtk.TreeViewColumn("")
         renderer_text = gtk.CellRendererText()
@@ -166,20 +174,54 @@ class ConscanResultsWindow(GladeWrapper):
         self.tree_selection.connect("changed", self.on_selection_changed)
         context.application.cache.connect("cache-invalidated", self.on_cache_invalidated)
 
+    def start_preview(self, top_k):
+        # The window is filled with previews of the best connections while
+        # the connection scanner is still running. The previews can not be
+        # applied, the final results replace them when the scan is done.
+        # The title of the window tells that the list is provisional.
+        self.frame1 = None
+        self.frame2 = None
+        self.top_k = top_k
+        self.list_store.clear()
+        self.window.set_title("%s (preview, scan in progress)" % self.title)
+        self.window.show_all()
+
+    def add_preview(self, preview):
+        # a better duplicate replaces the earlier preview
+        for row in self.list_store:
+            if row[4] == preview.key:
+                self.list_store.remove(row.iter)
+                break
+        position = 0
+        for row in self.list_store:
+            if row[0] < preview.quality:
+                break
+            position += 1
+        if position < self.top_k:
+            self.list_store.insert(position, [preview.quality, preview.size, "", None, preview.key])
+            if len(self.list_store) > self.top_k:
+                self.list_store.remove(self.list_store.get_iter(self.top_k))
+
+    def stop_preview(self):
+        self.list_store.clear()
+        self.window.set_title(self.title)
+        self.window.hide()
+
     def set_conscan_results(self, conscan_results):
         self.frame1 = conscan_results.children[0].target
         self.frame2 = conscan_results.children[1].target
         self.list_store.clear()
+        self.window.set_title(self.title)
         for connection in conscan_results.connections:
             self.list_store.append([
                 connection[0], len(connection[2]),
-                {True: "X", False: ""}[len(connection[3])>0], connection
+                {True: "X", False: ""}[len(connection[3])>0], connection, -1
             ])
         self.window.show_all()
 
     def update_sensitivities(self):
         model, iter = self.tree_selection.get_selected()
-        if iter is None:
+        if iter is None or model.get_value(iter, 3) is None:
             self.bu_apply.set_sensitive(False)
             self.bu_apply_opt.set_sensitive(False)
         else:
@@ -250,8 +292,9 @@ class ConscanResultsWindow(GladeWrapper):
         self.clean_springs(springs)
 
     def auto_apply(self):
-        if self.cb_auto_apply.get_active() and \
-           self.tree_selection.get_selected()[1] is not None:
+        model, iter = self.tree_selection.get_selected()
+        if self.cb_auto_apply.get_active() and iter is not None and \
+           model.get_value(iter, 3) is not None:
             action = CustomAction("Auto apply connection")
             self.apply_normal()
             action.finish()
@@ -338,12 +381,13 @@ class ConscanReportDialog(ChildProcessDialog):
             pb.set_text("- / -")
             pb.set_fraction(0.0)
 
-    def run(self, inp):
+    def run(self, inp, on_preview=None):
         self.clear_gui()
         self.connections = []
+        self.on_preview = on_preview
         response = ChildProcessDialog.run(self,
             [context.get_share_filename("helpers/conscan")],
-            inp, pickle=True
+            inp, persistent=True
         )
         if response == gtk.RESPONSE_OK:
             result = self.connections
@@ -366,6 +410,9 @@ class ConscanReportDialog(ChildProcessDialog):
                 pb.set_fraction(0.0)
         elif isinstance(instance, Connection):
             self.connections.append(instance)
+        elif isinstance(instance, ConnectionPreview):
+            if self.on_preview is not None:
+                self.on_preview(instance)
 
 
 class ConnectionPointDescription(fields.composed.ComposedInTable):
@@ -454,6 +501,26 @@ class ScanForConnections(ImmediateWithMemory):
                         low=0.0,
                         low_inclusive=False,
                     ),
+                    fields.faulty.Int(
+                        label_text="Repulsive points checked to drop clashing connections before evaluation (0=off)",
+                        attribute_name="prune_size",
+                        minimum=0,
+                    ),
+                    fields.faulty.Int(
+                        label_text="Maximum number of results, shown while scanning (0=all, shown at the end)",
+                        attribute_name="top_k",
+                        minimum=0,
+                    ),
+                    fields.faulty.Float(
+                        label_text="Rotation tolerance for duplicates (quaternion components, 0=off)",
+                        attribute_name="rotation_tolerance",
+                        low=0.0,
+                    ),
+                    fields.faulty.Length(
+                        label_text="Translation tolerance for duplicates (0=off)",
+                        attribute_name="distance_tolerance",
+                        low=0.0,
+                    ),
                     fields.group.Table(fields=[
                         fields.optional.RadioOptional(slave=fields.group.Table(fields=[
                             fields.edit.CheckButton(
@@ -485,6 +552,7 @@ class ScanForConnections(ImmediateWithMemory):
         ("comp_env", "Comparing environments"),
         ("calc_trans", "Calculating transformations"),
         ("mirror", "Adding inversions"),
+        ("pruned", "Pruned connections"),
         ("eval_con", "Evaluating connections"),
         ("elim_dup", "Eliminating duplicates"),
         ("send_con", "Receiving solutions"),
@@ -494,6 +562,7 @@ class ScanForConnections(ImmediateWithMemory):
         ("calc_env", "Calculating environments"),
         ("comp_env", "Comparing environments"),
         ("calc_trans", "Calculating transformations"),
+        ("pruned", "Pruned connections"),
         ("eval_con", "Evaluating connections"),
         ("elim_dup", "Eliminating duplicates"),
         ("send_con", "Receiving solutions"),
@@ -524,9 +593,11 @@ class ScanForConnections(ImmediateWithMemory):
         result.action_radius = 7*angstrom
         result.distance_tolerance = 0.1*angstrom
         result.hit_tolerance = 0.1*angstrom
+        result.prune_size = 0
+        result.top_k = 0
         result.allow_inversions = True
         result.minimum_triangle_size = 0.1*angstrom
-        result.rotation_tolerance = 0.05
+        result.rotation_tolerance = 0.0
         result.rotation2 = Undefined(rotation2)
         return result
 
@@ -611,6 +682,13 @@ class ScanForConnections(ImmediateWithMemory):
             inp["geometry2"] = None
         inp["action_radius"] = self.parameters.action_radius
         inp["hit_tolerance"] = self.parameters.hit_tolerance
+        # compare the environments on all available cores
+        inp["num_processes"] = None
+        inp["cache_dir"] = os.path.join(context.user_dir, "conscan_cache")
+        inp["prune_size"] = self.parameters.prune_size
+        if self.parameters.rotation_tolerance > 0 and self.parameters.distance_tolerance > 0:
+            inp["rotation_tolerance"] = self.parameters.rotation_tolerance
+            inp["translation_tolerance"] = self.parameters.distance_tolerance
         if not isinstance(self.parameters.allow_inversions, Undefined):
             inp["allow_rotations"] = True
             inp["allow_inversions"] = self.parameters.allow_inversions
@@ -622,10 +700,18 @@ class ScanForConnections(ImmediateWithMemory):
             else:
                 inp["rotation2"] = self.parameters.rotation2
 
+        if self.parameters.top_k > 0:
+            inp["top_k"] = self.parameters.top_k
+            results_window = ShowConscanResultsWindow.conscan_results_window
+            results_window.start_preview(self.parameters.top_k)
+            on_preview = results_window.add_preview
+        else:
+            on_preview = None
+
         if inp["allow_rotations"]:
-            connections = self.triangle_report_dialog.run(inp)
+            connections = self.triangle_report_dialog.run(inp, on_preview)
         else:
-            connections = self.pair_report_dialog.run(inp)
+            connections = self.pair_report_dialog.run(inp, on_preview)
 
         if connections is not None and len(connections) > 0:
             if len(cache.nodes) == 1:
@@ -653,6 +739,11 @@ class ScanForConnections(ImmediateWithMemory):
                 ) for connection in connections],
             )
             primitive.Add(conscan_results, context.application.model.folder)
+            if on_preview is not None:
+                # replace the previews by the final results
+                results_window.set_conscan_results(conscan_results)
+        elif on_preview is not None:
+            results_window.stop_preview()
 
 
 nodes = {
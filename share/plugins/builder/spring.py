@@ -45,6 +45,7 @@ from zeobuilder.nodes.elementary import GLFrameBase
 from zeobuilder.gui.fields_dialogs import DialogFieldInfo, FieldsDialogSimple
 from zeobuilder.gui.glade_wrapper import GladeWrapper
 from zeobuilder.child_process import ChildProcessDialog
+from zeobuilder.wire import register_codecs
 from zeobuilder.conversion import express_measure
 import zeobuilder.actions.primitive as primitive
 import zeobuilder.gui.fields as fields
@@ -54,13 +55,17 @@ from molmod.periodic import periodic
 from molmod import Complete, Translation, angstrom
 
 import iterative
+from iterative.algorithms.messages import message_codecs
 
-import numpy, gtk, sys, time
+import numpy, gtk, sys
 
 
 __all__ = ["Spring"]
 
 
+register_codecs(message_codecs)
+
+
 class Spring(Vector, ColorMixin):
     info = ModelObjectInfo("plugins/builder/spring.svg")
     authors = [authors.toon_verstraelen]
@@ -214,44 +219,25 @@ class OptimizationReportDialog(ChildProcessDialog, GladeWrapper):
         self.progress_bar.set_text("0%")
         self.minimize = minimize
         self.involved_frames = [frame for frame in involved_frames if frame is not None]
-        self.update_interval = update_interval
-        self.update_steps = update_steps
         self.num_springs = num_springs
-
-        self.last_time = time.time()
-        self.last_step = 0
         self.status = None
 
+        # the helper only sends a status update when the gui needs it
+        minimize.set_report_policy(update_interval, update_steps)
+
         result = ChildProcessDialog.run(self,
             [context.get_share_filename("helpers/iterative")],
-            self.minimize, pickle=True
+            self.minimize, persistent=True
         )
 
         # just to avoid confusion
         del self.minimize
         del self.involved_frames
-        del self.update_interval
-        del self.update_steps
-        del self.last_time
-        del self.last_step
         del self.num_springs
         del self.status
 
         return result
 
-    def conditional_update_gui(self):
-        if self.last_step > self.update_steps:
-            self.last_step = 0
-        else:
-            self.last_step += 1
-            return
-        current_time = time.time()
-        if self.last_time < current_time:
-            self.last_time = current_time + self.update_interval
-        else:
-            return
-        self.update_gui()
-
     def update_gui(self):
         if self.status is not None:
             self.la_num_iter.set_text("%i" % self.status.step)
@@ -259,7 +245,7 @@ class OptimizationReportDialog(ChildProcessDialog, GladeWrapper):
             self.progress_bar.set_text("%i%%" % int(self.status.progress*100))
             self.progress_bar.set_fraction(self.status.progress)
             for state_index, frame, variable in zip(self.state_indices, self.involved_frames, self.minimize.root_expression.state_variables):
-                if isinstance(variable, iterative.var.Frame):
+                if isinstance(variable, iterative.var.Frame) or isinstance(variable, iterative.var.ExponentialFrame):
                     r, t = variable.extract_state(state_index, self.status.state)
                     frame.set_transformation(Complete(r, t))
                 elif isinstance(variable, iterative.var.Translation):
@@ -271,10 +257,7 @@ class OptimizationReportDialog(ChildProcessDialog, GladeWrapper):
     def on_receive(self, instance):
         if isinstance(instance, iterative.alg.Status):
             self.status = instance
-            if self.status.progress < 1:
-                self.conditional_update_gui()
-            else:
-                self.update_gui()
+            self.update_gui()
         else:
             self.state_indices = instance
 
@@ -323,6 +306,12 @@ class OptimizeSprings(ImmediateWithMemory):
     menu_info = MenuInfo("default/_Object:tools/_Builder:spring", "_Optimize springs", order=(0, 4, 1, 6, 0, 1))
     authors = [authors.toon_verstraelen]
 
+    ROTATION_MATRIX = 0
+    ROTATION_VECTOR = 1
+
+    MINIMIZE_CG = 0
+    MINIMIZE_LBFGS = 1
+
     parameters_dialog = FieldsDialogSimple(
         "Minimization parameters",
         fields.group.Table(fields=[
@@ -330,6 +319,33 @@ class OptimizeSprings(ImmediateWithMemory):
                 label_text="Allow free rotation",
                 attribute_name="allow_rotation",
             ),
+            fields.edit.ComboBox(
+                choices=[
+                    (ROTATION_MATRIX, "Rotation matrix (constrained)"),
+                    (ROTATION_VECTOR, "Rotation vector (unconstrained)"),
+                ],
+                label_text="Rotation parametrization",
+                attribute_name="rotation_parametrization",
+            ),
+            fields.edit.ComboBox(
+                choices=[
+                    (MINIMIZE_CG, "Conjugate gradient"),
+                    (MINIMIZE_LBFGS, "L-BFGS"),
+                ],
+                label_text="Minimizer",
+                attribute_name="minimizer",
+            ),
+            fields.faulty.Int(
+                label_text="Number of starts (1=only the current geometry)",
+                attribute_name="num_starts",
+                minimum=1,
+            ),
+            fields.faulty.Length(
+                label_text="Random displacement of the extra starts",
+                attribute_name="start_displacement",
+                low=0.0,
+                low_inclusive=True,
+            ),
             fields.faulty.Float(
                 label_text="Update interval [s]",
                 attribute_name="update_interval",
@@ -366,6 +382,10 @@ class OptimizeSprings(ImmediateWithMemory):
     def default_parameters(cls):
         result = Parameters()
         result.allow_rotation = True
+        result.rotation_parametrization = cls.ROTATION_MATRIX
+        result.minimizer = cls.MINIMIZE_CG
+        result.num_starts = 1
+        result.start_displacement = 2*angstrom
         result.update_interval = 0.4
         result.update_steps = 1
         return result
@@ -388,6 +408,14 @@ class OptimizeSprings(ImmediateWithMemory):
         for frame in involved_frames:
             if frame is None:
                 pass
+            elif self.parameters.allow_rotation and isinstance(frame.transformation, Complete) and \
+                 self.parameters.rotation_parametrization == self.ROTATION_VECTOR:
+                variable = iterative.var.ExponentialFrame(
+                    frame.transformation.r,
+                    frame.transformation.t,
+                )
+                cost_function.register_state_variable(variable)
+                max_step.extend([0.1, 0.1, 0.1, 1.0, 1.0, 1.0])
             elif self.parameters.allow_rotation and isinstance(frame.transformation, Complete):
                 variable = iterative.var.Frame(
                     frame.transformation.r,
@@ -407,26 +435,41 @@ class OptimizeSprings(ImmediateWithMemory):
             else:
                 raise UserError("The involved frames shoud be at least capable of being translated.")
 
+        spring_set = iterative.expr.SpringSet()
         for spring, frames in springs.iteritems():
-            spring_term = iterative.expr.Spring(spring.rest_length)
+            ends = []
             for target, frame in frames.iteritems():
                 if frame is None:
-                    spring_term.register_input_variable(
+                    ends.append((
                         iterative.expressions.NoFrame(),
                         target.get_frame_up_to(parent).t
-                    )
+                    ))
                 else:
-                    spring_term.register_input_variable(
+                    ends.append((
                         cost_function.state_variables[variable_indices[frame]],
                         target.get_frame_up_to(frame).t
-                    )
+                    ))
+            (variable1, coordinate1), (variable2, coordinate2) = ends
+            spring_set.add_spring(variable1, coordinate1, variable2, coordinate2, spring.rest_length)
 
         max_step = numpy.array(max_step, float)
-        minimize = iterative.alg.DefaultMinimize(
+        if self.parameters.minimizer == self.MINIMIZE_LBFGS:
+            Minimize = iterative.alg.LBFGS
+        else:
+            Minimize = iterative.alg.DefaultMinimize
+        minimize = Minimize(
             cost_function,
             max_step,
             max_step*1e-8,
         )
+        if self.parameters.num_starts > 1:
+            # the extra starts get random rotations and translations, and
+            # they are minimized in parallel.
+            minimize = iterative.alg.MultiStart(
+                minimize,
+                self.parameters.num_starts,
+                self.parameters.start_displacement,
+            )
 
         result = self.report_dialog.run(
             minimize,
@@ -33,13 +33,15 @@
 
 
 
-from conscan import Geometry, Connection, ProgressMessage, TriangleScanner, PairScanner
+from conscan import Geometry, Connection, ProgressMessage, TriangleScanner, \
+    PairScanner, QualityEvaluator, ConnectionPreview
+from conscan.cache import EnvironmentCache, environment_cache
 
-from molmod import Rotation, MolecularGraph
+from molmod import Rotation, Complete, MolecularGraph
 from molmod.periodic import periodic
 from molmod.io import XYZFile
 
-import numpy as np, random
+import numpy as np, random, copy, tempfile, shutil, os
 
 
 
@@ -47,6 +49,7 @@ class Sender(object):
     def __init__(self, silent=True):
         self.silent = silent
         self.connections = []
+        self.previews = {}
 
     def __call__(self, message):
         if not self.silent:
@@ -66,6 +69,9 @@ class Sender(object):
             print "=~-~"*20
         if isinstance(message, Connection):
             self.connections.append(message)
+        elif isinstance(message, ConnectionPreview):
+            # a preview replaces the earlier one with the same key
+            self.previews[message.key] = message.quality
 
 
 def get_simple_model1():
@@ -219,6 +225,253 @@ def test_triangle_ego_precursor():
     )
     scanner.run()
 
+def test_triangle_ego_precursor_vectorized():
+    geometry = Geometry(*get_precursor_model())
+    pairs = []
+    for vectorized in False, True:
+        scanner = TriangleScanner(
+            send=Sender(),
+            geometry1=geometry,
+            geometry2=None,
+            action_radius=5.0,
+            hit_tolerance=0.1,
+            allow_inversions=True,
+            minimum_trianlge_area=0.001**2,
+            vectorized=vectorized,
+        )
+        scanner.generate_connections()
+        pairs.append([frozenset(connection.pairs) for connection in scanner.connections])
+    assert len(pairs[0]) > 0
+    assert pairs[0] == pairs[1]
+
+def test_triangle_ego_precursor_parallel():
+    geometry = Geometry(*get_precursor_model())
+    pairs = []
+    for num_processes in 1, 2:
+        scanner = TriangleScanner(
+            send=Sender(),
+            geometry1=geometry,
+            geometry2=None,
+            action_radius=5.0,
+            hit_tolerance=0.1,
+            allow_inversions=True,
+            minimum_trianlge_area=0.001**2,
+            num_processes=num_processes,
+        )
+        scanner.generate_connections()
+        pairs.append([frozenset(connection.pairs) for connection in scanner.connections])
+    assert len(pairs[0]) > 0
+    assert pairs[0] == pairs[1]
+
+def test_triangle_ego_precursor_fingerprints():
+    geometry = Geometry(*get_precursor_model())
+    pairs = []
+    for use_fingerprints in False, True:
+        scanner = TriangleScanner(
+            send=Sender(),
+            geometry1=geometry,
+            geometry2=None,
+            action_radius=5.0,
+            hit_tolerance=0.1,
+            allow_inversions=True,
+            minimum_trianlge_area=0.001**2,
+        )
+        if not use_fingerprints:
+            scanner.may_match = lambda environment1, environment2: True
+        scanner.generate_connections()
+        pairs.append([frozenset(connection.pairs) for connection in scanner.connections])
+    assert len(pairs[0]) > 0
+    assert pairs[0] == pairs[1]
+
+def test_quality_evaluator_precursor():
+    geometry = Geometry(*get_precursor_model())
+    scanner = TriangleScanner(
+        send=Sender(),
+        geometry1=geometry,
+        geometry2=None,
+        action_radius=5.0,
+        hit_tolerance=0.1,
+        allow_inversions=True,
+        minimum_trianlge_area=0.001**2,
+    )
+    scanner.generate_connections()
+    scanner.compute_transformations()
+    connections = scanner.connections
+    assert len(connections) > 0
+    references = copy.deepcopy(connections)
+    for reference in references:
+        reference.compute_quality(geometry, geometry)
+    QualityEvaluator(geometry, geometry).evaluate(connections)
+    for connection, reference in zip(connections, references):
+        assert connection.pairs == reference.pairs
+        assert abs(connection.quality - reference.quality) < 1e-10
+
+def test_triangle_ego_precursor_pruned():
+    geometry = Geometry(*get_precursor_model())
+    qualities = []
+    for prune_size in 0, 10:
+        messages = []
+        scanner = TriangleScanner(
+            send=messages.append,
+            geometry1=geometry,
+            geometry2=None,
+            action_radius=5.0,
+            hit_tolerance=0.1,
+            allow_inversions=True,
+            minimum_trianlge_area=0.001**2,
+            prune_size=prune_size,
+        )
+        scanner.generate_connections()
+        scanner.compute_transformations()
+        assert len(scanner.connections) > 0
+        # a connection that puts the geometry on top of itself clearly clashes
+        clash = copy.copy(scanner.connections[0])
+        clash.transformation = Rotation.identity()
+        scanner.connections.append(clash)
+        if prune_size > 0:
+            candidates = scanner.connections
+            candidate_qualities = QualityEvaluator(geometry, geometry).compute(candidates)[0]
+            scanner.prune_connections()
+            survivors = set(id(connection) for connection in scanner.connections)
+            assert id(clash) not in survivors
+            pruned = [
+                message for message in messages
+                if isinstance(message, ProgressMessage) and message.label == "pruned"
+            ]
+            assert pruned[-1].progress == len(candidates) - len(survivors)
+            assert pruned[-1].progress > 0
+            # only connections with a negative quality are removed
+            for connection, quality in zip(candidates, candidate_qualities):
+                if id(connection) not in survivors:
+                    assert quality < 0
+        scanner.evaluate_connections()
+        qualities.append(sorted(
+            connection.quality for connection in scanner.connections
+            if connection.quality >= 0
+        ))
+    assert qualities[0] == qualities[1]
+
+def test_triangle_ego_precursor_clustered():
+    geometry = Geometry(*get_precursor_model())
+    scanner = TriangleScanner(
+        send=(lambda message: None),
+        geometry1=geometry,
+        geometry2=None,
+        action_radius=5.0,
+        hit_tolerance=0.1,
+        allow_inversions=True,
+        minimum_trianlge_area=0.001**2,
+        rotation_tolerance=0.01,
+        translation_tolerance=0.1,
+    )
+
+    def make_connection(name, angle, invert, translation, quality):
+        connection = Connection(frozenset())
+        r = Rotation.from_properties(angle, [0, 0, 1], False).r
+        if invert:
+            r = -r
+        connection.transformation = Complete(r, np.array(translation, float))
+        connection.quality = quality
+        connection.name = name
+        return connection
+
+    # Rotations close to 180 degrees, where the quaternions of a and b only
+    # match after flipping the sign of one of them.
+    scanner.connections = [
+        make_connection("a", np.pi - 0.004, False, [1.0, 0.0, 0.0], 5.0),
+        # q/-q partner of a, slightly translated: merged into a
+        make_connection("b", np.pi + 0.004, False, [1.05, 0.0, 0.0], 4.0),
+        # improper counterpart of a: never merged with a
+        make_connection("c", np.pi - 0.004, True, [1.0, 0.0, 0.0], 3.0),
+        # close to c, but better: c is merged into d
+        make_connection("d", np.pi - 0.004, True, [1.0, 0.05, 0.0], 6.0),
+        # translation just outside the tolerance from a
+        make_connection("e", np.pi - 0.004, False, [1.0, -0.105, 0.0], 1.0),
+        # rotation just outside the tolerance from a
+        make_connection("f", np.pi - 0.025, False, [1.0, 0.0, 0.0], 0.5),
+    ]
+    clusters = {"a": "ab", "d": "cd", "e": "e", "f": "f"}
+    qualities = dict((c.name, c.quality) for c in scanner.connections)
+    scanner.cluster_connections()
+    assert [c.name for c in scanner.connections] == ["d", "a", "e", "f"]
+    # each survivor is the best member of its cluster
+    for connection in scanner.connections:
+        assert connection.quality == max(qualities[name] for name in clusters[connection.name])
+
+def test_triangle_ego_precursor_top_k():
+    geometry = Geometry(*get_precursor_model())
+    senders = []
+    for top_k in None, 10:
+        sender = Sender()
+        scanner = TriangleScanner(
+            send=sender,
+            geometry1=geometry,
+            geometry2=None,
+            action_radius=5.0,
+            hit_tolerance=0.1,
+            allow_inversions=True,
+            minimum_trianlge_area=0.001**2,
+            top_k=top_k,
+        )
+        scanner.run()
+        senders.append(sender)
+    assert 0 < len(senders[1].connections) <= 10
+    assert len(senders[1].previews) >= len(senders[1].connections)
+    # each result is shown with its final quality in the previews
+    qualities = set(senders[1].previews.itervalues())
+    for connection in senders[1].connections:
+        assert connection.quality in qualities
+    for connection1, connection2 in zip(senders[0].connections, senders[1].connections):
+        assert abs(connection1.quality - connection2.quality) < 1e-8
+
+def test_environment_cache():
+    geometry = Geometry(*get_precursor_model())
+    cache_dir = tempfile.mkdtemp("conscan")
+    try:
+        qualities = []
+        for counter in xrange(2):
+            # start from an empty memory cache, such that the second scan
+            # reads the environments from disk.
+            environment_cache.values.clear()
+            del environment_cache.keys[:]
+            sender = Sender()
+            scanner = PairScanner(
+                send=sender,
+                geometry1=geometry,
+                geometry2=None,
+                action_radius=5.0,
+                hit_tolerance=0.1,
+                rotation2=None,
+                cache_dir=cache_dir,
+            )
+            scanner.run()
+            qualities.append([connection.quality for connection in sender.connections])
+            assert len(os.listdir(cache_dir)) == 1
+        assert qualities[0] == qualities[1]
+
+        cache = EnvironmentCache(size=1)
+        assert cache.load(geometry, 5.0) is None
+        assert cache.load(geometry, 5.0, cache_dir) is not None
+        assert cache.load(geometry, 5.0) is not None
+        assert cache.load(geometry, 6.0, cache_dir) is None
+
+        # only the most recently used files are kept on disk
+        evict_dir = os.path.join(cache_dir, "evict")
+        cache = EnvironmentCache(size=1, disk_size=2)
+        for counter, action_radius in enumerate([1.0, 2.0, 3.0]):
+            cache.dump(geometry, action_radius, [], evict_dir)
+            filename = cache.get_filename(evict_dir, cache.get_key(geometry, action_radius))
+            os.utime(filename, (counter, counter))
+        assert len(os.listdir(evict_dir)) == 2
+        assert cache.load(geometry, 1.0, evict_dir) is None
+        assert cache.load(geometry, 2.0, evict_dir) is not None
+        # the file that was just read is now the most recent one
+        cache.dump(geometry, 4.0, [], evict_dir)
+        assert cache.load(geometry, 2.0, evict_dir) is not None
+        assert cache.load(geometry, 3.0, evict_dir) is None
+    finally:
+        shutil.rmtree(cache_dir)
+
 def test_pair_ego_precursor():
     geometry = Geometry(*get_precursor_model())
     sender = Sender()
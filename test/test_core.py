@@ -34,7 +34,22 @@
 
 from common import *
 
+from zeobuilder import context
 from zeobuilder.conversion import express_measure
+from zeobuilder.wire import write_message, read_message, serve, JobDone, \
+    register_codecs
+from zeobuilder.zml import load_from_file, dump_to_file, parse_numbers
+from zeobuilder.nodes.model_object import copy_model_objects, index_model_objects
+
+from conscan import Connection, ConnectionPreview, ProgressMessage
+import conscan.messages
+from iterative.algorithms import Status
+import iterative.algorithms.messages
+
+from molmod import Complete, Rotation, Translation
+
+from cStringIO import StringIO
+import numpy, os, signal, time
 
 
 def test_conversion():
@@ -42,3 +57,260 @@ def test_conversion():
         express_measure(0, "Mass")
     run_application(fn)
 
+
+def test_wire():
+    register_codecs(conscan.messages.message_codecs)
+    register_codecs(iterative.algorithms.messages.message_codecs)
+    # registering twice is harmless
+    register_codecs(conscan.messages.message_codecs)
+
+    connection = Connection(frozenset([(1, 2), (5, 3)]))
+    connection.transformation = Complete(
+        Rotation.from_properties(0.3, [1, 1, 0], True).r,
+        numpy.array([0.1, -2.0, 5.0]),
+    )
+    connection.quality = 2.5
+    connection.invertible = True
+    rotation_connection = Connection(frozenset([(0, 4)]))
+    rotation_connection.transformation = Rotation.from_properties(1.2, [0, 1, 1], False)
+    rotation_connection.quality = 1.0
+    rotation_connection.invertible = False
+    translation_connection = Connection(frozenset())
+    translation_connection.transformation = Translation(numpy.array([0.0, 1.5, -1.0]))
+    translation_connection.quality = 0.5
+    translation_connection.invertible = False
+    status = Status()
+    status.step = 12
+    status.progress = 0.25
+    status.value = 3.5
+    status.num_shakes = 2
+    status.state = numpy.random.normal(0, 1, 30)
+    # attributes without a dedicated place in the payload
+    other_status = Status()
+    other_status.step = 0
+    other_status.value = None
+    other_status.best_start = 3
+
+    f = StringIO()
+    messages = [
+        ProgressMessage("comp_env", 5, 10), ConnectionPreview(1.5, 3, 7),
+        connection, status, (4, 8, 9), rotation_connection,
+        translation_connection, other_status,
+    ]
+    for message in messages:
+        write_message(f, message)
+    f.seek(0)
+    received = [read_message(f) for message in messages]
+    try:
+        read_message(f)
+        assert False
+    except EOFError:
+        pass
+
+    assert received[0].label == "comp_env"
+    assert received[0].progress == 5
+    assert received[0].maximum == 10
+    assert received[1].quality == 1.5
+    assert received[1].size == 3
+    assert received[1].key == 7
+    assert received[2].pairs == connection.pairs
+    assert received[2].quality == connection.quality
+    assert received[2].invertible
+    assert received[2].transformation.compare(connection.transformation)
+    assert received[3].step == 12
+    assert received[3].progress == 0.25
+    assert received[3].value == 3.5
+    assert received[3].num_shakes == 2
+    assert (received[3].state == status.state).all()
+    assert received[4] == (4, 8, 9)
+    assert received[5].transformation.__class__ == Rotation
+    assert received[5].transformation.compare(rotation_connection.transformation)
+    assert received[6].transformation.__class__ == Translation
+    assert received[6].transformation.compare(translation_connection.transformation)
+    assert received[6].pairs == frozenset()
+    assert received[7].__dict__ == {"step": 0, "value": None, "best_start": 3}
+
+
+def test_serve():
+    def handle(job, send):
+        if job < 0:
+            raise ValueError("negative job")
+        send(job*2)
+
+    f_in = StringIO()
+    for job in 3, -1, 5:
+        write_message(f_in, job)
+    f_in.seek(0)
+    f_out = StringIO()
+    serve(handle, f_in, f_out)
+    f_out.seek(0)
+
+    assert read_message(f_out) == 6
+    done = read_message(f_out)
+    assert isinstance(done, JobDone)
+    assert done.error is None
+    done = read_message(f_out)
+    assert "negative job" in done.error
+    assert read_message(f_out) == 10
+    assert read_message(f_out).error is None
+
+
+def test_serve_cancel():
+    # cancel a job while the worker is blocked in a large write
+    big = "x"*(1 << 22)
+    def handle(job, send):
+        send("started")
+        send(big)
+        for counter in xrange(1000):
+            send(counter)
+            time.sleep(0.01)
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            f_in = StringIO()
+            write_message(f_in, None)
+            f_in.seek(0)
+            serve(handle, f_in, os.fdopen(w, "wb"))
+        finally:
+            os._exit(0)
+    os.close(w)
+    f_out = os.fdopen(r, "rb")
+    try:
+        assert read_message(f_out) == "started"
+        # The worker is blocked in the large write. The first signal only
+        # shortens the current system call, the next ones arrive while the
+        # pipe is full and used to fail with EINTR.
+        for counter in xrange(3):
+            time.sleep(0.1)
+            os.kill(pid, signal.SIGUSR1)
+        assert read_message(f_out) == big
+        while True:
+            message = read_message(f_out)
+            if isinstance(message, JobDone):
+                break
+        assert message.error is None
+        assert message.cancelled
+    finally:
+        f_out.close()
+        os.waitpid(pid, 0)
+
+
+def test_zml_lazy():
+    def fn():
+        for filename in "core_objects.zml", "precursor.zml", "sod.zml":
+            dumps = []
+            for lazy in False, True:
+                f = file("test/input/%s" % filename)
+                root = load_from_file(f, lazy)
+                f.close()
+                f = StringIO()
+                dump_to_file(f, root)
+                dumps.append(f.getvalue())
+            assert dumps[0] == dumps[1]
+    run_application(fn)
+
+
+def test_zml_parse_numbers():
+    def check(content, dtype, expected):
+        result = parse_numbers(content)
+        assert result.dtype == dtype
+        assert result.shape == (len(expected),)
+        assert (result == numpy.array(expected, dtype)).all()
+
+    check("", float, [])
+    check("True False\nTrue", bool, [True, False, True])
+    check("1 2\n3", int, [1, 2, 3])
+    check("-1 0 -20", int, [-1, 0, -20])
+    check("0.5 -1e-3 2E4", float, [0.5, -1e-3, 2e4])
+    # an integer first word does not force the rest into integers
+    check("1 2.5", float, [1.0, 2.5])
+    # integers that do not fit in an int64 are read as floats
+    check("%i 1" % 2**70, float, [2.0**70, 1.0])
+    result = parse_numbers("nan inf -inf 1")
+    assert result.dtype == float
+    assert numpy.isnan(result[0])
+    assert (result[1:] == [numpy.inf, -numpy.inf, 1.0]).all()
+
+
+def test_zml_lazy_tree_view():
+    def fn():
+        model = context.application.model
+        model.file_open("test/input/core_objects.zml")
+        # the frame is loaded because the saved selection refers to its
+        # children, the nested folder is not.
+        frame = model.universe.children[3]
+        assert not frame.has_deferred_children()
+        assert model.iter_n_children(frame.iter) == len(frame.children)
+        folder = model.folder.children[1]
+        assert folder.has_deferred_children()
+        assert model.iter_n_children(folder.iter) == 1
+        assert model.get_value(model.iter_children(folder.iter), 0) is None
+        # expanding the folder creates its children
+        context.application.main.tree_view.expand_row(model.get_path(folder.iter), False)
+        assert not folder.has_deferred_children()
+        assert len(folder.children) == 2
+        assert [
+            model.get_value(model.iter_nth_child(folder.iter, index), 0)
+            for index in xrange(model.iter_n_children(folder.iter))
+        ] == folder.children
+        for child in folder.children:
+            assert child.parent == folder
+    run_application(fn)
+
+
+def test_copy_model_objects():
+    def fn():
+        f = file("test/input/core_objects.zml")
+        universe, folder = load_from_file(f)
+        f.close()
+        for originals in [universe.children, universe.children[1:], folder.children]:
+            copies = copy_model_objects(originals)
+            for copy in copies:
+                assert copy not in originals
+            # compare with a round trip through ZML
+            f = StringIO()
+            dump_to_file(f, originals)
+            f.seek(0)
+            loaded = load_from_file(f)
+            dumps = []
+            for nodes in copies, loaded:
+                f = StringIO()
+                dump_to_file(f, nodes)
+                dumps.append(f.getvalue())
+            assert dumps[0] == dumps[1]
+    run_application(fn)
+
+
+def test_dump_referent_chain():
+    def fn():
+        f = file("test/input/core_objects.zml")
+        universe, folder = load_from_file(f)
+        f.close()
+        SavedSelection = context.application.plugins.get_node("SavedSelection")
+        box, sphere, arrow, frame = universe.children[:4]
+        point, frame_arrow = frame.children
+        # a chain of referents that starts with an arrow to the box
+        first = SavedSelection(targets=[arrow])
+        second = SavedSelection(targets=[first, sphere])
+        third = SavedSelection(targets=[second])
+        kept = SavedSelection(targets=[sphere, frame, point])
+        # the box is left out
+        nodes = [sphere, arrow, frame, first, second, third, kept]
+        identifiers = index_model_objects(nodes)
+        for dropped in arrow, frame_arrow, first, second, third:
+            assert dropped not in identifiers
+        assert set(identifiers) == set([sphere, frame, point, kept])
+        # the references between the kept objects survive a round trip
+        f = StringIO()
+        dump_to_file(f, nodes)
+        f.seek(0)
+        loaded = load_from_file(f)
+        assert [node.class_name() for node in loaded] == ["Sphere", "Frame", "SavedSelection"]
+        loaded_sphere, loaded_frame, loaded_kept = loaded
+        assert len(loaded_frame.children) == 1
+        loaded_point = loaded_frame.children[0]
+        assert loaded_kept.get_targets() == [loaded_sphere, loaded_frame, loaded_point]
+    run_application(fn)
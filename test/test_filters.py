@@ -47,6 +47,7 @@ def helper_file_open(filename):
 
 def test_open_zml():
     helper_file_open("core_objects.zml")
+    helper_file_open("lau_double.zml")
     # old file formats
     helper_file_open("format1_0.1.zml")
     helper_file_open("format2_0.1.zml")
@@ -79,6 +80,22 @@ def helper_file_save(in_filename, out_filename):
 def test_save_zml():
     helper_file_save("core_objects.zml", "core_objects.zml")
 
+def test_save_zmlb():
+    helper_file_save("core_objects.zml", "core_objects.zmlb")
+    helper_file_save("lau.zml", "lau.zmlb.gz")
+    def fn():
+        context.application.model.file_open("test/output/core_objects.zmlb")
+        context.application.model.file_open("test/output/lau.zmlb.gz")
+    run_application(fn)
+    # save back to the file that was just opened
+    def fn():
+        context.application.model.file_open("test/output/core_objects.zmlb")
+        context.application.model.file_save("test/output/core_objects.zmlb")
+        context.application.model.file_open("test/output/core_objects.zmlb")
+        universe = context.application.model.universe
+        universe.cell.matrix.sum()
+    run_application(fn)
+
 def test_save_xyz():
     helper_file_save("tpa.zml", "tpa.xyz")
 
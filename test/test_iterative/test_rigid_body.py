@@ -127,6 +127,57 @@ def define_cost_function2():
     return cost_function
 
 
+def define_cost_function3(spring_set, frame_class=iterative.var.Frame, parse=True):
+    # a mix of a rotating frame, a Translation and a fixed point, either with
+    # separate Spring terms or with one SpringSet. The rotating frame is a
+    # Frame with an Orthonormality constraint or an ExponentialFrame.
+    cost_function = iterative.expr.Root(1, 5, True)
+
+    frame1 = frame_class(
+        numpy.array([
+            [ 0.0, -1.0 , 0.0],
+            [ 1.0,  0.0,  0.0],
+            [ 0.0,  0.0,  1.0],
+        ], float),
+        numpy.array([1.0, 0.0, 0.0], float)
+    )
+    cost_function.register_state_variable(frame1)
+    if frame_class == iterative.var.Frame:
+        constraint1 = iterative.expr.Orthonormality(1e-6)
+        constraint1.register_input_variable(frame1)
+
+    frame2 = iterative.var.Translation(
+        numpy.array([
+            [ 1.0,  0.0,  0.0],
+            [ 0.0,  0.0, -1.0],
+            [ 0.0,  1.0,  0.0],
+        ], float),
+        numpy.array([0.0, 0.0, -3.0], float)
+    )
+    cost_function.register_state_variable(frame2)
+
+    springs = [
+        (frame1, numpy.array([ 0.0,  2.0,  1.2]), frame2, numpy.array([-3.0,  2.0,  1.2]), 0.5),
+        (frame2, numpy.array([-1.0,  0.5,  0.0]), frame1, numpy.array([ 0.0, -1.2,  0.5]), 0.0),
+        (frame1, numpy.array([ 0.7, -2.0, -0.3]), frame2, numpy.array([ 1.5,  0.0, -2.7]), 0.5),
+        (iterative.expr.NoFrame(), numpy.array([ 0.7, -2.0, -0.3]), frame2, numpy.array([ 1.5,  0.0, -2.7]), 0.2),
+        (frame1, numpy.array([ 0.3,  1.0, -0.3]), iterative.expr.NoFrame(), numpy.array([ 2.5,  1.0, -1.7]), 0.0),
+    ]
+    if spring_set:
+        spring_set = iterative.expr.SpringSet()
+        for variable1, coordinate1, variable2, coordinate2, rest_length in springs:
+            spring_set.add_spring(variable1, coordinate1, variable2, coordinate2, rest_length)
+    else:
+        for variable1, coordinate1, variable2, coordinate2, rest_length in springs:
+            spring = iterative.expr.Spring(rest_length)
+            spring.register_input_variable(variable1, coordinate1)
+            spring.register_input_variable(variable2, coordinate2)
+
+    if parse:
+        cost_function.parse_input()
+    return cost_function
+
+
 def report(status):
     pass
     #print status.step, status.value
@@ -204,3 +255,318 @@ def test_constraint_derivatives():
         overlap = (numpy.dot(cluster.constraint_derivatives, cluster.state_derivatives)**2).sum()
         assert overlap < 1e-5
 
+
+def test_spring_set():
+    expressions = [define_cost_function3(spring_set) for spring_set in False, True]
+    for expr in expressions:
+        expr.clear()
+        expr.add_outputs()
+        expr.add_derivatives()
+    assert abs(expressions[0].outputs[0] - expressions[1].outputs[0]) < 1e-10
+    assert abs(expressions[0].derivatives - expressions[1].derivatives).max() < 1e-10
+    assert abs(expressions[0].mass - expressions[1].mass).max() < 1e-10
+
+
+def test_minimize_noincrease3_conjugate_gradient():
+    cost_function = define_cost_function3(True)
+
+    minimize = iterative.alg.ConjugateGradient(
+        cost_function,
+        numpy.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float),
+        1e-5,
+    )
+    minimize.run(report)
+
+
+def test_orthonormality_batch():
+    frame_states = numpy.random.normal(0, 1, (4, 12))
+    outputs, derivatives = iterative.expr.Orthonormality.compute_batch(frame_states)
+    assert outputs.shape == (4, 6)
+    assert derivatives.shape == (4, 6, 12)
+    epsilon = 1e-6
+    for index in xrange(12):
+        delta = numpy.zeros(12, float)
+        delta[index] = epsilon
+        outputs_plus = iterative.expr.Orthonormality.compute_batch(frame_states + delta)[0]
+        outputs_min = iterative.expr.Orthonormality.compute_batch(frame_states - delta)[0]
+        numerical = (outputs_plus - outputs_min)/(2*epsilon)
+        assert abs(numerical - derivatives[:,:,index]).max() < 1e-6
+
+
+def test_exponential_frame_equivalence():
+    # without rotation, the energy must be the same as with a Frame
+    expr_matrix = define_cost_function3(True)
+    expr_vector = define_cost_function3(True, iterative.var.ExponentialFrame)
+    for expr in expr_matrix, expr_vector:
+        expr.clear()
+        expr.add_outputs()
+    assert abs(expr_matrix.outputs[0] - expr_vector.outputs[0]) < 1e-10
+
+
+def test_exponential_frame_derivatives():
+    for spring_set in False, True:
+        expr = define_cost_function3(spring_set, iterative.var.ExponentialFrame)
+        expr.state[:] += numpy.random.normal(0, 0.5, expr.state.shape)
+        expr.clear()
+        expr.add_derivatives()
+        analytical = expr.derivatives.copy()
+        epsilon = 1e-6
+        state = expr.state.copy()
+        for index in xrange(len(state)):
+            values = []
+            for sign in 1, -1:
+                expr.state[:] = state
+                expr.state[index] += sign*epsilon
+                expr.clear()
+                expr.add_outputs()
+                values.append(expr.outputs[0])
+            numerical = (values[0] - values[1])/(2*epsilon)
+            assert abs(numerical - analytical[index]) < 1e-5
+
+
+def test_rotation_vectors_to_matrices():
+    rotation_vectors = numpy.concatenate([
+        numpy.random.normal(0, 1, (5, 3)),
+        numpy.random.normal(0, 1e-3, (5, 3)),
+        numpy.zeros((1, 3)),
+    ])
+    matrices, derivatives = iterative.var.rotation_vectors_to_matrices(rotation_vectors, True)
+    for matrix in matrices:
+        assert abs(numpy.dot(matrix, matrix.transpose()) - numpy.identity(3)).max() < 1e-10
+        assert abs(numpy.linalg.det(matrix) - 1) < 1e-10
+    epsilon = 1e-6
+    for index in xrange(3):
+        delta = numpy.zeros(3, float)
+        delta[index] = epsilon
+        numerical = (
+            iterative.var.rotation_vectors_to_matrices(rotation_vectors + delta) -
+            iterative.var.rotation_vectors_to_matrices(rotation_vectors - delta)
+        )/(2*epsilon)
+        assert abs(numerical - derivatives[:,index]).max() < 1e-8
+
+
+def test_minimize_noincrease3_exponential_conjugate_gradient():
+    cost_function = define_cost_function3(True, iterative.var.ExponentialFrame)
+
+    minimize = iterative.alg.ConjugateGradient(
+        cost_function,
+        numpy.array([0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float),
+        1e-5,
+    )
+    minimize.run(report)
+
+
+def check_lbfgs(cost_function, max_step):
+    minimize = iterative.alg.LBFGS(cost_function, max_step, 1e-5)
+    values = []
+    minimize.run(lambda status: values.append(status.value))
+    assert len(values) > 1
+    for value1, value2 in zip(values[:-1], values[1:]):
+        assert value2 <= value1
+    return values[-1]
+
+
+def test_minimize_noincrease1_lbfgs():
+    check_lbfgs(
+        define_cost_function1(),
+        numpy.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0]*2, float),
+    )
+
+
+def test_minimize_noincrease2_lbfgs():
+    value = check_lbfgs(
+        define_cost_function2(),
+        numpy.array([1.0, 1.0, 1.0]*2, float),
+    )
+    # compare with the result of the conjugate gradient method
+    cost_function = define_cost_function2()
+    minimize = iterative.alg.ConjugateGradient(
+        cost_function,
+        numpy.array([1.0, 1.0, 1.0]*2, float),
+        1e-5,
+    )
+    minimize.run(report)
+    assert abs(value - minimize.status.value) < 1e-6
+
+
+def test_minimize_noincrease3_exponential_lbfgs():
+    check_lbfgs(
+        define_cost_function3(True, iterative.var.ExponentialFrame),
+        numpy.array([0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float),
+    )
+
+
+class FixedDistance(iterative.expr.Constraint):
+    # a constraint between two Translation variables that couples all the
+    # variables in a chain into one cluster
+    output_dimension = 1
+
+    def __init__(self, distance, convergence_threshold):
+        iterative.expr.Constraint.__init__(self, convergence_threshold)
+        self.distance = distance
+
+    def add_outputs(self):
+        delta = self.input_variables[0].translation_vector - self.input_variables[1].translation_vector
+        self.outputs[0] += numpy.dot(delta, delta) - self.distance**2
+
+    def add_derivatives(self):
+        delta = self.input_variables[0].translation_vector - self.input_variables[1].translation_vector
+        self.derivatives[0][0] += 2*delta
+        self.derivatives[1][0] -= 2*delta
+
+
+def define_cost_function4(sparse_threshold):
+    numpy.random.seed(5)
+    cost_function = iterative.expr.Root(1, 10, True, sparse_threshold)
+    variables = []
+    for index in xrange(30):
+        variable = iterative.var.Translation(
+            numpy.identity(3), numpy.array([index, 0.0, 0.0]) + numpy.random.normal(0, 0.01, 3)
+        )
+        cost_function.register_state_variable(variable)
+        variables.append(variable)
+    for variable1, variable2 in zip(variables[:-1], variables[1:]):
+        constraint = FixedDistance(1.0, 1e-10)
+        constraint.register_input_variable(variable1)
+        constraint.register_input_variable(variable2)
+    spring_set = iterative.expr.SpringSet()
+    for index, variable in enumerate(variables):
+        spring_set.add_spring(variable, numpy.zeros(3), iterative.expr.NoFrame(), numpy.random.normal(0, 3, 3), 0.0)
+    cost_function.parse_input()
+    return cost_function, variables
+
+
+def test_sparse_constraints():
+    results = []
+    for sparse_threshold in 1000, 1:
+        cost_function, variables = define_cost_function4(sparse_threshold)
+        assert (cost_function.constraint_clusters[0].jacobian is None) == (sparse_threshold == 1000)
+        cost_function.clear()
+        cost_function.add_derivatives()
+        derivatives = numpy.array([variable.derivatives.copy() for variable in variables])
+        for variable in variables:
+            variable.state[:] += numpy.random.normal(0, 0.01, 3)
+        cost_function.shake()
+        state = numpy.array([variable.state.copy() for variable in variables])
+        results.append((derivatives, state))
+    assert abs(results[0][0] - results[1][0]).max() < 1e-8
+    assert abs(results[0][1] - results[1][1]).max() < 1e-8
+
+
+def test_incremental_outputs():
+    for define_cost_function in define_cost_function1, lambda: define_cost_function3(True, iterative.var.ExponentialFrame), lambda: define_cost_function4(1000)[0]:
+        cost_function = define_cost_function()
+        for counter in xrange(5):
+            # change only one of the variables
+            variable = cost_function.state_variables[counter % len(cost_function.state_variables)]
+            variable.state[:] += numpy.random.normal(0, 0.1, variable.dimension)
+            cost_function.clear_outputs()
+            cost_function.add_outputs_incremental()
+            incremental = cost_function.outputs[0]
+            cost_function.clear_outputs()
+            cost_function.add_outputs()
+            assert abs(incremental - cost_function.outputs[0]) < 1e-10
+
+
+def test_report_policy():
+    steps = []
+    minimize = iterative.alg.ConjugateGradient(
+        define_cost_function2(),
+        numpy.array([1.0, 1.0, 1.0]*2, float),
+        1e-5,
+    )
+    minimize.set_report_policy(steps=5)
+    minimize.run(lambda status: steps.append(status.step))
+    assert steps[-1] == minimize.status.step
+    for step in steps[:-1]:
+        assert step % 5 == 0
+
+    steps = []
+    minimize = iterative.alg.ConjugateGradient(
+        define_cost_function2(),
+        numpy.array([1.0, 1.0, 1.0]*2, float),
+        1e-5,
+    )
+    minimize.set_report_policy(interval=1e3)
+    minimize.run(lambda status: steps.append(status.step))
+    assert steps == [minimize.status.step]
+
+
+def test_multi_start():
+    minimize = iterative.alg.ConjugateGradient(
+        define_cost_function3(True, iterative.var.ExponentialFrame, parse=False),
+        numpy.array([0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float),
+        1e-5,
+    )
+    multi_start = iterative.alg.MultiStart(minimize, 4, 1.0, 2)
+    multi_start.root_expression.parse_input()
+    values = []
+    multi_start.run(lambda status: values.append(status.value))
+    assert len(values) == 4
+    for value1, value2 in zip(values[:-1], values[1:]):
+        assert value2 <= value1
+    # the state of the best start is copied into the root expression
+    root_expression = multi_start.root_expression
+    root_expression.clear_outputs()
+    root_expression.add_outputs()
+    assert abs(root_expression.outputs[0] - values[-1]) < 1e-10
+
+
+def check_hessian_vector(cost_function):
+    # compare with a central finite difference of the (projected) derivatives
+    assert cost_function.supports_hessian_vector()
+    state = cost_function.state.copy()
+    cost_function.clear()
+    cost_function.add_derivatives()
+    for counter in xrange(3):
+        vector = numpy.random.normal(0, 1, cost_function.state_dimension)
+        if cost_function.constrain_derivatives:
+            # only the tangent space of the constraints is relevant
+            cost_function.project_constraints(vector)
+        hessian_vector = cost_function.compute_hessian_vector(vector)
+        epsilon = 1e-5
+        gradients = []
+        for sign in 1, -1:
+            cost_function.state[:] = state + sign*epsilon*vector
+            cost_function.clear()
+            cost_function.add_derivatives()
+            gradients.append(cost_function.derivatives.copy())
+        cost_function.state[:] = state
+        numerical = (gradients[0] - gradients[1])/(2*epsilon)
+        if cost_function.constrain_derivatives:
+            cost_function.project_constraints(numerical)
+        assert abs(hessian_vector - numerical).max() < 1e-6
+        cost_function.clear()
+        cost_function.add_derivatives()
+
+
+def test_hessian_vector():
+    assert define_cost_function2().supports_hessian_vector()
+    for spring_set in False, True:
+        for constrain_derivatives in False, True:
+            cost_function = define_cost_function3(spring_set)
+            cost_function.constrain_derivatives = constrain_derivatives
+            check_hessian_vector(cost_function)
+        cost_function = define_cost_function3(spring_set, iterative.var.ExponentialFrame)
+        cost_function.state[:] += numpy.random.normal(0, 0.5, cost_function.state.shape)
+        check_hessian_vector(cost_function)
+    # constraints without second derivatives
+    assert not define_cost_function4(1000)[0].supports_hessian_vector()
+
+
+def test_minimize_noincrease_truncated_newton():
+    # analytic Hessian-vector products, also for the rotating frames, and
+    # finite differences for constraints without second derivatives
+    for cost_function, max_step, analytic in [
+        (define_cost_function2(), numpy.array([1.0, 1.0, 1.0]*2, float), True),
+        (define_cost_function3(True), numpy.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float), True),
+        (define_cost_function3(True, iterative.var.ExponentialFrame), numpy.array([0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float), True),
+        (define_cost_function4(1000)[0], numpy.ones(90, float), False),
+    ]:
+        values = []
+        minimize = iterative.alg.TruncatedNewton(cost_function, max_step, 1e-5)
+        minimize.run(lambda status: values.append(status.value))
+        assert minimize.analytic_hessian == analytic
+        assert len(values) > 1
+        for value1, value2 in zip(values[:-1], values[1:]):
+            assert value2 <= value1
@@ -81,6 +81,10 @@ class Drag(object):
 
         destination_iter = model.get_iter(destination_path)
         destination = model.get_value(destination_iter, 0)
+        if destination is None:
+            # the placeholder of deferred children
+            drag_context.finish(False, False, timestamp)
+            return
         if (pos == gtk.TREE_VIEW_DROP_INTO_OR_BEFORE) or (pos == gtk.TREE_VIEW_DROP_INTO_OR_AFTER):
             # We assume that the user dropped on top if the item, doesn't always work
             #print "TRY DROP Into"
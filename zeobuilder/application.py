@@ -63,6 +63,8 @@ class Application(object):
         gobject.idle_add(self.after_gui)
         gtk.main()
 
+        from zeobuilder.child_process import worker_pool
+        worker_pool.shutdown()
         self.configuration.save_to_file()
 
     def initialize_config(self):
@@ -35,11 +35,61 @@
 from zeobuilder import context
 from zeobuilder.application import TestApplication
 from zeobuilder.gui.simple import ok_error
+from zeobuilder.wire import read_message, write_message, JobDone
 
-import gobject, gtk, subprocess, cPickle, gobject, os
+import gobject, gtk, subprocess, cPickle, gobject, os, signal
 
 
-__all__ = ["ChildProcessDialog"]
+__all__ = ["ChildProcessDialog", "WorkerPool", "worker_pool"]
+
+
+def get_child_environment():
+    # configure python path to include the current directory.
+    # this is needed for the tests.
+    env = dict(os.environ)
+    python_path = env.get('PYTHONPATH')
+    if python_path is None:
+        python_path = os.getcwd()
+    else:
+        python_path += ':' + os.getcwd()
+    env['PYTHONPATH'] = python_path
+    return env
+
+
+class WorkerPool(object):
+    """Keeps helper processes alive in between jobs
+
+    The helpers must process jobs with zeobuilder.wire.serve. This avoids the
+    startup cost of the Python interpreter and the imports for each job.
+    """
+    def __init__(self):
+        self.idle = {}
+
+    def acquire(self, args):
+        workers = self.idle.get(tuple(args), [])
+        while len(workers) > 0:
+            process = workers.pop()
+            if process.poll() is None:
+                return process
+        #print >> sys.stderr, "ZEOBUILDER, spawn worker"
+        return subprocess.Popen(
+            args, bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            env=get_child_environment(),
+        )
+
+    def release(self, args, process):
+        if process.poll() is None:
+            self.idle.setdefault(tuple(args), []).append(process)
+
+    def shutdown(self):
+        for workers in self.idle.itervalues():
+            for process in workers:
+                process.stdin.close()
+                process.wait()
+        self.idle.clear()
+
+
+worker_pool = WorkerPool()
 
 
 class ChildProcessDialog(object):
@@ -49,42 +99,60 @@ class ChildProcessDialog(object):
         self.buttons = buttons
         self.response_active = False
 
-    def run(self, args, input_data, pickle=False):
+    def run(self, args, input_data, pickle=False, framed=False, persistent=False):
+        """Run a child process and process its output
+
+        When pickle is True, the input data is pickled, otherwise it is
+        written as a string. When framed is True, the output of the child
+        process is read as a series of messages, see zeobuilder.wire.
+        Otherwise, the output is read either as pickled objects (pickle=True)
+        or as lines of text.
+
+        When persistent is True, the input data is sent as a job to a worker
+        from worker_pool and the output is always framed. The job can be
+        cancelled while it is running.
+        """
         self.response_active = False
         self.error_lines = []
         self.pickle = pickle
+        self.framed = framed
+        self.persistent = persistent
+        self.cancelled = False
 
         for button in self.buttons:
-            button.set_sensitive(False)
-
-        # configure python path to include the current directory.
-        # this is needed for the tests.
-        env = dict(os.environ)
-        python_path = env.get('PYTHONPATH')
-        if python_path is None:
-            python_path = os.getcwd()
-        else:
-            python_path += ':' + os.getcwd()
-        env['PYTHONPATH'] = python_path
-
-        #print >> sys.stderr, "ZEOBUILDER, spawn process"
-        self.process = subprocess.Popen(
-            args, bufsize=0, stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env,
-        )
-        if self.pickle:
-            cPickle.dump(input_data, self.process.stdin, -1)
+            if persistent and self.dialog.get_response_for_widget(button) == gtk.RESPONSE_CANCEL:
+                button.set_sensitive(True)
+            else:
+                button.set_sensitive(False)
+
+        if persistent:
+            self.args = args
+            self.process = worker_pool.acquire(args)
+            write_message(self.process.stdin, input_data)
+            self.process.stdin.flush()
+            self.event_sources = [
+                gobject.io_add_watch(self.process.stdout, gobject.IO_IN, self._on_receive_job, priority=200),
+                gobject.io_add_watch(self.process.stdout, gobject.IO_HUP, self._on_worker_died, priority=200),
+            ]
         else:
-            self.process.stdin.write(input_data)
-        self.process.stdin.close()
+            #print >> sys.stderr, "ZEOBUILDER, spawn process"
+            self.process = subprocess.Popen(
+                args, bufsize=0, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=get_child_environment(),
+            )
+            if self.pickle:
+                cPickle.dump(input_data, self.process.stdin, -1)
+            else:
+                self.process.stdin.write(input_data)
+            self.process.stdin.close()
 
-        #print >> sys.stderr, "ZEOBUILDER, add io_watch"
-        self.event_sources = [
-            gobject.io_add_watch(self.process.stdout, gobject.IO_IN, self._on_receive_out, priority=200),
-            gobject.io_add_watch(self.process.stdout, gobject.IO_HUP, self._on_done, priority=200),
-            gobject.io_add_watch(self.process.stderr, gobject.IO_IN, self._on_receive_err, priority=200),
-        ]
+            #print >> sys.stderr, "ZEOBUILDER, add io_watch"
+            self.event_sources = [
+                gobject.io_add_watch(self.process.stdout, gobject.IO_IN, self._on_receive_out, priority=200),
+                gobject.io_add_watch(self.process.stdout, gobject.IO_HUP, self._on_done, priority=200),
+                gobject.io_add_watch(self.process.stderr, gobject.IO_IN, self._on_receive_err, priority=200),
+            ]
 
         self.dialog.set_transient_for(context.parent_window)
         result = self.response_loop()
@@ -96,12 +164,22 @@ class ChildProcessDialog(object):
     def response_loop(self):
         response = self.dialog.run()
         while not self.response_active:
+            if self.persistent and not self.cancelled and \
+               response in (gtk.RESPONSE_CANCEL, gtk.RESPONSE_DELETE_EVENT):
+                self.cancel()
             response = self.dialog.run()
             #print >> sys.stderr, "DIALOG CLOSED", response
         return response
 
+    def cancel(self):
+        """Interrupt the running job, the worker process stays alive"""
+        self.cancelled = True
+        os.kill(self.process.pid, signal.SIGUSR1)
+
     def _on_receive_out(self, source, condition):
-        if self.pickle:
+        if self.framed:
+            data = read_message(self.process.stdout)
+        elif self.pickle:
             data = cPickle.load(self.process.stdout)
         else:
             data = self.process.stdout.readline()
@@ -155,6 +233,36 @@ class ChildProcessDialog(object):
 
         return False
 
+    def _on_receive_job(self, source, condition):
+        data = read_message(self.process.stdout)
+        if isinstance(data, JobDone):
+            self._on_job_done(data)
+            return False
+        self.on_receive(data)
+        return True
+
+    def _on_worker_died(self, source, condition):
+        self.process.wait()
+        self._on_job_done(JobDone(error="The child process terminated unexpectedly."))
+        return False
+
+    def _on_job_done(self, done):
+        self.response_active = True
+        for button in self.buttons:
+            button.set_sensitive(True)
+
+        for source in self.event_sources:
+            gobject.source_remove(source)
+        worker_pool.release(self.args, self.process)
+
+        if done.error is not None:
+            ok_error("An error occured in the child process.", done.error)
+
+        if done.cancelled:
+            self.dialog.response(gtk.RESPONSE_CANCEL)
+        elif isinstance(context.application, TestApplication):
+            self.dialog.response(gtk.RESPONSE_OK)
+
     def on_receive(self, data):
         raise NotImplementedError
 
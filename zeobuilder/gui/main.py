@@ -33,7 +33,7 @@
 
 
 from zeobuilder import context
-from zeobuilder.nodes.parent_mixin import ParentMixin
+from zeobuilder.nodes.parent_mixin import ParentMixin, ContainerMixin
 from zeobuilder.gui.simple import nosave_cancel_save_question, ok_error
 from zeobuilder.gui.glade_wrapper import GladeWrapper
 from zeobuilder.gui.visual.drawing_area import DrawingArea
@@ -74,6 +74,7 @@ class Main(GladeWrapper):
         self.tree_view.set_headers_visible(False)
         self.tree_view.connect("button-press-event", self.on_tree_view_button_press_event)
         self.tree_view.connect("row-collapsed", self.on_row_collapsed)
+        self.tree_view.connect("test-expand-row", self.on_test_expand_row)
 
         self.tree_selection = self.tree_view.get_selection()
         self.tree_selection.set_mode(gtk.SELECTION_MULTIPLE)
@@ -91,13 +92,21 @@ class Main(GladeWrapper):
         self.column = gtk.TreeViewColumn()
         self.column.pack_start(renderer_pixbuf, expand=False)
         def render_icon(column, cell, model, iter):
-            cell.set_property('pixbuf', model.get_value(iter, 0).icon)
+            node = model.get_value(iter, 0)
+            if node is None: # the placeholder of deferred children
+                cell.set_property('pixbuf', None)
+            else:
+                cell.set_property('pixbuf', node.icon)
         self.column.set_cell_data_func(renderer_pixbuf, render_icon)
 
         renderer_text = gtk.CellRendererText()
         self.column.pack_start(renderer_text, expand=False)
         def render_name(column, cell, model, iter):
-            cell.set_property('text', model.get_value(iter, 0).get_name())
+            node = model.get_value(iter, 0)
+            if node is None:
+                cell.set_property('text', "Loading...")
+            else:
+                cell.set_property('text', node.get_name())
         self.column.set_cell_data_func(renderer_text, render_name)
         self.tree_view.append_column(self.column)
         self.tree_view.set_expander_column(self.column)
@@ -202,6 +211,7 @@ class Main(GladeWrapper):
 
     def select_path(self, path):
         node = context.application.model[path][0]
+        if node is None: return False
         is_selected = self.tree_selection.path_is_selected(path)
         try:
             if not (
@@ -217,11 +227,21 @@ class Main(GladeWrapper):
         node.set_selected(not is_selected)
         return True
 
+    def on_test_expand_row(self, tree_view, iter, path):
+        # the children of containers from a lazily loaded file are created
+        # when the container is expanded for the first time.
+        node = context.application.model.get_value(iter, 0)
+        if isinstance(node, ContainerMixin):
+            node.load_deferred_children()
+        return False
+
     def on_row_collapsed(self, tree_view, iter, path):
         # unselect all the nodes that are no longer visible in the tree. The
         # tree_selection is updated by gtk, but the selection attribute of the
         # nodes must be updated here:
         def recursive_unselect_children(node):
+            if isinstance(node, ContainerMixin) and node.has_deferred_children():
+                return
             for child in node.children:
                 child.set_selected(False)
                 if isinstance(child, ParentMixin):
@@ -270,9 +290,9 @@ class Main(GladeWrapper):
             return True
         elif event.button == 1:
             if event.type == gtk.gdk._2BUTTON_PRESS:
-                context.application.action_manager.default_action(
-                    context.application.model[path][0]
-                )
+                node = context.application.model[path][0]
+                if node is not None:
+                    context.application.action_manager.default_action(node)
                 return True
         return False
 
@@ -64,4 +64,13 @@ class Model(ModelBase, gtk.TreeStore):
             node.cleanup_gl()
         del node.iter
 
+    def add_deferred(self, node):
+        # an empty row makes the node expandable, see
+        # ContainerMixin.load_deferred_children
+        node.deferred_iter = self.append(node.iter, [None])
+
+    def remove_deferred(self, node):
+        self.remove(node.deferred_iter)
+        del node.deferred_iter
+
 
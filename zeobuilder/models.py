@@ -88,6 +88,12 @@ class Model(gobject.GObject):
     def remove_node(self, node):
         pass
 
+    def add_deferred(self, node):
+        pass
+
+    def remove_deferred(self, node):
+        pass
+
     def clear(self):
         while len(self.root) > 0:
             victim = self.root[0]
@@ -65,6 +65,11 @@ class GLContainerMixin(ContainerMixin):
         if not issubclass(ModelObjectClass, GLMixin): return False
         return True
 
+    def load_deferred_children(self):
+        if self.has_deferred_children():
+            ContainerMixin.load_deferred_children(self)
+            self.invalidate_all_lists()
+
     #
     # Draw
     #
@@ -77,6 +82,9 @@ class GLContainerMixin(ContainerMixin):
         vb.set_bright(False)
 
     def draw(self):
+        # deferred children are only drawn after they are loaded, e.g. when
+        # the container is expanded in the tree view.
+        if self.has_deferred_children(): return
         for child in self.children:
             child.call_list()
 
@@ -86,6 +94,7 @@ class GLContainerMixin(ContainerMixin):
     #
 
     def revalidate_bounding_box(self):
+        if self.has_deferred_children(): return
         for child in self.children:
             child_bounding_box = child.get_bounding_box_in_parent_frame()
             if child_bounding_box.corners is not None:
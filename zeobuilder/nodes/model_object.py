@@ -33,16 +33,24 @@
 
 from zeobuilder.nodes.node import Node, NodeInfo
 from zeobuilder.nodes.meta import Property
+from zeobuilder.nodes.parent_mixin import ParentMixin, ContainerMixin, ReferentMixin
 from zeobuilder.gui.fields_dialogs import DialogFieldInfo
+from zeobuilder.undefined import Undefined
+from zeobuilder.expressions import Expression
 import zeobuilder.gui.fields as fields
 import zeobuilder.actions.primitive as primitive
 
+from molmod import Translation, Rotation, Complete, UnitCell
+
 import gobject
 
-import numpy
+import numpy, types, copy, StringIO
 
 
-__all__ = ["ModelObject", "ModelObjectInfo"]
+__all__ = [
+    "ModelObject", "ModelObjectInfo", "index_model_objects",
+    "copy_model_objects"
+]
 
 
 class ModelObjectInfo(NodeInfo):
@@ -164,3 +172,104 @@ class ModelObject(Node):
 gobject.signal_new("on-move", ModelObject, gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
 
 
+
+
+def index_model_objects(node):
+    """Return a dictionary with a serial number for each model object in node
+
+    node can be a model object or a (nested) list of model objects, and the
+    children of containers are included. Referents whose targets are not all
+    included are left out, together with the referents that depend on them.
+    """
+    identifiers = {}
+    # for each target, the referents that refer to it
+    referents = {}
+
+    def collect(node):
+        cls = node.__class__
+        if issubclass(cls, ModelObject):
+            identifiers[node] = len(identifiers)
+            if issubclass(cls, ContainerMixin):
+                for child in node.children:
+                    collect(child)
+            if issubclass(cls, ReferentMixin):
+                for child in node.children:
+                    dependents = referents.get(child.target)
+                    if dependents is None:
+                        dependents = []
+                        referents[child.target] = dependents
+                    dependents.append(node)
+        elif cls == list:
+            for item in node:
+                collect(item)
+
+    collect(node)
+    to_be_deleted = []
+    for target, dependents in referents.iteritems():
+        if target not in identifiers:
+            to_be_deleted.extend(dependents)
+    while len(to_be_deleted) > 0:
+        model_object = to_be_deleted.pop()
+        if model_object in identifiers:
+            del identifiers[model_object]
+            to_be_deleted.extend(referents.get(model_object, []))
+    return identifiers
+
+
+def copy_model_objects(nodes):
+    """Return deep copies of a list of model objects
+
+    The result is the same as a round trip through ZML, without the
+    serialization. The copies are made with __getstate__ and initstate.
+    References between the original objects become references between the
+    copies, and referents whose targets are not copied are left out.
+    """
+    identifiers = index_model_objects(nodes)
+    originals = sorted(identifiers, key=identifiers.get)
+    copies = dict((original, original.__class__()) for original in originals)
+
+    def keep(value):
+        if isinstance(value, ModelObject):
+            return value in copies
+        return not isinstance(value, Undefined)
+
+    def copy_value(value):
+        cls = type(value)
+        if cls == types.InstanceType: cls = value.__class__ # For old style stuff
+
+        if issubclass(cls, ModelObject):
+            return copies[value]
+        elif cls == list:
+            return [copy_value(item) for item in value if keep(item)]
+        elif cls == dict:
+            return dict((key, copy_value(item)) for key, item in value.iteritems() if keep(item))
+        elif cls == tuple:
+            return tuple(copy_value(item) for item in value if keep(item))
+        elif cls == numpy.ndarray:
+            return value.copy()
+        elif cls == StringIO.StringIO:
+            return StringIO.StringIO(value.getvalue())
+        elif cls == Translation:
+            return Translation(value.t.copy())
+        elif cls == Rotation:
+            return Rotation(value.r.copy())
+        elif cls == Complete:
+            return Complete(value.r.copy(), value.t.copy())
+        elif cls == UnitCell:
+            return UnitCell(value.matrix.copy(), value.active.copy())
+        elif cls == Expression:
+            return Expression(value.code)
+        else:
+            return copy.deepcopy(value)
+
+    # first create all the states, then initialize the copies, just like
+    # zeobuilder.zml.ZMLHandler.endDocument
+    states = [copy_value(original.__getstate__()) for original in originals]
+    for original, state in zip(originals, states):
+        copies[original].initstate(**state)
+
+    result = [copies[node] for node in nodes if node in copies]
+    for node in result:
+        if isinstance(node, ParentMixin):
+            node.reparent()
+    return result
@@ -34,7 +34,26 @@
 from meta import NodeClass, Property
 from reference import Reference
 
-__all__ = ["ParentMixin", "ContainerMixin", "ReferentMixin"]
+__all__ = ["DeferredChildren", "ParentMixin", "ContainerMixin", "ReferentMixin"]
+
+
+class DeferredChildren(object):
+    """The children of a container that are only created when they are used
+
+    The function is called without arguments the first time the children are
+    needed, and it must return the list of children. See
+    zeobuilder.zml.load_from_file with lazy=True.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.children = None
+        self.container = None
+
+    def get(self):
+        if self.children is None:
+            self.children = self.function()
+        return self.children
 
 
 class ParentMixin(object):
@@ -73,6 +92,14 @@ class ContainerMixin(ParentMixin):
     #
 
     def set_children(self, children, init=False):
+        if isinstance(children, DeferredChildren):
+            children.container = self
+            if children.children is None:
+                # the children attribute is created by __getattr__
+                self.__dict__.pop("children", None)
+                self.deferred_children = children
+                return
+            children = children.get()
         self.children = children
         if not init:
             for child in self.children:
@@ -85,10 +112,54 @@ class ContainerMixin(ParentMixin):
         Property("children", [], lambda self: self.children, set_children),
     ]
 
+    #
+    # Deferred children
+    #
+
+    def __getattr__(self, name):
+        if name == "children" and "deferred_children" in self.__dict__:
+            self.load_deferred_children()
+            return self.children
+        raise AttributeError(name)
+
+    def has_deferred_children(self):
+        return "deferred_children" in self.__dict__
+
+    def load_deferred_children(self):
+        deferred_children = self.__dict__.pop("deferred_children", None)
+        if deferred_children is not None:
+            self.children = deferred_children.get()
+            ParentMixin.reparent(self)
+            if self.model is not None:
+                self.model.remove_deferred(self)
+                ParentMixin.set_model(self, self.model, None, None)
+
     #
     # Tree
     #
 
+    def set_model(self, model, parent, index):
+        # the model only gets a placeholder for deferred children
+        if self.has_deferred_children():
+            model.add_deferred(self)
+        else:
+            ParentMixin.set_model(self, model, parent, index)
+
+    def unset_model(self):
+        if self.has_deferred_children():
+            self.model.remove_deferred(self)
+        else:
+            ParentMixin.unset_model(self)
+
+    def unparent(self):
+        if not self.has_deferred_children():
+            ParentMixin.unparent(self)
+
+    def reparent(self):
+        # deferred children get their parent when they are loaded
+        if not self.has_deferred_children():
+            ParentMixin.reparent(self)
+
     def add(self, model_object, index=-1):
         if index == -1: index = len(self.children)
         #print "ADD TO " + self.name + ":", model_object.name, index
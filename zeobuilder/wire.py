@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Compact binary messages between Zeobuilder and its child processes
+
+Each message is a frame with a five-byte header (a one-byte message type and
+a four-byte payload length, little endian) followed by the payload. Messages
+that are sent often get a dedicated encoding through register_codecs. The
+packages that run in the helpers define these codecs themselves (see
+conscan.messages and iterative.algorithms.messages) and both the helper and
+the plugin that reads its output register them. Any other object is
+pickled.
+
+The helper programs run as persistent workers: they process one job after the
+other with the function serve. A job is an arbitrary (pickled) message sent to
+the standard input of the worker. The output of each job is terminated with a
+JobDone message. A job is cancelled by sending SIGUSR1 to the worker.
+
+This module does not depend on gtk, such that the helper programs can use it.
+"""
+
+
+import struct, cPickle, signal, traceback
+
+
+__all__ = [
+    "register_codecs", "write_message", "read_message", "Sender", "JobDone",
+    "JobCancelled", "serve",
+]
+
+
+header = struct.Struct("<BI")
+
+# The message type of pickled objects. The other types are chosen by the
+# packages that register a codec.
+PICKLE = 0
+
+# the order matters for subclasses.
+encoders = []
+
+decoders = {
+    PICKLE: cPickle.loads,
+}
+
+
+def register_codecs(codecs):
+    """Use a dedicated encoding for some classes of messages
+
+    Each codec is a tuple (cls, kind, encode, decode). Instances of cls are
+    written as encode(instance) with message type kind and decode(payload)
+    must restore them. Registering the same codec twice has no effect. A
+    message type that is already in use by another codec raises a ValueError.
+    """
+    for cls, kind, encode, decode in codecs:
+        if kind in decoders:
+            if (cls, kind, encode) in encoders and decoders[kind] == decode:
+                continue
+            raise ValueError("Message type %i is already in use." % kind)
+        encoders.append((cls, kind, encode))
+        decoders[kind] = decode
+
+
+def write_message(f, instance):
+    for cls, kind, encode in encoders:
+        if isinstance(instance, cls):
+            payload = encode(instance)
+            break
+    else:
+        kind = PICKLE
+        payload = cPickle.dumps(instance, -1)
+    f.write(header.pack(kind, len(payload)) + payload)
+
+
+def read_message(f):
+    """Read one message from a file, raises EOFError at the end of the file"""
+    data = f.read(header.size)
+    if len(data) < header.size:
+        raise EOFError
+    kind, size = header.unpack(data)
+    payload = f.read(size)
+    if len(payload) < size:
+        raise EOFError
+    return decoders[kind](payload)
+
+
+class JobDone(object):
+    """The last message of each job sent by a worker"""
+    def __init__(self, error=None, cancelled=False):
+        self.error = error
+        self.cancelled = cancelled
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Sender(object):
+    """Writes messages to a file and flushes after each message
+
+    When the job is cancelled, the next call raises JobCancelled. The
+    computations in the helpers send messages regularly, hence these are
+    the points where a job can be interrupted safely.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.cancelled = False
+
+    def __call__(self, instance):
+        if self.cancelled:
+            raise JobCancelled
+        write_message(self.f, instance)
+        self.f.flush()
+
+
+def serve(handle, f_in, f_out):
+    """Process jobs until the end of f_in is reached
+
+    For each job, handle(job, send) is called. The function send must be
+    used for all output of the job.
+    """
+    send = Sender(f_out)
+
+    def on_cancel(signum, frame):
+        send.cancelled = True
+    signal.signal(signal.SIGUSR1, on_cancel)
+    # Restart reads and writes that are interrupted by the signal. Otherwise
+    # a cancel during a large write fails with EINTR and leaves a truncated
+    # message in the output.
+    signal.siginterrupt(signal.SIGUSR1, False)
+
+    while True:
+        try:
+            job = read_message(f_in)
+        except EOFError:
+            break
+        send.cancelled = False
+        try:
+            handle(job, send)
+            done = JobDone()
+        except JobCancelled:
+            done = JobDone(cancelled=True)
+        except Exception:
+            done = JobDone(error=traceback.format_exc())
+        write_message(f_out, done)
+        f_out.flush()
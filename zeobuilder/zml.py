@@ -34,9 +34,9 @@
 
 from zeobuilder import context
 from zeobuilder.undefined import Undefined
-from zeobuilder.filters import Indenter, FilterError
-from zeobuilder.nodes.parent_mixin import ParentMixin, ContainerMixin, ReferentMixin
-from zeobuilder.nodes.model_object import ModelObject
+from zeobuilder.filters import FilterError
+from zeobuilder.nodes.parent_mixin import ParentMixin, DeferredChildren
+from zeobuilder.nodes.model_object import ModelObject, index_model_objects
 from zeobuilder.expressions import Expression
 
 from molmod import Translation, Rotation, Complete, UnitCell
@@ -45,44 +45,37 @@ import xml.sax
 from xml.sax.saxutils import XMLFilterBase, quoteattr, escape
 from xml.sax.xmlreader import AttributesImpl as Attributes
 from xml.sax.handler import ContentHandler
-import base64, numpy, types, StringIO
+import base64, numpy, types, StringIO, struct, mmap, re
 
 
-__all__ = ["dump_to_file", "load_from_file", "load_from_string"]
+__all__ = [
+    "dump_to_file", "load_from_file", "load_from_string",
+    "dump_to_binary_file", "load_from_binary_file",
+]
 
 
-def dump_to_file(f, node):
+def dump_to_file(f, node, blocks=None):
+    """Write node and everything it refers to as ZML to the file f
 
-    identifiers = {}
+    When blocks is a list, numerical arrays are not written as text but
+    appended to blocks and replaced by a <block> tag with the index in that
+    list. This is used by dump_to_binary_file.
 
-    def dump_stage1(node):
-        cls = node.__class__
-        if issubclass(cls, ModelObject):
-            identifiers[node] = len(identifiers)
-            if issubclass(cls, ContainerMixin):
-                for child in node.children:
-                    dump_stage1(child)
-        elif cls == list:
-            for item in node:
-                dump_stage1(item)
-
-
-    def dump_stage2():
-        deleted_some = True
-        while deleted_some:
-            to_be_deleted = []
-            for model_object in identifiers.iterkeys():
-                if isinstance(model_object, ReferentMixin):
-                    for child in model_object.children:
-                        if not child.target in identifiers:
-                            to_be_deleted.append(model_object)
-                            break
-            deleted_some = len(to_be_deleted) > 0
-            for model_object in to_be_deleted:
-                del identifiers[model_object]
-
-
-    def dump_stage3(indenter, node, use_references, name=None):
+    The model objects are collected first with index_model_objects. Then the
+    ZML is streamed through a buffer.
+    """
+
+    identifiers = index_model_objects(node)
+
+    pieces = []
+
+    def write(piece):
+        pieces.append(piece)
+        if len(pieces) >= 4096:
+            f.write("".join(pieces))
+            del pieces[:]
+
+    def dump_node(node, indent, use_references, name=None):
         cls = type(node)
         if cls == types.InstanceType: cls = node.__class__ # For old style stuff
 
@@ -90,94 +83,113 @@ def dump_to_file(f, node):
         else: name_key = " label=" + quoteattr(name)
 
         if issubclass(cls, str):
-            indenter.write_line("<str%s>%s</str>" % (name_key, escape(node)))
+            write("%s<str%s>%s</str>\n" % (indent, name_key, escape(node)))
         elif issubclass(cls, float):
-            indenter.write_line("<float%s>%s</float>" % (name_key, str(node)))
+            write("%s<float%s>%s</float>\n" % (indent, name_key, str(node)))
         elif issubclass(cls, bool):
-            indenter.write_line("<bool%s>%s</bool>" % (name_key, str(node)))
+            write("%s<bool%s>%s</bool>\n" % (indent, name_key, str(node)))
         elif issubclass(cls, int):
-            indenter.write_line("<int%s>%s</int>" % (name_key, str(node)))
+            write("%s<int%s>%s</int>\n" % (indent, name_key, str(node)))
         elif cls == Undefined:
             pass
         elif cls == list:
-            indenter.write_line("<list%s>" % name_key, 1)
-            for item in node: dump_stage3(indenter, item, use_references)
-            indenter.write_line("</list>", -1)
+            write("%s<list%s>\n" % (indent, name_key))
+            for item in node: dump_node(item, indent + " ", use_references)
+            write("%s</list>\n" % indent)
         elif cls == dict:
-            indenter.write_line("<dict%s>" % name_key, 1)
+            write("%s<dict%s>\n" % (indent, name_key))
             for key, val in node.iteritems():
                 if not isinstance(key, str):
                     raise FilterError("ZML supports only strings as dictionary keys.")
-                dump_stage3(indenter, val, use_references, key)
-            indenter.write_line("</dict>", -1)
+                dump_node(val, indent + " ", use_references, key)
+            write("%s</dict>\n" % indent)
         elif cls == tuple:
-            indenter.write_line("<tuple%s>" % name_key, 1)
-            for item in node: dump_stage3(indenter, item, use_references)
-            indenter.write_line("</tuple>", -1)
+            write("%s<tuple%s>\n" % (indent, name_key))
+            for item in node: dump_node(item, indent + " ", use_references)
+            write("%s</tuple>\n" % indent)
+        elif cls == numpy.ndarray and blocks is not None and node.dtype.kind in "biuf":
+            write("%s<block%s index='%i' />\n" % (indent, name_key, len(blocks)))
+            blocks.append(node)
         elif cls == numpy.ndarray:
-            shape = node.shape
-            indenter.write_line("<array%s>" % name_key, 1)
-            indenter.write("<shape>")
-            for value in node.shape:
-                indenter.write("%s " % value)
-            indenter.write("</shape>", True)
-            indenter.write("<cells>")
-            for value in numpy.ravel(node):
-                indenter.write("%s " % value)
-            indenter.write("</cells>", True)
-            indenter.write_line("</array>", -1)
+            write("%s<array%s>\n" % (indent, name_key))
+            write("%s <shape>%s</shape>\n" % (indent, "".join("%s " % value for value in node.shape)))
+            write("%s <cells>" % indent)
+            values = numpy.ravel(node)
+            for start in xrange(0, len(values), 1024):
+                write("".join("%s " % value for value in values[start:start+1024]))
+            write("</cells>\n")
+            write("%s</array>\n" % indent)
         elif cls == StringIO.StringIO:
-            indenter.write("<binary%s>" % name_key)
-            node.seek(0)
-            base64.encode(node, f)
-            indenter.write("</binary>", True)
+            write("%s<binary%s>%s</binary>\n" % (indent, name_key, base64.encodestring(node.getvalue())))
         elif cls == Translation:
-            indenter.write_line("<translation%s>" % name_key, 1)
-            dump_stage3(indenter, node.t, use_references, name="translation_vector")
-            indenter.write_line("</translation>", -1)
+            write("%s<translation%s>\n" % (indent, name_key))
+            dump_node(node.t, indent + " ", use_references, name="translation_vector")
+            write("%s</translation>\n" % indent)
         elif cls == Rotation:
-            indenter.write_line("<rotation%s>" % name_key, 1)
-            dump_stage3(indenter, node.r, use_references, name="rotation_matrix")
-            indenter.write_line("</rotation>", -1)
+            write("%s<rotation%s>\n" % (indent, name_key))
+            dump_node(node.r, indent + " ", use_references, name="rotation_matrix")
+            write("%s</rotation>\n" % indent)
         elif cls == Complete:
-            indenter.write_line("<transformation%s>" % name_key, 1)
-            dump_stage3(indenter, node.t, use_references, name="translation_vector")
-            dump_stage3(indenter, node.r, use_references, name="rotation_matrix")
-            indenter.write_line("</transformation>", -1)
+            write("%s<transformation%s>\n" % (indent, name_key))
+            dump_node(node.t, indent + " ", use_references, name="translation_vector")
+            dump_node(node.r, indent + " ", use_references, name="rotation_matrix")
+            write("%s</transformation>\n" % indent)
         elif cls == UnitCell:
-            indenter.write_line("<unit_cell%s>" % name_key, 1)
-            dump_stage3(indenter, node.matrix, use_references, name="matrix")
-            dump_stage3(indenter, node.active, use_references, name="active")
-            indenter.write_line("</unit_cell>", -1)
+            write("%s<unit_cell%s>\n" % (indent, name_key))
+            dump_node(node.matrix, indent + " ", use_references, name="matrix")
+            dump_node(node.active, indent + " ", use_references, name="active")
+            write("%s</unit_cell>\n" % indent)
         elif cls == Expression:
-            indenter.write_line("<expression%s>%s</expression>" % (name_key, escape(node.code)))
+            write("%s<expression%s>%s</expression>\n" % (indent, name_key, escape(node.code)))
         elif issubclass(cls, ModelObject):
             if node in identifiers:
                 if use_references:
-                    indenter.write_line("<reference to='%i' />" % identifiers[node])
+                    write("%s<reference to='%i' />\n" % (indent, identifiers[node]))
                 else:
-                    indenter.write_line("<model_object%s id='%i' class='%s'>" % (name_key, identifiers[node], node.class_name()), 1)
+                    write("%s<model_object%s id='%i' class='%s'>\n" % (indent, name_key, identifiers[node], node.class_name()))
                     for key, item in node.__getstate__().iteritems():
-                        dump_stage3(indenter, item, key!="children", key)
-                    indenter.write_line("</model_object>", -1)
+                        dump_node(item, indent + " ", key!="children", key)
+                    write("%s</model_object>\n" % indent)
         else:
             raise FilterError, "Can not handle node %s of class %s" % (node, cls)
 
-    indenter = Indenter(f)
-    dump_stage1(node)
-    dump_stage2()
-    indenter.write_line("<?xml version='1.0'?>")
-    indenter.write_line("<zml_file version='0.2'>", 1)
-    dump_stage3(indenter, node, False)
-    indenter.write_line("</zml_file>", -1)
+    write("<?xml version='1.0'?>\n")
+    write("<zml_file version='0.2'>\n")
+    dump_node(node, " ", False)
+    write("</zml_file>\n")
+    f.write("".join(pieces))
 
     # this is usefull when the caller wants to know if there were actually
     # model_objects pickled.
     return len(identifiers)
 
+
 # ---
 
 
+def parse_numbers(content):
+    """Convert the text of a <cells> or <grid> tag into a flat array
+
+    The type of the array is derived from the first word, just like the
+    original per-word eval: True/False give a boolean array, words without a
+    decimal point or exponent give an integer array and everything else,
+    including integers that do not fit in an int64, gives a floating point
+    array.
+    """
+    words = content.split()
+    if len(words) == 0:
+        return numpy.zeros(0, float)
+    first = words[0]
+    if first == "True" or first == "False":
+        return numpy.array(words) == "True"
+    if not ("." in first or "e" in first or "n" in first):
+        try:
+            return numpy.array(words, int)
+        except (ValueError, OverflowError):
+            pass
+    return numpy.array(words, float)
+
+
 class ZMLTag(object):
     def __init__(self, name, attributes):
         self.name = name
@@ -189,21 +201,24 @@ class ZMLTag(object):
             self.content = StringIO.StringIO()
         else:
             self.binary_content = False
-            self.content = ""
+            # the text is collected in pieces and joined in endElement
+            self.content = []
         self.value = None
         self.being_processed = True
 
     def add_content(self, content):
         if self.binary_content: self.content.write(content)
-        else: self.content += content
+        else: self.content.append(content)
 
     def close(self):
         self.being_processed = False
 
 
 class ZMLHandler(ContentHandler):
-    def __init__(self):
+    def __init__(self, blocks=None, lazy_loader=None):
         self.root = None
+        self.blocks = blocks
+        self.lazy_loader = lazy_loader
         self.model_object_tags = {}
         self.target_ids = {}
 
@@ -239,6 +254,8 @@ class ZMLHandler(ContentHandler):
         if not current_tag.being_processed:
             current_tag = self.hierarchy[-2][-1]
             child_tags = self.hierarchy[-1]
+        if not current_tag.binary_content:
+            current_tag.content = "".join(current_tag.content)
 
         # do it
         if name == "str": current_tag.value = str(current_tag.content)
@@ -254,12 +271,16 @@ class ZMLHandler(ContentHandler):
         elif name == "shape":
             current_tag.value = tuple(int(item) for item in current_tag.content.split())
         elif name == "cells":
-            current_tag.value = numpy.array([eval(item) for item in current_tag.content.split()])
+            current_tag.value = parse_numbers(current_tag.content)
         elif name == "array":
             child_dict = dict((tag.name, tag.value) for tag in child_tags)
             current_tag.value = numpy.reshape(child_dict["cells"], child_dict["shape"])
+        elif name == "lazy_children":
+            current_tag.value = self.lazy_loader.regions[int(current_tag.attributes["index"])]
+        elif name == "block":
+            current_tag.value = self.blocks[int(current_tag.attributes["index"])]
         elif name == "grid":
-            current_tag.value = numpy.reshape(numpy.array([eval(item) for item in current_tag.content.split()]), (int(current_tag.attributes["rows"]), int(current_tag.attributes["cols"]), -1))
+            current_tag.value = numpy.reshape(parse_numbers(current_tag.content), (int(current_tag.attributes["rows"]), int(current_tag.attributes["cols"]), -1))
         elif name == "binary":
             current_tag.value = StringIO.StringIO()
             current_tag.content.seek(0)
@@ -306,16 +327,27 @@ class ZMLHandler(ContentHandler):
         self.root = self.hierarchy[0][0].value
         self.hierarchy = []
 
+        if self.lazy_loader is not None:
+            for model_object_id, model_object_tag in self.model_object_tags.iteritems():
+                self.lazy_loader.model_objects[model_object_id] = model_object_tag.value
+
         # fix the targets:
         for referent_tag, target_ids in self.target_ids.iteritems():
             referent_tag.state["targets"] = [
-                self.model_object_tags[target_id].value for target_id in target_ids
+                self.get_target(target_id) for target_id in target_ids
             ]
 
         # set the states of all the model_objects:
         for model_object_tag in self.model_object_tags.itervalues():
             model_object_tag.value.initstate(**model_object_tag.state)
 
+    def get_target(self, target_id):
+        model_object_tag = self.model_object_tags.get(target_id)
+        if model_object_tag is None and self.lazy_loader is not None:
+            # the target is in a part of the file that is not loaded yet
+            return self.lazy_loader.get_model_object(target_id)
+        return self.model_object_tags[target_id].value
+
 
 class Convertor1(XMLFilterBase):
     """XMLFilter that converts from zml format 0.1 to format 0.2"""
@@ -395,12 +427,118 @@ class Convertor1(XMLFilterBase):
             if name == "array" and self.recording == "cell_active":
                 self.recording = None
                 words = (" ".join(self.cell_active)).split()[1:]
-                self.cell_active = numpy.array([eval(v) for v in words])
+                self.cell_active = parse_numbers(" ".join(words))
                 self.cell_active.shape = (3,)
 
 convertors = [Convertor1]
 
-def load_from_file(f):
+class LazyLoader(object):
+    """Parses the children of nested containers only when they are used
+
+    The children of the top-level model objects are loaded immediately. The
+    children lists of deeper containers are cut out of the document with a
+    simple scan of the tags and are replaced by DeferredChildren objects.
+    This works for ZML 0.2 as written by dump_to_file, in which tag names
+    and attribute values can not contain '<' or '>'.
+    """
+
+    version_pattern = re.compile(r"""<zml_file version=['"]0\.2['"]""")
+    tag_pattern = re.compile(r"<(/?)(model_object|list)\b([^>]*)>")
+    id_pattern = re.compile(r"""\bid=['"](\d+)['"]""")
+    children_pattern = re.compile(r"""\blabel=['"]children['"]""")
+
+    def __init__(self, data):
+        self.data = data
+        # the DeferredChildren objects, in the order they are found
+        self.regions = []
+        # for each id that is not loaded yet, the region that contains it
+        self.region_ids = {}
+        # the model objects that are already created, by id
+        self.model_objects = {}
+
+    def cut_regions(self, start, end, min_depth):
+        """Return the document between start and end without the deferred parts
+
+        The children lists of model objects that are nested min_depth or
+        more levels deep are replaced by <lazy_children> tags.
+        """
+        pieces = []
+        last = start
+        depth = 0 # the number of open model objects
+        lists = [] # for each open list, its region or None
+        region = None
+        for match in self.tag_pattern.finditer(self.data, start, end):
+            closing, name, attributes = match.groups()
+            if attributes.endswith("/"):
+                continue
+            if name == "model_object":
+                if closing:
+                    depth -= 1
+                else:
+                    depth += 1
+                    if region is not None:
+                        id_match = self.id_pattern.search(attributes)
+                        if id_match is not None:
+                            self.region_ids[int(id_match.group(1))] = region
+            elif closing:
+                if lists.pop() is not None:
+                    region.function = self.region_function(region_start, match.end())
+                    pieces.append(self.data[last:region_start])
+                    pieces.append("<lazy_children label='children' index='%i' />" % region_index)
+                    last = match.end()
+                    region = None
+            elif region is None and depth >= min_depth and self.children_pattern.search(attributes):
+                region = DeferredChildren(None)
+                region_start = match.start()
+                region_index = len(self.regions)
+                self.regions.append(region)
+                lists.append(region)
+            else:
+                lists.append(None)
+        pieces.append(self.data[last:end])
+        return "".join(pieces)
+
+    def region_function(self, start, end):
+        return lambda: self.parse(start, end, 1)
+
+    def parse(self, start, end, min_depth):
+        content_handler = ZMLHandler(lazy_loader=self)
+        xml.sax.parseString(
+            "<zml_file version='0.2'>%s</zml_file>" % self.cut_regions(start, end, min_depth),
+            content_handler
+        )
+        return content_handler.root
+
+    def get_model_object(self, model_object_id):
+        # the model object may be nested in several deferred containers,
+        # which are loaded from the outside in.
+        while model_object_id not in self.model_objects:
+            region = self.region_ids[model_object_id]
+            region.get()
+            if region.container is not None:
+                region.container.load_deferred_children()
+        return self.model_objects[model_object_id]
+
+
+def load_from_file(f, lazy=False):
+    """Load the nodes from a ZML file
+
+    With lazy=True, the children of nested containers, e.g. the atoms in the
+    frames of a Universe, are only parsed when they are used for the first
+    time. This is not possible for old ZML formats, which are always loaded
+    completely. In the GUI, such containers only get a placeholder row in the
+    tree view and their children are not drawn until they are loaded, e.g.
+    when the container is expanded.
+    """
+    if lazy:
+        data = f.read()
+        start = data.find("<zml_file")
+        if start >= 0 and LazyLoader.version_pattern.match(data, start):
+            root = LazyLoader(data).parse(data.find(">", start) + 1, data.rfind("</zml_file>"), 2)
+            for node in root:
+                if isinstance(node, ParentMixin):
+                    node.reparent()
+            return root
     counter = 0
     while True:
         try:
@@ -433,3 +571,95 @@ def load_from_string(s):
     return root
 
 
+
+
+# Binary ZML
+#
+# A binary ZML file starts with an eight byte signature, followed by a
+# sequence of chunks. Each chunk has a four character type, four reserved
+# bytes, the size of the payload as a little-endian 64-bit integer and the
+# payload itself, padded with zeros to a multiple of eight bytes. The first
+# chunk (TREE) contains the ZML document in which numerical arrays are
+# replaced by <block> tags. Each following chunk (ARRY) contains one array:
+# the dtype string in eight bytes, the number of dimensions and the shape as
+# 64-bit integers, and the raw little-endian data. All array data is aligned
+# on eight bytes so that it can be read directly from a memory map.
+
+
+binary_signature = "ZMLB\x00\x00\x00\x01"
+
+
+def _write_chunk(f, chunk_type, parts):
+    size = sum(len(part) for part in parts)
+    f.write(struct.pack("<4s4xQ", chunk_type, size))
+    for part in parts:
+        f.write(part)
+    f.write("\x00"*(-size % 8))
+
+
+def dump_to_binary_file(f, node):
+    blocks = []
+    tree = StringIO.StringIO()
+    result = dump_to_file(tree, node, blocks)
+    f.write(binary_signature)
+    _write_chunk(f, "TREE", [tree.getvalue()])
+    for array in blocks:
+        dtype = array.dtype.newbyteorder("<")
+        array = numpy.array(array, dtype, copy=False, order="C")
+        _write_chunk(f, "ARRY", [
+            struct.pack("<8sQ", dtype.str, array.ndim),
+            struct.pack("<%iQ" % array.ndim, *array.shape),
+            array.tostring(),
+        ])
+    return result
+
+
+def _map_file(f):
+    # Returns a read-only buffer with the contents of the file. Regular files
+    # are mapped, so that the arrays are read from disk only once, while they
+    # are copied into the model. Compressed files are read completely.
+    if isinstance(f, file):
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            pass
+    return f.read()
+
+
+def load_from_binary_file(f):
+    data = _map_file(f)
+    try:
+        if data[:len(binary_signature)] != binary_signature:
+            raise FilterError("The file does not start with the binary ZML signature.")
+        offset = len(binary_signature)
+        tree = None
+        blocks = []
+        while offset < len(data):
+            chunk_type, size = struct.unpack_from("<4s4xQ", data, offset)
+            offset += 16
+            if chunk_type == "TREE":
+                tree = data[offset:offset+size]
+            elif chunk_type == "ARRY":
+                dtype, ndim = struct.unpack_from("<8sQ", data, offset)
+                shape = struct.unpack_from("<%iQ" % ndim, data, offset + 16)
+                # The model never refers to the map itself: the file may be
+                # overwritten while the model is still in use, e.g. when it
+                # is saved back to the same path.
+                blocks.append(numpy.ndarray(
+                    shape, numpy.dtype(dtype.rstrip("\x00")), data,
+                    offset + 16 + 8*ndim
+                ).copy())
+            offset += size + (-size % 8)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    if tree is None:
+        raise FilterError("The binary ZML file does not contain a TREE chunk.")
+
+    content_handler = ZMLHandler(blocks)
+    xml.sax.parseString(tree, content_handler)
+    root = content_handler.root
+    for node in root:
+        if isinstance(node, ParentMixin):
+            node.reparent()
+    return root